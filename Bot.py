@@ -1,25 +1,56 @@
 import os
+import time
 import asyncio
 import logging
 import gspread
+from gspread.utils import rowcol_to_a1, a1_to_rowcol
+import re
 import json
+import heapq
+import random
+import hashlib
+import hmac
+import zlib
+import array
+import struct
+import marshal
+import bisect
+import itertools
+import functools
+import multiprocessing
+import sqlite3
+import threading
+import contextvars
+import html
+from collections import OrderedDict
+from queue import Empty
 from aiogram import Bot, Dispatcher, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     KeyboardButton,
     ReplyKeyboardMarkup,
-    ReplyKeyboardRemove
+    ReplyKeyboardRemove,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent
 )
 from aiogram import F
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
 from oauth2client.service_account import ServiceAccountCredentials
+from oauth2client import transport as oauth2_transport
+from concurrent.futures import ThreadPoolExecutor
 import traceback
+from types import MappingProxyType
+import aiohttp
 from aiohttp import web
+from urllib.parse import quote
 from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 import traceback
 
 load_dotenv()
@@ -45,16 +76,129 @@ sheet_clients = None   # "Клиенты - Партнерки"
 sheet_logs = None      # "Логи от бота"
 sheet_offers = None    # "Офферы"
 
-# меню пользователя: хранит (chat_id, message_id, category, page)
-USER_MENU_MESSAGE: dict[int, dict] = {}
+# USER_MENU_MESSAGE (меню пользователя) и PENDING_OFFER (ожидание кода) — ограниченные StateStore, см. ниже
 
-OFFERS = {}
-OFFERS_BY_CATEGORY = {}   # { "Дебетовые карты": [offer_obj, ...], ... }
-OFFERS_BY_ID = {}         # { "1": offer_obj, ... }
+# каталог офферов — неизменяемый снимок CATALOG (см. CatalogSnapshot), здесь только карта колонок
 CLIENT_OFFER_COL_MAP = {} # { offer_id_int: column_index_in_clients_sheet }
-PENDING_OFFER = {}        # { user_id: offer_id } временная память ожидающих ввода кода
 PAGE_SIZE = 5
 
+# состояние диалогов: ограничение по числу записей/памяти, TTL и сохранение на диск между деплоями
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "100000"))
+STATE_MAX_BYTES = int(os.getenv("STATE_MAX_BYTES", str(32 * 1024 * 1024)))
+STATE_MENU_TTL_SEC = float(os.getenv("STATE_MENU_TTL_SEC", str(7 * 24 * 3600)))
+STATE_PENDING_TTL_SEC = float(os.getenv("STATE_PENDING_TTL_SEC", str(24 * 3600)))
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.sqlite3")   # пусто — только в памяти
+STATE_FLUSH_INTERVAL_SEC = float(os.getenv("STATE_FLUSH_INTERVAL_SEC", "1"))
+
+# быстрый старт: снимок каталога и индекса клиентов на диске — после деплоя бот отвечает сразу,
+# а сверка с таблицей идёт фоном (пусто — не используется)
+WARM_START_PATH = os.getenv("WARM_START_PATH", "bot_warm_start.bin")
+WARM_START_SAVE_DELAY_SEC = float(os.getenv("WARM_START_SAVE_DELAY_SEC", "5"))
+# пока хранилище подключается, апдейты, которым нужна таблица, ждут его не дольше N секунд
+STORAGE_READY_TIMEOUT_SEC = float(os.getenv("STORAGE_READY_TIMEOUT_SEC", "15"))
+
+# повторное нажатие той же кнопки в том же меню чаще, чем раз в N секунд, игнорируется
+MENU_DEBOUNCE_SEC = float(os.getenv("MENU_DEBOUNCE_SEC", "0.7"))
+
+# как часто фоном пересобирать индекс user_id -> строка (сек)
+CLIENT_INDEX_RESYNC_SEC = int(os.getenv("CLIENT_INDEX_RESYNC_SEC", "300"))
+
+# буфер логов: сбрасываем одним append_rows раз в N секунд или при накоплении N строк
+LOG_FLUSH_INTERVAL_SEC = float(os.getenv("LOG_FLUSH_INTERVAL_SEC", "5"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "200"))
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "20000"))
+
+# апдейт дольше порога (мс) пишется в лог [SLOW] с разбивкой времени по вызовам Sheets / Telegram
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "50"))
+
+# администраторы (user_id через запятую): команды рассылки доступны только им
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.lstrip("-").isdigit()}
+
+# рассылка о новых офферах: темп (сообщений в секунду), число параллельных отправителей, размер пачки строк
+BROADCAST_RATE_PER_SEC = float(os.getenv("BROADCAST_RATE_PER_SEC", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_CHUNK_ROWS = int(os.getenv("BROADCAST_CHUNK_ROWS", "200"))
+
+# число процессов-воркеров; больше 1 — апдейты распределяются по процессам по хэшу user_id
+WORKERS = int(os.getenv("WORKERS", "1"))
+# сколько фронт ждёт метрики воркеров для /metrics (не ответившие в срок пропускаются)
+METRICS_WORKER_TIMEOUT_SEC = float(os.getenv("METRICS_WORKER_TIMEOUT_SEC", "2"))
+
+# приём апдейтов: "polling" (по умолчанию) или "webhook" (на том же aiohttp-сервере, что и healthcheck)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")          # например https://my-bot.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")               # обязателен в режиме webhook
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+
+# inline-поиск офферов (@bot запрос): результатов на страницу, кэш ответа у Telegram,
+# сколько ждём статусы пользователя (чтобы скрыть взятые офферы) до ответа без фильтра
+INLINE_PAGE_SIZE = int(os.getenv("INLINE_PAGE_SIZE", "20"))
+INLINE_CACHE_SEC = int(os.getenv("INLINE_CACHE_SEC", "30"))
+INLINE_STATUS_TIMEOUT_SEC = float(os.getenv("INLINE_STATUS_TIMEOUT_SEC", "1"))
+
+# планировщик запросов к Google Sheets: свой пул потоков и квоты (запросов в минуту)
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "8"))
+SHEETS_READS_PER_MIN = int(os.getenv("SHEETS_READS_PER_MIN", "60"))
+SHEETS_WRITES_PER_MIN = int(os.getenv("SHEETS_WRITES_PER_MIN", "60"))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+SHEETS_BACKOFF_BASE_SEC = float(os.getenv("SHEETS_BACKOFF_BASE_SEC", "1"))
+SHEETS_BACKOFF_MAX_SEC = float(os.getenv("SHEETS_BACKOFF_MAX_SEC", "64"))
+
+# одинаковые одновременные чтения Sheets объединяются в один запрос; результат можно
+# дополнительно переиспользовать N секунд (0 — только объединение запросов «в полёте»)
+SHEETS_READ_FRESH_SEC = float(os.getenv("SHEETS_READ_FRESH_SEC", "0"))
+
+# приоритеты запросов к Sheets: меньше — важнее
+PRIO_USER = 0         # пользователь ждёт ответа
+PRIO_BACKGROUND = 1   # фоновые синхронизации и отложенные записи
+PRIO_LOG = 2          # логи
+
+# исходящие запросы к Telegram: общий лимит бота и лимит на чат (сообщений в секунду), повторы при flood wait
+TG_GLOBAL_PER_SEC = float(os.getenv("TG_GLOBAL_PER_SEC", "28"))
+TG_CHAT_PER_SEC = float(os.getenv("TG_CHAT_PER_SEC", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_GROUP_PER_MIN = float(os.getenv("TG_GROUP_PER_MIN", "20"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+TG_MAX_RETRY_AFTER_SEC = float(os.getenv("TG_MAX_RETRY_AFTER_SEC", "30"))
+
+# приоритеты исходящих запросов к Telegram: меньше — важнее
+TG_PRIO_ANSWER = 0    # ответ на нажатие кнопки (у Telegram на него ограниченное время)
+TG_PRIO_EDIT = 1      # редактирование меню
+TG_PRIO_SEND = 2      # обычные сообщения
+TG_PRIO_BULK = 3      # рассылки
+
+# фоновая перезагрузка каталога офферов (сек)
+CATALOG_REFRESH_SEC = int(os.getenv("CATALOG_REFRESH_SEC", "300"))
+
+# кэш строк клиентов: изменённые ячейки копятся и уходят одним batch_update
+CLIENT_FLUSH_INTERVAL_SEC = float(os.getenv("CLIENT_FLUSH_INTERVAL_SEC", "2"))
+CLIENT_ROW_TTL_SEC = float(os.getenv("CLIENT_ROW_TTL_SEC", "60"))
+
+# регистрация новых клиентов: новые строки копятся и уходят одним append_rows
+REGISTRATION_BATCH_SEC = float(os.getenv("REGISTRATION_BATCH_SEC", "0.1"))
+REGISTRATION_BATCH_SIZE = int(os.getenv("REGISTRATION_BATCH_SIZE", "50"))
+# сколько обработчик ждёт номер строки нового клиента (0 — не ждёт: строка уже в журнале и в очереди,
+# следующие изменения дописываются прямо в неё)
+REGISTRATION_WAIT_SEC = float(os.getenv("REGISTRATION_WAIT_SEC", "0"))
+# повтор после сбоя Google: от RETRY_SEC, удваивается с каждым сбоем подряд, но не больше RETRY_MAX_SEC
+REGISTRATION_RETRY_SEC = float(os.getenv("REGISTRATION_RETRY_SEC", "5"))
+REGISTRATION_RETRY_MAX_SEC = float(os.getenv("REGISTRATION_RETRY_MAX_SEC", "300"))
+
+# журнал записей (write-ahead): каждое изменение сначала дописывается в локальный файл, в Google — фоном;
+# после сбоя Google или рестарта неподтверждённые записи доезжают по порядку (пусто — без журнала)
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "bot_journal.jsonl")
+JOURNAL_FSYNC_SEC = float(os.getenv("JOURNAL_FSYNC_SEC", "0.05"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(8 * 1024 * 1024)))
+JOURNAL_REPLAY_SEC = float(os.getenv("JOURNAL_REPLAY_SEC", "5"))
+
+# статусы офферов пользователя (взятые / в работе / выполненные) держим в памяти
+OFFER_STATUS_TTL_SEC = float(os.getenv("OFFER_STATUS_TTL_SEC", "600"))
+OFFER_STATUS_REFRESH_SEC = float(os.getenv("OFFER_STATUS_REFRESH_SEC", "60"))
+OFFER_STATUS_REFRESH_CHUNK = int(os.getenv("OFFER_STATUS_REFRESH_CHUNK", "200"))   # строк на один batch_get
+
 # Константы кол-во колонок и индексы (A..Q)
 NUM_COLUMNS = 40
 # LAST_COLUMNS = "BK"
@@ -69,11 +213,210 @@ IDX_OFFER_NO = 8    # H
 # K..} = 10..} (чекбоксы офферов)
 
 SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1pGc9kdpdFggwZlc3wairUBunou1BW_fw-D-heBViHic/edit#gid=0"
+SHEET_CLIENTS_TITLE = "Клиенты - Партнерки"
+SHEET_LOGS_TITLE = "Логи от бота"
+SHEET_OFFERS_TITLE = "Офферы"
+
+# хранилище: "aiohttp" (Google Sheets API напрямую, без потоков), "gspread" (Google Sheets через gspread)
+# или "sqlite" (локально, для офлайн-прогонов и нагрузочных тестов)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "aiohttp")
+SHEETS_HTTP_POOL_SIZE = int(os.getenv("SHEETS_HTTP_POOL_SIZE", "16"))
+SHEETS_HTTP_TIMEOUT_SEC = float(os.getenv("SHEETS_HTTP_TIMEOUT_SEC", "30"))
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot_storage.sqlite3")   # ":memory:" — только в памяти
+# хранилище не открылось при старте — повторяем фоном: от RETRY_SEC, удваивая, но не реже RETRY_MAX_SEC
+STORAGE_RETRY_SEC = float(os.getenv("STORAGE_RETRY_SEC", "5"))
+STORAGE_RETRY_MAX_SEC = float(os.getenv("STORAGE_RETRY_MAX_SEC", "300"))
+
+class Histogram:
+    """Гистограмма в стиле Prometheus (накопление по бакетам делается при выводе)"""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # последний — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    Счётчики, гистограммы и gauge'и для /metrics (текстовый формат Prometheus).
+    Запись — обычные операции со словарём в потоке event loop, без блокировок.
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._gauges: dict[str, tuple] = {}    # name -> (help, fn() -> число или {labels: число})
+        self._help: dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._counters.get(name)
+        if series is None:
+            series = self._counters[name] = {}
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._histograms.get(name)
+        if series is None:
+            series = self._histograms[name] = {}
+        key = tuple(sorted(labels.items()))
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = Histogram(self.DEFAULT_BUCKETS)
+        hist.observe(value)
+
+    def gauge(self, name: str, help_text: str, fn):
+        self._gauges[name] = (help_text, fn)
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    @staticmethod
+    def _labels(key) -> str:
+        parts = ['{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in key]
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def snapshot(self) -> dict:
+        """Текущие значения простыми структурами (pickle) — фронт собирает их с воркеров"""
+        gauges = {}
+        for name, (help_text, fn) in self._gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning(f"metrics: gauge {name} недоступен: {e}")
+                continue
+            gauges[name] = (help_text, value if isinstance(value, dict) else {(): value})
+        return {
+            "counters": {name: dict(series) for name, series in self._counters.items()},
+            "histograms": {
+                name: {key: (h.bounds, list(h.counts), h.sum, h.count) for key, h in series.items()}
+                for name, series in self._histograms.items()
+            },
+            "gauges": gauges,
+            "help": dict(self._help),
+        }
+
+    def render(self, labels: tuple = (), others: list = ()) -> str:
+        """
+        Свои метрики плюс others — [(labels, snapshot)] других процессов.
+        labels добавляются ко всем сериям источника; одноимённые метрики выводятся одним блоком.
+        """
+        counters, histograms, gauges, help_texts = {}, {}, {}, {}
+        for src_labels, snap in [(labels, self.snapshot()), *others]:
+            help_texts.update(snap["help"])
+            for name, series in snap["counters"].items():
+                out = counters.setdefault(name, [])
+                out.extend((src_labels + key, value) for key, value in series.items())
+            for name, series in snap["histograms"].items():
+                out = histograms.setdefault(name, [])
+                out.extend((src_labels + key, hist) for key, hist in series.items())
+            for name, (help_text, series) in snap["gauges"].items():
+                help_texts.setdefault(name, help_text)
+                out = gauges.setdefault(name, [])
+                out.extend((src_labels + key, value) for key, value in series.items())
+        lines = []
+        for name, series in counters.items():
+            if name in help_texts:
+                lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series:
+                lines.append(f"{name}{self._labels(key)} {value}")
+        for name, series in histograms.items():
+            if name in help_texts:
+                lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, (bounds, counts, total, count) in series:
+                acc = 0
+                for bound, cnt in zip(bounds, counts):
+                    acc += cnt
+                    lines.append(f"{name}_bucket{self._labels(key + (('le', bound),))} {acc}")
+                lines.append(f"{name}_bucket{self._labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._labels(key)} {total}")
+                lines.append(f"{name}_count{self._labels(key)} {count}")
+        for name, series in gauges.items():
+            lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in series:
+                lines.append(f"{name}{self._labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("bot_handler_duration_seconds", "Время обработки апдейта обработчиком")
+METRICS.describe("bot_sheets_request_duration_seconds", "Время запроса к Google Sheets (включая ожидание квоты)")
+METRICS.describe("bot_sheets_errors_total", "Ошибки Google Sheets по HTTP-статусу")
+METRICS.describe("bot_telegram_request_duration_seconds", "Время запроса к Telegram Bot API")
+METRICS.describe("bot_telegram_errors_total", "Ошибки Telegram Bot API")
+
+class UpdateTrace:
+    """
+    Трасса одного апдейта: какие вызовы Sheets / Telegram он ждал и сколько.
+    Живёт в contextvar, поэтому видна во всех await внутри обработчика без передачи аргументов.
+    """
+    __slots__ = ("handler", "user_id", "start", "spans", "dropped", "totals", "finished")
+
+    def __init__(self, handler: str, user_id):
+        self.handler = handler
+        self.user_id = user_id
+        self.start = time.perf_counter()
+        self.spans = []        # (kind, name, offset_ms, duration_ms, wait_ms)
+        self.dropped = 0
+        self.totals = {}       # kind -> [calls, duration, wait]
+        self.finished = False
+
+    def add_span(self, kind: str, name: str, started: float, duration: float, wait: float = 0.0):
+        # задачи, порождённые обработчиком (create_task копирует контекст), могут закончиться позже — не считаем
+        if self.finished:
+            return
+        total = self.totals.get(kind)
+        if total is None:
+            total = self.totals[kind] = [0, 0.0, 0.0]
+        total[0] += 1
+        total[1] += duration
+        total[2] += wait
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((kind, name, round((started - self.start) * 1000, 1),
+                               round(duration * 1000, 1), round(wait * 1000, 1)))
+        else:
+            self.dropped += 1
+
+    def summary(self, elapsed: float) -> dict:
+        spent = sum(t[1] for t in self.totals.values())
+        result = {
+            "handler": self.handler,
+            "user_id": self.user_id,
+            "total_ms": round(elapsed * 1000, 1),
+            # вызовы могут идти параллельно, поэтому "прочее" не меньше нуля
+            "other_ms": round(max(0.0, elapsed - spent) * 1000, 1),
+        }
+        for kind, (calls, duration, wait) in self.totals.items():
+            result[f"{kind}_calls"] = calls
+            result[f"{kind}_ms"] = round(duration * 1000, 1)
+            if wait:
+                result[f"{kind}_wait_ms"] = round(wait * 1000, 1)
+        result["spans"] = self.spans
+        if self.dropped:
+            result["spans_dropped"] = self.dropped
+        return result
+
+CURRENT_TRACE: contextvars.ContextVar = contextvars.ContextVar("update_trace", default=None)
+
+def trace_span(kind: str, name: str, started: float, duration: float, wait: float = 0.0):
+    """Добавляет вызов в трассу текущего апдейта (если вызов идёт не из обработчика — ничего не делает)"""
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add_span(kind, name, started, duration, wait)
 
 class LoggingMiddleware(BaseMiddleware):
     """
     Логирует входящие Message и CallbackQuery.
-    Не блокирует обработчик — логирование в Google выполняется в background (create_task).
+    Не блокирует обработчик — строка только кладётся в очередь LOG_WRITER, запись в Google идёт пачками.
     """
     async def __call__(self, handler, event, data):
         try:
@@ -82,33 +425,1596 @@ class LoggingMiddleware(BaseMiddleware):
                 user = event.from_user
                 text = (event.text or "")[:300]
                 logger.info(f"[MSG] {user.id} @{user.username} : {text}")
-                # лог в Google в фоне (не блокируем основной обработчик)
-                try:
-                    asyncio.create_task(log_event(user, "MSG", text))
-                except Exception as e:
-                    logger.error(f"Failed schedule log_event: {e}")
+                # лог в Google через буфер (не блокируем основной обработчик)
+                enqueue_log(user, "MSG", text)
 
             # CALLBACK QUERY
             elif isinstance(event, types.CallbackQuery):
                 user = event.from_user
                 data_text = (event.data or "")[:200]
                 logger.info(f"[CB] {user.id} @{user.username} : {data_text}")
-                try:
-                    asyncio.create_task(log_event(user, "CB", data_text))
-                except Exception as e:
-                    logger.error(f"Failed schedule log_event: {e}")
+                enqueue_log(user, "CB", data_text)
 
         except Exception as e:
             logger.error("Ошибка в LoggingMiddleware: " + str(e))
             logger.error(traceback.format_exc())
 
-        # передаём событие дальше
+        # передаём событие дальше (и меряем время обработчика)
+        handler_obj = data.get("handler")
+        handler_name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        from_user = getattr(event, "from_user", None)
+        trace = UpdateTrace(handler_name, from_user.id if from_user else None)
+        token = CURRENT_TRACE.set(trace)
+        try:
+            return await handler(event, data)
+        except Exception:
+            METRICS.inc("bot_handler_errors_total", handler=handler_name)
+            raise
+        finally:
+            CURRENT_TRACE.reset(token)
+            trace.finished = True
+            elapsed = time.perf_counter() - trace.start
+            METRICS.observe("bot_handler_duration_seconds", elapsed, handler=handler_name)
+            if elapsed * 1000 >= SLOW_UPDATE_MS:
+                METRICS.inc("bot_slow_updates_total", handler=handler_name)
+                logger.warning("[SLOW] " + json.dumps(trace.summary(elapsed), ensure_ascii=False))
+
+class CallbackDebounceMiddleware(BaseMiddleware):
+    """
+    Гасит дребезг: то же нажатие (пользователь, сообщение, callback_data) в течение window секунд
+    только снимает «часики» с кнопки и не запускает обработчик повторно.
+    """
+    def __init__(self, window: float):
+        self.window = window
+        self._last: dict[tuple, float] = {}
+        self._next_sweep = 0.0
+
+    async def __call__(self, handler, event, data):
+        if self.window <= 0 or not isinstance(event, types.CallbackQuery):
+            return await handler(event, data)
+        now = time.monotonic()
+        message_id = event.message.message_id if event.message else None
+        key = (event.from_user.id, message_id, event.data)
+        last = self._last.get(key)
+        self._last[key] = now
+        if now >= self._next_sweep:
+            self._next_sweep = now + 60
+            stale = now - self.window
+            self._last = {k: ts for k, ts in self._last.items() if ts > stale}
+        if last is not None and now - last < self.window:
+            METRICS.inc("bot_callbacks_debounced_total")
+            try:
+                await event.answer()
+            except Exception as e:
+                logger.warning(f"Не удалось ответить на повторный callback (user {event.from_user.id}): {e}")
+            return None
         return await handler(event, data)
 
+class StorageReadyMiddleware(BaseMiddleware):
+    """
+    При быстром старте polling начинается до подключения к таблице. Обработчики, которым хватает
+    каталога и индекса клиентов из снимка на диске (CATALOG_ONLY_HANDLERS), выполняются сразу;
+    остальные ждут открытия хранилища (STORAGE_READY), но не дольше timeout — дальше работают как без него.
+    """
+    CATALOG_ONLY_HANDLERS = frozenset({
+        "open_menu", "category_handler", "offers_page_handler", "back_to_categories_handler",
+        "show_my_offers_menu", "my_offer_info_handler", "cancel_pending_cb", "inline_search_handler",
+    })
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+
+    async def __call__(self, handler, event, data):
+        if not STORAGE_READY.is_set():
+            handler_obj = data.get("handler")
+            handler_name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+            if handler_name not in self.CATALOG_ONLY_HANDLERS:
+                try:
+                    await asyncio.wait_for(STORAGE_READY.wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    METRICS.inc("bot_storage_wait_timeouts_total", handler=handler_name)
+                    logger.warning(f"Хранилище не открылось за {self.timeout} c — {handler_name} выполняется без него")
+        return await handler(event, data)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Считает запросы к Bot API, их время и ошибки"""
+    async def __call__(self, make_request, bot_, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot_, method)
+        except Exception as e:
+            METRICS.inc("bot_telegram_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            METRICS.inc("bot_telegram_requests_total", method=name)
+            METRICS.observe("bot_telegram_request_duration_seconds", elapsed, method=name)
+            trace_span("telegram", name, start, elapsed)
+
+def setup_bot_session(bot_: Bot) -> Bot:
+    """Подключает request-middleware к сессии бота (для каждого созданного экземпляра Bot)"""
+    # очередь — снаружи: метрики и трасса считают сам запрос, ожидание в очереди пишется отдельно
+    bot_.session.middleware(TELEGRAM_OUTBOX)
+    bot_.session.middleware(TelegramMetricsMiddleware())
+    return bot_
+
 async def run_in_executor(fn, *args, **kwargs):
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(None, lambda: fn(*args, **kwargs))
 
+class TokenBucket:
+    """
+    Token bucket с приоритетной очередью ожидающих: токен получает самый приоритетный (меньший priority),
+    при равном приоритете — пришедший раньше.
+    """
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters: list = []          # heap (priority, seq, future)
+        self._seq = itertools.count()
+        self._pump_task: asyncio.Task | None = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = 0, holder=None):
+        """holder (если задан) на время ожидания получает .waiting = (bucket, future) — см. promote"""
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        if holder is None:
+            await fut
+            return
+        holder.waiting = (self, fut)
+        try:
+            await fut
+        finally:
+            holder.waiting = None
+
+    def promote(self, fut, priority: int):
+        """Поднимает приоритет ожидающего (к нему присоединился более срочный запрос)"""
+        for i, (prio, seq, waiter) in enumerate(self._waiters):
+            if waiter is fut:
+                if priority < prio:
+                    self._waiters[i] = (priority, seq, waiter)
+                    heapq.heapify(self._waiters)
+                return
+
+    async def _pump(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                _, _, fut = heapq.heappop(self._waiters)
+                if fut.done():
+                    continue
+                self.tokens -= 1
+                fut.set_result(None)
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self, delay: float):
+        """Google ответил 429 — притормаживаем всех, а не только повторяемый запрос"""
+        self.tokens = 0
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+    def depth(self) -> int:
+        return len(self._waiters)
+
+# приоритет исходящих запросов к Telegram для текущей задачи (например, рассылка ставит TG_PRIO_BULK)
+TG_PRIORITY: contextvars.ContextVar = contextvars.ContextVar("tg_priority", default=None)
+
+class _PendingEdit:
+    __slots__ = ("method", "future")
+
+    def __init__(self, method, future):
+        self.method = method
+        self.future = future
+
+class TelegramOutbox(BaseRequestMiddleware):
+    """
+    Очередь исходящих запросов к Bot API (request-middleware сессии бота):
+    - общий token bucket бота и свой на каждый чат (в группах — отдельный, поминутный лимит);
+    - при ожидании токена первыми идут ответы на кнопки, потом правки меню, потом сообщения и рассылки;
+    - правки того же сообщения, ещё стоящие в очереди, схлопываются: уходит только последняя,
+      все вызвавшие получают её результат;
+    - на flood wait (retry_after) притормаживаем чат и повторяем запрос.
+    Служебные методы (getUpdates, setWebhook, ...) проходят без очереди.
+    """
+    ANSWER_METHODS = {"AnswerCallbackQuery", "AnswerInlineQuery"}
+    EDIT_METHODS = {"EditMessageText", "EditMessageReplyMarkup", "EditMessageCaption", "EditMessageMedia"}
+    SEND_PREFIXES = ("Send", "Edit", "Copy", "Forward", "Delete")
+
+    def __init__(self, global_per_sec: float, chat_per_sec: float, chat_burst: float, group_per_min: float,
+                 max_retries: int, max_retry_after: float):
+        self.global_bucket = TokenBucket(global_per_sec, max(1, global_per_sec))
+        self.chat_per_sec = chat_per_sec
+        self.chat_burst = chat_burst
+        self.group_per_min = group_per_min
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._chats: dict = {}                    # chat_id -> TokenBucket
+        self._edits: dict[tuple, _PendingEdit] = {}
+        self._next_sweep = 0.0
+        self.collapsed = 0
+        self.flood_waits = 0
+
+    def scale(self, factor: float):
+        """Общий лимит бота делится между процессами-воркерами (чат всегда обслуживает один воркер)"""
+        bucket = self.global_bucket
+        bucket.rate *= factor
+        bucket.capacity = max(1, bucket.capacity * factor)
+        bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_per_min / 60, max(1, self.group_per_min / 6))
+            else:
+                bucket = TokenBucket(self.chat_per_sec, self.chat_burst)
+            self._chats[chat_id] = bucket
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            # забываем чаты, которые давно молчат (их bucket полон и никто не ждёт)
+            self._next_sweep = now + 60
+            for cid, b in list(self._chats.items()):
+                if b is not bucket and not b.depth():
+                    b._refill()
+                    if b.tokens >= b.capacity:
+                        del self._chats[cid]
+        return bucket
+
+    def _priority(self, name: str) -> int:
+        override = TG_PRIORITY.get()
+        if override is not None:
+            return override
+        if name in self.ANSWER_METHODS:
+            return TG_PRIO_ANSWER
+        if name in self.EDIT_METHODS:
+            return TG_PRIO_EDIT
+        return TG_PRIO_SEND
+
+    def depth(self) -> int:
+        return self.global_bucket.depth() + sum(b.depth() for b in self._chats.values())
+
+    async def __call__(self, make_request, bot_, method):
+        name = type(method).__name__
+        if name not in self.ANSWER_METHODS and not name.startswith(self.SEND_PREFIXES):
+            return await make_request(bot_, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        message_id = getattr(method, "message_id", None)
+        if name in self.EDIT_METHODS and chat_id is not None and message_id is not None:
+            key = (name, chat_id, message_id)
+            pending = self._edits.get(key)
+            if pending is not None:
+                # предыдущая правка ещё ждёт очереди — заменяем её содержимое на актуальное
+                pending.method = method
+                self.collapsed += 1
+                METRICS.inc("bot_telegram_edits_collapsed_total")
+                return await asyncio.shield(pending.future)
+            pending = self._edits[key] = _PendingEdit(method, asyncio.get_running_loop().create_future())
+            try:
+                result = await self._send(make_request, bot_, name, chat_id, pending, key)
+            except BaseException as e:
+                if not pending.future.done():
+                    pending.future.set_exception(e if isinstance(e, Exception) else RuntimeError("запрос отменён"))
+                    pending.future.exception()
+                raise
+            finally:
+                if self._edits.get(key) is pending:
+                    del self._edits[key]
+            pending.future.set_result(result)
+            return result
+
+        return await self._send(make_request, bot_, name, chat_id, _PendingEdit(method, None), None)
+
+    async def _send(self, make_request, bot_, name: str, chat_id, pending: _PendingEdit, edit_key):
+        priority = self._priority(name)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            if chat_id is not None and name not in self.ANSWER_METHODS:
+                await self._chat_bucket(chat_id).acquire(priority)
+            await self.global_bucket.acquire(priority)
+            trace_span("telegram_queue", name, start, time.perf_counter() - start)
+            if edit_key is not None and self._edits.get(edit_key) is pending:
+                # с этого момента правка уходит — следующие правки встают в очередь заново
+                del self._edits[edit_key]
+            try:
+                return await make_request(bot_, pending.method)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                METRICS.inc("bot_telegram_flood_waits_total", method=name)
+                if attempt >= self.max_retries or e.retry_after > self.max_retry_after:
+                    raise
+                attempt += 1
+                logger.warning(f"Telegram flood wait {e.retry_after} c ({name}, чат {chat_id}), повтор {attempt}/{self.max_retries}")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).throttle(e.retry_after)
+                else:
+                    self.global_bucket.throttle(e.retry_after)
+
+TELEGRAM_OUTBOX = TelegramOutbox(TG_GLOBAL_PER_SEC, TG_CHAT_PER_SEC, TG_CHAT_BURST, TG_GROUP_PER_MIN,
+                                 TG_MAX_RETRIES, TG_MAX_RETRY_AFTER_SEC)
+
+def _sheets_error_status(e: Exception):
+    """HTTP-статус из ошибки gspread (или None)"""
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None) or getattr(e, "code", None)
+
+def _sheets_error_permanent(e: Exception) -> bool:
+    """Google отклонил сам запрос (4xx, кроме 429): он ничего не изменил, и повтор того же не поможет"""
+    status = _sheets_error_status(e)
+    return status is not None and 400 <= status < 500 and status not in SheetsScheduler.RETRYABLE_STATUSES
+
+class SheetsScheduler:
+    """
+    Все запросы к Google Sheets идут через этот планировщик:
+    - свой ограниченный пул потоков для gspread (не занимаем default executor),
+      асинхронные методы (AsyncWorksheet) выполняются прямо в event loop;
+    - отдельные token bucket для чтений и записей под поминутные квоты Google;
+    - приоритеты (пользовательские запросы раньше фоновых и логов);
+    - повтор при 429/5xx с экспоненциальной задержкой и джиттером. 5xx повторяем только для идемпотентных
+      запросов (retry_5xx=False — для append_rows: запрос мог дойти до таблицы, и повтор задвоил бы строки;
+      такой сбой вызывающий код разбирает сам). 429 — отказ до выполнения, его повторять можно всегда.
+    """
+    RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_workers: int, reads_per_min: int, writes_per_min: int,
+                 max_retries: int, backoff_base: float, backoff_max: float):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        # ёмкость ведра — квота за 10 секунд, чтобы короткий всплеск проходил без ожидания
+        self.buckets = {
+            "read": TokenBucket(reads_per_min / 60, max(1, reads_per_min / 6)),
+            "write": TokenBucket(writes_per_min / 60, max(1, writes_per_min / 6)),
+        }
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.in_flight = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+
+    async def call(self, fn, *args, op: str = "read", priority: int = PRIO_USER, flight=None,
+                   retry_5xx: bool = True, **kwargs):
+        """flight — общий запрос ReadCoalescer: его приоритет может вырасти, пока мы ждём квоту"""
+        method = getattr(fn, "__name__", "call")
+        start = time.perf_counter()
+        wait = [0.0]
+        try:
+            return await self._call(fn, args, kwargs, op, priority, wait, flight, retry_5xx)
+        finally:
+            elapsed = time.perf_counter() - start
+            # одно наблюдение на вызов вместе со всеми повторами, не на каждую попытку
+            METRICS.observe("bot_sheets_request_duration_seconds", elapsed, op=op, method=method)
+            trace_span("sheets", f"{op}:{method}", start, elapsed, wait[0])
+
+    async def _call(self, fn, args, kwargs, op: str, priority: int, wait: list, flight=None, retry_5xx: bool = True):
+        bucket = self.buckets[op]
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            acquire_start = time.perf_counter()
+            if flight is not None:
+                priority = flight.priority
+            await bucket.acquire(priority, flight)
+            wait[0] += time.perf_counter() - acquire_start
+            self.in_flight += 1
+            try:
+                if asyncio.iscoroutinefunction(fn):
+                    # асинхронный клиент (AsyncSheetsClient) — поток не нужен
+                    return await fn(*args, **kwargs)
+                return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+            except Exception as e:
+                status = _sheets_error_status(e)
+                METRICS.inc("bot_sheets_errors_total", op=op, status=status or "error")
+                retryable = status == 429 or (retry_5xx and status in self.RETRYABLE_STATUSES)
+                if not retryable or attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                METRICS.inc("bot_sheets_retries_total", op=op)
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if status == 429:
+                    self.throttled += 1
+                    METRICS.inc("bot_sheets_throttled_total", op=op)
+                    bucket.throttle(delay)
+                logger.warning(f"Sheets {op} вернул {status}, повтор {attempt}/{self.max_retries} через {delay:.1f} c")
+            finally:
+                self.in_flight -= 1
+            # пауза перед повтором — уже без занятого слота in_flight
+            await asyncio.sleep(delay)
+
+    def scale_quota(self, factor: float):
+        """Делит квоту (например, между процессами-воркерами, у которых общий лимит Google)"""
+        for bucket in self.buckets.values():
+            bucket.rate *= factor
+            bucket.capacity = max(1, bucket.capacity * factor)
+            bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+    def queue_depth(self) -> dict:
+        return {
+            "read": self.buckets["read"].depth(),
+            "write": self.buckets["write"].depth(),
+            "in_flight": self.in_flight,
+        }
+
+SHEETS = SheetsScheduler(
+    SHEETS_MAX_WORKERS, SHEETS_READS_PER_MIN, SHEETS_WRITES_PER_MIN,
+    SHEETS_MAX_RETRIES, SHEETS_BACKOFF_BASE_SEC, SHEETS_BACKOFF_MAX_SEC
+)
+
+async def sheets_call(fn, *args, op: str = "read", priority: int = PRIO_USER, flight=None,
+                      retry_5xx: bool = True, **kwargs):
+    """Вызов метода gspread через SHEETS (квоты, приоритеты, повторы при 429; при 5xx — если retry_5xx)"""
+    if op == "write":
+        # после записи закэшированные чтения могут быть устаревшими
+        READ_FLIGHTS.invalidate()
+    return await SHEETS.call(fn, *args, op=op, priority=priority, flight=flight, retry_5xx=retry_5xx, **kwargs)
+
+def _freeze(value):
+    """Делает аргументы пригодными для ключа словаря (списки диапазонов -> кортежи)"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+def _copy_result(value):
+    """Каждый ожидающий получает свою копию: вызывающие код правят списки на месте (_pad_row)"""
+    if isinstance(value, list):
+        return [_copy_result(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _copy_result(v) for k, v in value.items()}
+    return value
+
+class _ReadFlight:
+    """Выполняющееся чтение: результат, текущий приоритет и место в очереди квоты (bucket, future)"""
+    __slots__ = ("future", "priority", "waiting")
+
+    def __init__(self, future, priority: int):
+        self.future = future
+        self.priority = priority
+        self.waiting = None
+
+    def raise_priority(self, priority: int) -> bool:
+        if priority >= self.priority:
+            return False
+        self.priority = priority
+        if self.waiting is not None:
+            bucket, fut = self.waiting
+            bucket.promote(fut, priority)
+        return True
+
+class ReadCoalescer:
+    """
+    Single-flight для чтений Sheets: пока запрос (метод + аргументы) выполняется,
+    такие же запросы не уходят в Google, а ждут его результат.
+    Присоединившийся более срочный запрос поднимает приоритет общего (фоновое чтение не задержит пользователя).
+    Опционально результат переиспользуется fresh_sec секунд; любая запись через sheets_call сбрасывает кэш.
+    """
+    def __init__(self, fresh_sec: float):
+        self.fresh_sec = fresh_sec
+        self._inflight: dict[tuple, _ReadFlight] = {}
+        self._fresh: dict[tuple, tuple[float, object]] = {}
+        self._generation = 0
+
+    def invalidate(self):
+        self._fresh.clear()
+        # результаты запросов, начатых до записи, в кэш уже не попадут, и новые чтения к ним не присоединяются
+        self._generation += 1
+        self._inflight.clear()
+
+    async def read(self, fn, *args, priority: int = PRIO_USER, fresh_sec: float | None = None, **kwargs):
+        fresh_sec = self.fresh_sec if fresh_sec is None else fresh_sec
+        method = getattr(fn, "__name__", "call")
+        key = (fn, _freeze(args), _freeze(kwargs))
+        now = time.monotonic()
+        if fresh_sec > 0:
+            hit = self._fresh.get(key)
+            if hit is not None and now - hit[0] <= fresh_sec:
+                METRICS.inc("bot_sheets_read_cache_hits_total", method=method)
+                return _copy_result(hit[1])
+
+        flight = self._inflight.get(key)
+        if flight is not None:
+            METRICS.inc("bot_sheets_reads_coalesced_total", method=method)
+            if flight.raise_priority(priority):
+                METRICS.inc("bot_sheets_reads_promoted_total", method=method)
+            start = time.perf_counter()
+            try:
+                return _copy_result(await asyncio.shield(flight.future))
+            finally:
+                trace_span("sheets", f"coalesced:{method}", start, time.perf_counter() - start)
+
+        fut = asyncio.get_running_loop().create_future()
+        flight = self._inflight[key] = _ReadFlight(fut, priority)
+        generation = self._generation
+        try:
+            result = await sheets_call(fn, *args, op="read", priority=priority, flight=flight, **kwargs)
+        except BaseException as e:
+            # отмена ведущего не должна отменять остальных — они получат ошибку и повторят сами
+            fut.set_exception(e if isinstance(e, Exception) else RuntimeError("чтение Sheets отменено"))
+            fut.exception()   # чтобы asyncio не ругался на неполученное исключение
+            raise
+        else:
+            fut.set_result(result)
+            if fresh_sec > 0 and generation == self._generation:
+                self._fresh[key] = (now, result)
+            return _copy_result(result)
+        finally:
+            if self._inflight.get(key) is flight:
+                self._inflight.pop(key)
+
+READ_FLIGHTS = ReadCoalescer(SHEETS_READ_FRESH_SEC)
+
+async def sheets_read(fn, *args, priority: int = PRIO_USER, fresh_sec: float | None = None, **kwargs):
+    """Чтение через SHEETS с объединением одинаковых одновременных запросов (см. ReadCoalescer)"""
+    return await READ_FLIGHTS.read(fn, *args, priority=priority, fresh_sec=fresh_sec, **kwargs)
+
+class ClientRowIndex:
+    """
+    Резидентный индекс user_id -> номер строки в листе 'Клиенты - Партнерки'.
+    Строится один раз при старте (одна загрузка колонки B), дальше поиск — O(1) без запросов в Google.
+    Фоном периодически пересинхронизируется, чтобы подхватить ручные правки операторов.
+    При быстром старте загружается из снимка на диске (from_disk) до первой сверки с таблицей.
+    Вместе со строкой помнит, заполнен ли у клиента телефон (колонка E): пока хранилище подключается,
+    регистрацию проверяем по этому признаку (см. is_registered).
+    """
+    def __init__(self):
+        self._rows: dict[str, int] = {}
+        self._phones: set[str] = set()   # user_id с телефоном
+        self.last_row = 0      # последняя занятая строка по колонке B
+        self.ready = False
+        self.from_disk = False   # индекс из снимка: клиентов, добавленных после него, в нём нет
+        self._sync_lock = asyncio.Lock()
+
+    async def rebuild(self):
+        """Полная пересборка индекса по колонке B"""
+        if not sheet_clients:
+            return False
+        try:
+            col_vals, phone_vals = await asyncio.gather(
+                sheets_read(sheet_clients.col_values, IDX_USER_ID, priority=PRIO_BACKGROUND),
+                sheets_read(sheet_clients.col_values, IDX_PHONE, priority=PRIO_BACKGROUND),
+            )
+            rows = {}
+            phones = set()
+            for i, v in enumerate(col_vals, start=1):
+                # как и раньше — берём первое совпадение
+                if v and v not in rows:
+                    rows[v] = i
+                    if i <= len(phone_vals) and phone_vals[i - 1].strip():
+                        phones.add(v)
+            last_row = len(col_vals)
+            # строки, дописанные ботом пока шла загрузка колонки, не теряем
+            for uid, r in self._rows.items():
+                if r > last_row and uid not in rows:
+                    rows[uid] = r
+                    last_row = max(last_row, r)
+                    if uid in self._phones:
+                        phones.add(uid)
+            # как и телефоны, которые ещё только пишутся в таблицу
+            for uid in self._phones - phones:
+                r = rows.get(uid)
+                pending = CLIENT_ROWS.overlay(r, []) if r else []
+                if len(pending) >= IDX_PHONE and pending[IDX_PHONE - 1].strip():
+                    phones.add(uid)
+            changed = self.from_disk or last_row != self.last_row or rows != self._rows or phones != self._phones
+            # подменяем целиком, чтобы параллельные обработчики не видели полупустой индекс
+            self._rows = rows
+            self._phones = phones
+            self.last_row = last_row
+            self.ready = True
+            self.from_disk = False
+            if changed:
+                logger.info(f"Индекс клиентов построен: {len(rows)} записей, последняя строка {self.last_row}")
+                WARM_START.request_save()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка построения индекса клиентов: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def ensure_synced(self):
+        """Индекс из снимка сверяется с таблицей (один раз) — перед выдачей номеров по last_row"""
+        if not self.from_disk:
+            return
+        async with self._sync_lock:
+            if self.from_disk:
+                await self.rebuild()
+
+    def load_snapshot(self, user_ids: list, rows, last_row: int, phones: bytes):
+        """Индекс из снимка быстрого старта (до сверки с таблицей); phones — по байту на user_id: 1, если есть телефон"""
+        self._rows = dict(zip(user_ids, rows))
+        self._phones = {uid for uid, flag in zip(user_ids, phones) if flag}
+        self.last_row = max(last_row, self.last_row)
+        self.ready = True
+        self.from_disk = True
+
+    def snapshot(self) -> tuple[list, list, int, bytes]:
+        """(user_id, строки, last_row, признаки телефона) для снимка быстрого старта"""
+        user_ids = list(self._rows)
+        return user_ids, list(self._rows.values()), self.last_row, bytes(uid in self._phones for uid in user_ids)
+
+    def get(self, user_id: str):
+        return self._rows.get(user_id)
+
+    def has_phone(self, user_id: str) -> bool:
+        return user_id in self._phones
+
+    def set(self, user_id: str, row_index: int, phone: bool = False):
+        if self._rows.get(user_id) == row_index and (not phone or user_id in self._phones):
+            return
+        self._rows[user_id] = row_index
+        if phone:
+            self._phones.add(user_id)
+        if row_index > self.last_row:
+            self.last_row = row_index
+        WARM_START.request_save()
+
+    def set_phone(self, user_id: str):
+        if user_id in self._phones:
+            return
+        self._phones.add(user_id)
+        WARM_START.request_save()
+
+    def rows_after(self, row_index: int) -> list[tuple[int, str]]:
+        """(строка, user_id) для строк после row_index, по возрастанию — порядок, по которому можно продолжить обход"""
+        return sorted((r, uid) for uid, r in self._rows.items() if r > row_index)
+
+    def __len__(self):
+        return len(self._rows)
+
+    async def resync_loop(self, interval: int = CLIENT_INDEX_RESYNC_SEC):
+        """Фоновая пересинхронизация индекса"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.rebuild()
+
+CLIENT_ROW_INDEX = ClientRowIndex()
+
+class WriteJournal:
+    """
+    Журнал изменений (write-ahead) в локальном файле, строка JSON на запись с порядковым номером seq:
+    ячейка клиента (cell), новая строка клиента (register), строка лога (log), отложенная пометка оффера (take).
+    Запись сначала попадает сюда и только потом — в Google через CLIENT_ROWS / CLIENT_REGISTRAR / LOG_WRITER;
+    после успешной записи в таблицу слой подтверждает seq строкой {"ack": [...]}.
+    Строка сразу отдаётся ОС (переживает падение процесса), fsync — пачкой раз в fsync_interval.
+    Когда файл разрастается больше compact_bytes, он сжимается фоном: подтверждённые записи отбрасываются
+    в потоке executor'а, event loop только дописывает хвост, появившийся за это время, и подменяет файл.
+    При старте, до первого обработчика, неподтверждённые записи применяются заново по порядку seq (restore):
+    ячейки ложатся в CLIENT_ROWS, и обработчики читают строки клиентов уже поверх них. Повторы отсекаются:
+    ячейки идемпотентны, строку клиента не добавляем, если user_id уже в индексе, логи сверяются с хвостом листа.
+    """
+    def __init__(self, path: str, fsync_interval: float, compact_bytes: int, replay_interval: float):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.replay_interval = replay_interval
+        self._file = None
+        self._seq = 0
+        self._size = 0
+        self._unacked: set[int] = set()
+        self._recovered: list[dict] = []   # неподтверждённые записи прошлых запусков — ждут restore()
+        self._deferred: list[dict] = []    # take, которые пока не применить (нет строки или таблица недоступна)
+        self._sync_task: asyncio.Task | None = None
+        self._compact_task: asyncio.Task | None = None
+        self._replay_lock = asyncio.Lock()
+
+    @staticmethod
+    def _dumps(rec: dict) -> bytes:
+        """Строка журнала (с переводом строки); файл открыт в двоичном режиме — tell() точный"""
+        return (json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+    def _read(self, path: str, limit: int | None = None) -> tuple[dict, set]:
+        """Записи и подтверждённые seq из файла (limit — только первые limit байт)"""
+        entries, acked = {}, set()
+        if not os.path.exists(path):
+            return entries, acked
+        with open(path, "rb") as f:
+            pos = 0
+            for line in f:
+                pos += len(line)
+                if limit is not None and pos > limit:
+                    break
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # недописанная строка (падение посреди записи) — подтверждена она быть не могла
+                    logger.warning(f"Журнал: пропущена повреждённая строка {line[:80]!r}")
+                    continue
+                if "ack" in rec:
+                    acked.update(rec["ack"])
+                else:
+                    entries[rec["seq"]] = rec
+        return entries, acked
+
+    def _rewrite(self, entries: list):
+        """Переписывает файл журнала одними entries (атомарно) и открывает его на дозапись"""
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            for rec in entries:
+                f.write(self._dumps(rec))
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+
+    def open(self, path: str | None = None) -> int:
+        """Открывает журнал; неподтверждённые записи прошлых запусков ждут restore(). Возвращает их число"""
+        self.path = path if path is not None else self.path
+        if not self.path:
+            return 0
+        entries, acked = self._read(self.path)
+        self._recovered = [entries[seq] for seq in sorted(entries) if seq not in acked]
+        self._unacked = {rec["seq"] for rec in self._recovered}
+        self._seq = max(entries, default=0)
+        self._rewrite(self._recovered)
+        if self._recovered:
+            logger.info(f"Журнал: {len(self._recovered)} неподтверждённых записей с прошлого запуска")
+        return len(self._recovered)
+
+    def append(self, op: str, **fields) -> int | None:
+        """Дописывает изменение в журнал; seq — для подтверждения после записи в Google (None — журнал выключен)"""
+        if self._file is None:
+            return None
+        self._seq += 1
+        self._write({"seq": self._seq, "op": op, **fields})
+        self._unacked.add(self._seq)
+        return self._seq
+
+    def ack(self, seqs):
+        """Записи seqs дошли до Google"""
+        if self._file is None:
+            return
+        seqs = [seq for seq in seqs if seq in self._unacked]
+        if not seqs:
+            return
+        self._unacked.difference_update(seqs)
+        self._write({"ack": seqs})
+        if self._size > self.compact_bytes and (self._compact_task is None or self._compact_task.done()):
+            self._compact_task = asyncio.create_task(self._compact(), context=contextvars.Context())
+
+    def _write(self, rec: dict):
+        line = self._dumps(rec)
+        self._file.write(line)
+        self._file.flush()
+        self._size += len(line)
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync_later(), context=contextvars.Context())
+
+    async def _sync_later(self):
+        await asyncio.sleep(self.fsync_interval)
+        f = self._file
+        if f is None:
+            return
+        try:
+            await run_in_executor(os.fsync, f.fileno())
+        except (OSError, ValueError) as e:
+            # файл успели переоткрыть при сжатии — новый уже записан с fsync
+            logger.warning(f"Журнал: fsync не выполнен: {e}")
+
+    async def _compact(self):
+        """
+        Оставляет в файле только неподтверждённые записи (редко: раз в compact_bytes записанного).
+        Первые limit байт (всё записанное к началу сжатия) фильтруются в executor'е; то, что дописали
+        за это время, копируется в новый файл как есть — там и новые записи, и подтверждения.
+        """
+        f = self._file
+        if f is None:
+            return
+        started = time.perf_counter()
+        limit = f.tell()
+        keep = set(self._unacked)
+        tmp = f"{self.path}.tmp"
+
+        def write_head():
+            # построчно, без разбора всего файла в память: большой граф объектов в потоке
+            # включает полную сборку мусора, а она держит GIL и останавливает event loop
+            with open(self.path, "rb") as src, open(tmp, "wb") as out:
+                pos = 0
+                for line in src:
+                    pos += len(line)
+                    if pos > limit:
+                        break
+                    if line.startswith(b'{"seq":'):
+                        seq = int(line[7:line.index(b",")])
+                    else:
+                        try:
+                            seq = json.loads(line).get("seq")
+                        except ValueError:
+                            continue
+                    if seq in keep:
+                        out.write(line)
+                out.flush()
+                os.fsync(out.fileno())
+
+        try:
+            await run_in_executor(write_head)
+            if self._file is not f:
+                # журнал закрыли, пока шло сжатие
+                os.remove(tmp)
+                return
+            with open(self.path, "rb") as src, open(tmp, "ab") as out:
+                src.seek(limit)
+                out.write(src.read())
+            f.close()
+            os.replace(tmp, self.path)
+            self._file = open(self.path, "ab")
+            self._size = self._file.tell()
+        except Exception as e:
+            logger.error(f"Журнал: ошибка сжатия: {e}")
+            logger.error(traceback.format_exc())
+            return
+        # скопированный хвост ещё не на диске — как обычная запись, fsync пачкой
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync_later(), context=contextvars.Context())
+        logger.info(f"Журнал сжат: {limit} -> {self._size} байт за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+    async def load(self, seqs) -> list[dict]:
+        """Неподтверждённые записи seqs из файла (для строк, вытесненных из памяти), по порядку seq"""
+        wanted = set(seqs) & self._unacked
+        if not wanted or self._file is None:
+            return []
+        entries, _ = await run_in_executor(self._read, self.path)
+        return [entries[seq] for seq in sorted(wanted) if seq in entries]
+
+    def pending(self) -> int:
+        return len(self._unacked)
+
+    def deferred(self) -> int:
+        return len(self._deferred)
+
+    def defer_take(self, row_index: int | None, user_id: str | None, offer_id: str):
+        """Пометку оффера пока не применить (нет строки / таблица недоступна) — журнал и повтор в replay()"""
+        rec = {"op": "take", "r": row_index, "u": user_id, "o": str(offer_id)}
+        rec["seq"] = self.append("take", r=row_index, u=user_id, o=str(offer_id))
+        self._deferred.append(rec)
+
+    def restore(self):
+        """
+        Применяет записи прошлых запусков по порядку — при старте, до первого обработчика (таблица не нужна):
+        ячейки — в CLIENT_ROWS, строки клиентов — в очередь CLIENT_REGISTRAR, пометки офферов — в отложенные,
+        логи — в LOG_WRITER (сверка с хвостом листа — перед их отправкой).
+        """
+        entries, self._recovered = self._recovered, []
+        if not entries:
+            return
+        # от строки клиента, менявшейся в очереди, нужна только последняя версия
+        last_register = {rec["u"]: rec["seq"] for rec in entries if rec["op"] == "register"}
+        logs = []
+        for rec in entries:
+            op = rec["op"]
+            if op == "cell":
+                CLIENT_ROWS.set_cell(rec["r"], rec["c"], rec["v"], seq=rec["seq"], user_id=rec.get("u"))
+            elif op == "register":
+                if last_register[rec["u"]] == rec["seq"]:
+                    CLIENT_REGISTRAR.restore(rec["u"], rec["row"], rec["seq"])
+                else:
+                    self.ack([rec["seq"]])
+            elif op == "take":
+                self._deferred.append(rec)
+            elif op == "log":
+                logs.append((rec["seq"], rec["row"]))
+        LOG_WRITER.put_recovered(logs)
+        logger.info(f"Журнал: восстановлено {len(entries)} записей")
+
+    async def replay(self):
+        """Отложенные пометки офферов — по порядку, до первой неудачи; вытесненные строки логов — обратно в очередь"""
+        async with self._replay_lock:
+            while self._deferred:
+                rec = self._deferred[0]
+                row_index = rec.get("r") or (CLIENT_ROW_INDEX.get(rec["u"]) if rec.get("u") else None)
+                # без каталога колонка чекбокса оффера неизвестна (хранилище подключилось, каталог ещё грузится)
+                if not row_index or not CATALOG.offers_by_id:
+                    break
+                if not await mark_offer_taken_for_user(row_index, rec["o"], defer=False):
+                    break
+                self._deferred.pop(0)
+                if rec["seq"] is not None:
+                    self.ack([rec["seq"]])
+            await LOG_WRITER.respool()
+
+    async def replay_loop(self):
+        while True:
+            await asyncio.sleep(self.replay_interval)
+            try:
+                await self.replay()
+            except Exception as e:
+                logger.error(f"Ошибка повтора записей журнала: {e}")
+                logger.error(traceback.format_exc())
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+JOURNAL = WriteJournal(JOURNAL_PATH, JOURNAL_FSYNC_SEC, JOURNAL_COMPACT_BYTES, JOURNAL_REPLAY_SEC)
+
+def _journal_record_user(rec: dict) -> str | None:
+    """Клиент, к которому относится запись журнала (None — не указан: записи старого формата)"""
+    if rec["op"] == "log":
+        return rec["row"][1] if len(rec["row"]) > 1 else None
+    return rec.get("u") or None
+
+def consolidate_journals(base: str, n_workers: int) -> int:
+    """
+    До запуска процессов: неподтверждённые записи всех файлов журнала (base — один процесс, base.N — воркеры)
+    переносятся в файлы процессов, которые теперь обслуживают их клиентов (число воркеров могло измениться).
+    Записи без клиента остаются в своём файле, если он ещё чей-то, иначе уходят воркеру 0.
+    Сначала записи дописываются новым владельцам, потом убираются у старых: падение посередине
+    даёт повтор записи, но не потерю. Возвращает число перенесённых записей.
+    """
+    if not base:
+        return 0
+    sharded = n_workers > 1
+    targets = [f"{base}.{i}" for i in range(n_workers)] if sharded else [base]
+    directory, prefix = os.path.dirname(base), os.path.basename(base) + "."
+    sources = [base] if os.path.exists(base) else []
+    sources += sorted(
+        (os.path.join(directory, name) for name in os.listdir(directory or ".")
+         if name.startswith(prefix) and name[len(prefix):].isdigit()),
+        key=lambda path: int(path.rsplit(".", 1)[1])
+    )
+    incoming = {path: [] for path in targets}
+    leaving: dict[str, set] = {}
+    for path in sources:
+        entries, acked = JOURNAL._read(path)
+        for seq in sorted(entries):
+            if seq in acked:
+                continue
+            rec = entries[seq]
+            user_id = _journal_record_user(rec)
+            if user_id is not None:
+                dest = targets[shard_of(user_id, n_workers) if sharded else 0]
+            else:
+                dest = path if path in incoming else targets[0]
+            if dest != path:
+                incoming[dest].append(rec)
+                leaving.setdefault(path, set()).add(seq)
+    moved = sum(len(recs) for recs in incoming.values())
+    if not moved:
+        return 0
+    # 1) дописываем новым владельцам (со своими seq — после уже занятых в файле)
+    for path, recs in incoming.items():
+        if not recs:
+            continue
+        entries, _ = JOURNAL._read(path)
+        seq = max(entries, default=0)
+        with open(path, "ab") as f:
+            for rec in recs:
+                seq += 1
+                f.write(WriteJournal._dumps({**rec, "seq": seq}))
+            f.flush()
+            os.fsync(f.fileno())
+    # 2) убираем у прежних: файл без владельца — целиком, остальные — переписываем без ушедших записей
+    for path, seqs in leaving.items():
+        if path not in incoming:
+            os.remove(path)
+            continue
+        entries, acked = JOURNAL._read(path)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            for seq in sorted(entries):
+                if seq not in acked and seq not in seqs:
+                    f.write(WriteJournal._dumps(entries[seq]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    # файлы без записей, которые больше ничьи, не нужны
+    for path in sources:
+        if path not in incoming and path not in leaving and os.path.exists(path):
+            os.remove(path)
+    logger.info(f"Журнал: перенесено {moved} записей между файлами (воркеров: {n_workers})")
+    return moved
+
+class ClientRowCache:
+    """
+    Write-behind кэш строк листа 'Клиенты - Партнерки'.
+    Хранит значения строки и отдельно — изменённые ботом ячейки (dirty).
+    Раз в flush_interval все изменённые ячейки всех пользователей уходят одним batch_update,
+    причём пишутся только сами изменённые ячейки — правки операторов в остальных ячейках не затираются.
+    Строки старше ttl без несохранённых изменений вытесняются, чтобы кэш не рос со всеми, кто когда-либо писал боту.
+    Ячейки, которые сейчас отправляются (_in_flight), накладываются на прочитанные строки до ответа Google,
+    а записанные во время чтения (_written) — на результат этого чтения: чтение, совпавшее с записью,
+    может вернуть из таблицы ещё старое значение.
+    Если Google отклонил пачку (4xx), она делится пополам, пока не найдутся ячейки, которые таблица не принимает:
+    они отбрасываются (в лог и метрику), остальные записываются. При прочих ошибках пачка ждёт следующего flush.
+    """
+    def __init__(self, flush_interval: float, ttl: float):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._rows: dict[int, list[str]] = {}          # row_index -> значения (A..)
+        self._fetched_at: dict[int, float] = {}        # row_index -> monotonic время загрузки
+        self._dirty: dict[int, dict[int, str]] = {}    # row_index -> {col (1-based): value}
+        self._in_flight: dict[int, dict[int, str]] = {}   # то же для ячеек текущего batch_update
+        self._flushes = 0                              # номер последней подтверждённой записи
+        self._reads = 0                                # чтений строк из таблицы в полёте
+        self._written: dict[int, dict[int, tuple[int, str]]] = {}   # row_index -> {col: (№ записи, value)}
+        self._seqs: dict[tuple[int, int], list[int]] = {}   # (row_index, col) -> записи журнала (JOURNAL) ячейки
+        self.rejected = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def get_row(self, row_index: int) -> list[str]:
+        """Строка клиента (копия, длиной не меньше NUM_COLUMNS) с учётом ещё не записанных изменений"""
+        now = asyncio.get_running_loop().time()
+        cached = self._rows.get(row_index)
+        if cached is None or now - self._fetched_at.get(row_index, 0) > self.ttl:
+            row_vals, since = await self._fetch(sheet_clients.row_values, row_index)
+            row_vals = self.overlay(row_index, _pad_row(row_vals, max(NUM_COLUMNS, len(row_vals or []))), since)
+            self._rows[row_index] = row_vals
+            self._fetched_at[row_index] = now
+            self._settle()
+            cached = row_vals
+        return list(cached)
+
+    async def refresh_rows(self, row_indexes) -> int:
+        """Перечитывает сразу несколько строк одним batch_get (свои несохранённые изменения сохраняются)"""
+        row_indexes = sorted(set(row_indexes))
+        if not row_indexes or not sheet_clients:
+            return 0
+        last_col = rowcol_to_a1(1, max(NUM_COLUMNS, max(CLIENT_OFFER_COL_MAP.values(), default=0))).rstrip("0123456789")
+        ranges = [f"A{r}:{last_col}{r}" for r in row_indexes]
+        result, since = await self._fetch(sheet_clients.batch_get, ranges, priority=PRIO_BACKGROUND)
+        now = asyncio.get_running_loop().time()
+        for row_index, value_range in zip(row_indexes, result):
+            row_vals = list(value_range[0]) if value_range else []
+            row_vals = self.overlay(row_index, _pad_row(row_vals, max(NUM_COLUMNS, len(row_vals))), since)
+            self._rows[row_index] = row_vals
+            self._fetched_at[row_index] = now
+        self._settle()
+        return len(row_indexes)
+
+    async def _fetch(self, fn, *args, **kwargs):
+        """Чтение строк из таблицы: (результат, номер последней подтверждённой записи до начала чтения)"""
+        since = self._flushes
+        self._reads += 1
+        try:
+            return await sheets_read(fn, *args, **kwargs), since
+        finally:
+            self._reads -= 1
+
+    def _settle(self):
+        """Чтений в полёте нет — записанное во время них больше никому не понадобится"""
+        if not self._reads:
+            self._written.clear()
+
+    def overlay(self, row_index: int, row_vals: list, since: int | None = None) -> list:
+        """
+        Накладывает на прочитанную из таблицы строку свои ещё не записанные (и ещё не подтверждённые) изменения.
+        since — номер записи на момент начала чтения: записанное после него чтение могло не увидеть.
+        """
+        if since is not None:
+            for col, (flush_no, value) in self._written.get(row_index, {}).items():
+                if flush_no > since:
+                    row_vals = _ensure_len(row_vals, col)
+                    row_vals[col - 1] = value
+        for pending in (self._in_flight, self._dirty):
+            for col, value in pending.get(row_index, {}).items():
+                row_vals = _ensure_len(row_vals, col)
+                row_vals[col - 1] = value
+        return row_vals
+
+    def put_row(self, row_index: int, row_vals: list):
+        """Кладёт в кэш строку, которая уже записана в таблицу (например, только что добавленную)"""
+        self._rows[row_index] = _pad_row(row_vals, max(NUM_COLUMNS, len(row_vals)))
+        self._fetched_at[row_index] = asyncio.get_running_loop().time()
+
+    def set_cell(self, row_index: int, col: int, value: str, seq: int | None = None, user_id: str | None = None):
+        """
+        Меняет одну ячейку; в таблицу она уйдёт при ближайшем flush (только если значение изменилось).
+        Изменение сначала пишется в журнал (с user_id — чей это клиент, см. consolidate_journals);
+        seq — уже записанное в журнал (восстановление после рестарта).
+        """
+        if col == IDX_PHONE and value.strip() and user_id:
+            CLIENT_ROW_INDEX.set_phone(user_id)
+        row_vals = self._rows.get(row_index)
+        if row_vals is not None:
+            row_vals = _ensure_len(row_vals, col)
+            if row_vals[col - 1] == value and col not in self._dirty.get(row_index, {}):
+                if seq is not None:
+                    JOURNAL.ack([seq])
+                return
+            row_vals[col - 1] = value
+            self._rows[row_index] = row_vals
+        if seq is None:
+            seq = JOURNAL.append("cell", r=row_index, c=col, v=value, u=user_id)
+        if seq is not None:
+            self._seqs.setdefault((row_index, col), []).append(seq)
+        self._dirty.setdefault(row_index, {})[col] = value
+
+    def pending(self) -> int:
+        return sum(len(cells) for cells in self._dirty.values())
+
+    def evict(self) -> int:
+        """Убирает устаревшие строки (старше ttl) без изменённых ячеек — их всё равно пришлось бы перечитать"""
+        now = asyncio.get_running_loop().time()
+        stale = [r for r, ts in self._fetched_at.items()
+                 if now - ts > self.ttl and r not in self._dirty and r not in self._in_flight]
+        for row_index in stale:
+            self._rows.pop(row_index, None)
+            self._fetched_at.pop(row_index, None)
+        return len(stale)
+
+    def __len__(self):
+        return len(self._rows)
+
+    async def flush(self) -> bool:
+        """Отправляет все изменённые ячейки одним batch_update"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return True
+            if not sheet_clients:
+                # хранилище ещё подключается (_connect_storage повторяет попытки) — ячейки ждут в журнале
+                return False
+            dirty, self._dirty = self._dirty, {}
+            seqs, self._seqs = self._seqs, {}
+            # до ответа Google эти ячейки видны в overlay — иначе строка, прочитанная во время записи,
+            # закэшировалась бы со старыми значениями, и следующая правка (например, H) затёрла бы эту
+            self._in_flight = dirty
+            try:
+                rejected = await self._write([
+                    (row_index, col, value) for row_index, cells in dirty.items() for col, value in cells.items()
+                ])
+            except Exception as e:
+                logger.error(f"Ошибка записи изменений клиентов: {e}")
+                logger.error(traceback.format_exc())
+                # возвращаем обратно, но более свежие изменения (сделанные во время записи) важнее
+                for row_index, cells in dirty.items():
+                    newer = self._dirty.get(row_index, {})
+                    cells.update(newer)
+                    self._dirty[row_index] = cells
+                for key, cell_seqs in seqs.items():
+                    self._seqs[key] = cell_seqs + self._seqs.get(key, [])
+                return False
+            finally:
+                self._in_flight = {}
+            for row_index, col, value, e in rejected:
+                self._reject(row_index, col, value, e)
+                del dirty[row_index][col]
+            written = sum(len(cells) for cells in dirty.values())
+            logger.info(f"Клиенты: записано {written} ячеек в {sum(1 for cells in dirty.values() if cells)} строках")
+            # отклонённые ячейки тоже подтверждаем — иначе журнал повторял бы их после каждого рестарта
+            JOURNAL.ack([seq for cell_seqs in seqs.values() for seq in cell_seqs])
+            self._flushes += 1
+            if self._reads:
+                # чтения, начатые до этой записи, могут вернуть старые значения — наложим на них записанное
+                for row_index, cells in dirty.items():
+                    written_cells = self._written.setdefault(row_index, {})
+                    for col, value in cells.items():
+                        written_cells[col] = (self._flushes, value)
+            return True
+
+    async def _write(self, cells: list) -> list:
+        """
+        batch_update ячеек [(row_index, col, value)]. Пачку, отклонённую Google (4xx), делит пополам
+        и отправляет части отдельно. Возвращает отклонённые ячейки [(row_index, col, value, ошибка)]
+        """
+        data = [{"range": rowcol_to_a1(row_index, col), "values": [[value]]} for row_index, col, value in cells]
+        try:
+            await sheets_call(sheet_clients.batch_update, data, value_input_option="USER_ENTERED",
+                              op="write", priority=PRIO_BACKGROUND)
+            return []
+        except Exception as e:
+            if not _sheets_error_permanent(e):
+                raise
+            if len(cells) == 1:
+                return [(*cells[0], e)]
+            logger.error(f"Google отклонил запись {len(cells)} ячеек клиентов ({_sheets_error_status(e)}): делим пачку")
+            mid = len(cells) // 2
+            # запись ячеек идемпотентна: если вторая половина упадёт не по 4xx, повтор первой ничего не испортит
+            return await self._write(cells[:mid]) + await self._write(cells[mid:])
+
+    def _reject(self, row_index: int, col: int, value: str, e: Exception):
+        """Ячейку таблица не принимает — отбрасываем, чтобы не повторять вечно; строку потом перечитаем"""
+        self.rejected += 1
+        METRICS.inc("bot_client_cells_rejected_total")
+        logger.error(f"Ячейка {rowcol_to_a1(row_index, col)} клиентов отклонена Google и отброшена: {e}; "
+                     f"значение: {value!r}")
+        self._rows.pop(row_index, None)
+        self._fetched_at.pop(row_index, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self.evict()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+CLIENT_ROWS = ClientRowCache(CLIENT_FLUSH_INTERVAL_SEC, CLIENT_ROW_TTL_SEC)
+
+class UserOfferStatus:
+    """
+    Статусы офферов одного пользователя — битовые маски по Offer.idx каталога версии version
+    (несколько машинных слов на пользователя при любом числе офферов).
+    """
+    __slots__ = ("taken", "selected", "done", "version")
+
+    def __init__(self, version: int):
+        self.taken = 0      # всё, что уже брал: H + SELECTED + DONE
+        self.selected = 0   # в работе (SELECTED)
+        self.done = 0       # выполненные (DONE)
+        self.version = version
+
+    def is_taken(self, offer) -> bool:
+        return bool(self.taken >> offer.idx & 1)
+
+def _iter_bits(mask: int, skip: int = 0):
+    """Номера установленных битов mask по возрастанию, начиная с (skip+1)-го"""
+    for _ in range(skip):
+        mask &= mask - 1
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def _offers_page(catalog, mask: int, page: int, page_size: int) -> list:
+    """Офферы страницы page (с 1) из маски: без сборки полного списка доступных"""
+    bits = _iter_bits(mask, (page - 1) * page_size)
+    return [catalog.offers[idx] for idx in itertools.islice(bits, page_size)]
+
+def _parse_offer_status(row_vals, catalog=None) -> UserOfferStatus:
+    """Разбирает строку клиента: поле H (IDX_OFFER_NO) вида '1;3;10' и чекбоксы по колонкам каталога"""
+    catalog = catalog or CATALOG
+    status = UserOfferStatus(catalog.version)
+    # поле H (IDX_OFFER_NO) может содержать "1;3;10"; номера вне каталога на выдачу не влияют
+    raw = row_vals[IDX_OFFER_NO - 1] or ""
+    by_id = catalog.offers_by_id
+    for x in raw.replace(" ", "").split(";"):
+        offer = by_id.get(x)
+        if offer is not None:
+            status.taken |= 1 << offer.idx
+    # чекбоксы
+    for bit, col_idx in catalog.status_cols:
+        v = row_vals[col_idx - 1] if col_idx <= len(row_vals) else ""
+        v = str(v).strip().upper()
+        if v == "SELECTED":
+            status.selected |= bit
+        elif v == "DONE":
+            status.done |= bit
+    status.taken |= status.selected | status.done   # ⚡ только занятые
+    return status
+
+class OfferStatusCache:
+    """
+    Кэш статусов офферов по строке клиента с TTL.
+    Свои записи бота (mark_offer_taken_for_user) применяются сразу,
+    а изменения операторов (SELECTED -> DONE) подтягиваются фоновым обновлением
+    активных пользователей — batch_get на каждые chunk_rows строк.
+    """
+    def __init__(self, ttl: float, refresh_interval: float, chunk_rows: int):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.chunk_rows = chunk_rows
+        self._items: dict[int, tuple[UserOfferStatus, float]] = {}   # row_index -> (статус, время разбора)
+        self._last_access: dict[int, float] = {}
+
+    async def get(self, row_index: int, catalog=None) -> UserOfferStatus:
+        """
+        Статус в битах каталога catalog (по умолчанию текущего). Если каталог сменился —
+        маски пересобираются из закэшированной строки (CLIENT_ROWS), без чтения таблицы.
+        """
+        catalog = catalog or CATALOG
+        now = asyncio.get_running_loop().time()
+        self._last_access[row_index] = now
+        item = self._items.get(row_index)
+        if item and now - item[1] <= self.ttl:
+            if item[0].version == catalog.version:
+                return item[0]
+            row_vals = await CLIENT_ROWS.get_row(row_index)
+            status = _parse_offer_status(row_vals, catalog)
+            self._items[row_index] = (status, item[1])
+            return status
+        row_vals = await CLIENT_ROWS.get_row(row_index)
+        status = _parse_offer_status(row_vals, catalog)
+        self._items[row_index] = (status, now)
+        return status
+
+    def on_offer_taken(self, row_index: int, offer_id: str):
+        """Бот сам пометил оффер — обновляем статус без чтения таблицы"""
+        item = self._items.get(row_index)
+        if not item:
+            return
+        status = item[0]
+        offer = CATALOG.offers_by_id.get(str(offer_id))
+        if status.version != CATALOG.version or offer is None:
+            # маски другой версии каталога — пусть пересоберутся из строки
+            self._items.pop(row_index, None)
+            return
+        status.taken |= 1 << offer.idx
+        if offer.col:
+            status.selected |= 1 << offer.idx
+
+    def cached(self, row_index: int, catalog=None) -> UserOfferStatus | None:
+        """Статус из кэша без чтения таблицы (и без продления активности пользователя); None — если нет или другой версии"""
+        catalog = catalog or CATALOG
+        item = self._items.get(row_index)
+        return item[0] if item and item[0].version == catalog.version else None
+
+    def invalidate(self, row_index: int | None = None):
+        if row_index is None:
+            self._items.clear()
+        else:
+            self._items.pop(row_index, None)
+
+    def __len__(self):
+        return len(self._items)
+
+    async def refresh(self):
+        """Перечитывает строки пользователей, активных в пределах TTL, и пересобирает их статусы"""
+        now = asyncio.get_running_loop().time()
+        for row_index, ts in list(self._last_access.items()):
+            if now - ts > self.ttl:
+                self._last_access.pop(row_index, None)
+                self._items.pop(row_index, None)
+        active = sorted(self._last_access)
+        for start in range(0, len(active), self.chunk_rows):
+            chunk = active[start:start + self.chunk_rows]
+            try:
+                await CLIENT_ROWS.refresh_rows(chunk)
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления статусов офферов: {e}")
+                return
+            for row_index in chunk:
+                row_vals = await CLIENT_ROWS.get_row(row_index)
+                self._items[row_index] = (_parse_offer_status(row_vals), now)
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+OFFER_STATUS = OfferStatusCache(OFFER_STATUS_TTL_SEC, OFFER_STATUS_REFRESH_SEC, OFFER_STATUS_REFRESH_CHUNK)
+
+class StateDB:
+    """Локальная SQLite для состояния диалогов (переживает рестарты и деплои)"""
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " store TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL,"
+                " PRIMARY KEY (store, key))"
+            )
+        return self._conn
+
+    def load(self, store: str):
+        with self._lock:
+            conn = self._connect()
+            cur = conn.execute(
+                "SELECT key, value, updated FROM state WHERE store = ? ORDER BY updated", (store,)
+            )
+            return cur.fetchall()
+
+    def write(self, store: str, upserts: list, deletes: list = (), touches: list = ()):
+        """
+        upserts — (key, value, updated); touches — (key, updated): запись читали, продлеваем её TTL;
+        deletes — (key, updated): удаляем, только если в базе не более свежая версия
+        (её мог записать процесс-воркер, которому этот пользователь принадлежит сейчас).
+        """
+        with self._lock:
+            conn = self._connect()
+            if upserts:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO state (store, key, value, updated) VALUES (?, ?, ?, ?)",
+                    [(store, k, v, ts) for k, v, ts in upserts]
+                )
+            if touches:
+                conn.executemany(
+                    "UPDATE state SET updated = ? WHERE store = ? AND key = ? AND updated < ?",
+                    [(ts, store, k, ts) for k, ts in touches]
+                )
+            if deletes:
+                conn.executemany(
+                    "DELETE FROM state WHERE store = ? AND key = ? AND updated <= ?",
+                    [(store, k, ts) for k, ts in deletes]
+                )
+            conn.commit()
+
+STATE_DB = StateDB(STATE_DB_PATH) if STATE_DB_PATH else None
+
+class StateStore:
+    """
+    Словарь состояния пользователей (ключ — user_id) с вытеснением:
+    LRU при превышении max_entries / max_bytes и TTL с момента последнего обращения.
+    Если задан db — изменения пачками сохраняются в SQLite, а при старте загружаются обратно
+    (при нескольких воркерах — только ключи своих пользователей, см. owns_user). Время последнего
+    обращения тоже сохраняется, удаление из базы — только той версии, которую видел этот процесс.
+    Поддерживает то, чем бот пользуется у dict: get, [], in, pop, len.
+    """
+    def __init__(self, name: str, ttl: float, max_entries: int, max_bytes: int, db: StateDB | None = None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.db = db
+        self._data: OrderedDict = OrderedDict()   # key -> (value, последнее обращение (wall time), размер)
+        self._bytes = 0
+        self._dirty: set = set()
+        self._touched: set = set()              # читались: в базе продлеваем updated
+        self._deleted: dict = {}                # key -> время последнего обращения, которое видели мы
+        self.evicted = 0
+
+    @staticmethod
+    def _size(key, value) -> int:
+        # грубая оценка: сериализованное значение + накладные расходы на запись
+        return len(json.dumps(value, ensure_ascii=False, default=str)) + 120
+
+    def _drop(self, key, persist: bool = True):
+        _, ts, size = self._data.pop(key)
+        self._bytes -= size
+        if persist:
+            self._dirty.discard(key)
+            self._touched.discard(key)
+            self._deleted[key] = ts
+
+    def _expired(self, ts: float, now: float) -> bool:
+        return self.ttl and now - ts > self.ttl
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        now = time.time()
+        if self._expired(item[1], now):
+            self._drop(key)
+            return default
+        self._data[key] = (item[0], now, item[2])
+        self._data.move_to_end(key)
+        if key not in self._dirty:
+            self._touched.add(key)
+        return item[0]
+
+    def __getitem__(self, key):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._drop(key, persist=False)
+        size = self._size(key, value)
+        self._data[key] = (value, time.time(), size)
+        self._bytes += size
+        self._deleted.pop(key, None)
+        self._touched.discard(key)
+        self._dirty.add(key)
+        # LRU-вытеснение
+        while len(self._data) > self.max_entries or (self._bytes > self.max_bytes and len(self._data) > 1):
+            oldest = next(iter(self._data))
+            self._drop(oldest)
+            self.evicted += 1
+
+    def pop(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        self._drop(key)
+        return default if self._expired(item[1], time.time()) else item[0]
+
+    def __len__(self):
+        return len(self._data)
+
+    def memory_bytes(self) -> int:
+        return self._bytes
+
+    def sweep(self):
+        """Удаляет просроченные записи (самые старые — в начале OrderedDict)"""
+        now = time.time()
+        while self._data:
+            key, (_, ts, _) = next(iter(self._data.items()))
+            if not self._expired(ts, now):
+                break
+            self._drop(key)
+
+    async def load(self):
+        """Загружает сохранённое состояние своих пользователей (при старте); просроченное удаляется при flush"""
+        if not self.db:
+            return 0
+        now = time.time()
+        rows = await run_in_executor(self.db.load, self.name)
+        loaded = 0
+        for key, value, updated in rows:
+            key = int(key) if key.lstrip("-").isdigit() else key
+            if not owns_user(key):
+                # пользователь другого воркера — его состояние ведёт (и удаляет) только тот процесс
+                continue
+            if self._expired(updated, now):
+                self._deleted[key] = updated
+                continue
+            value = json.loads(value)
+            size = self._size(key, value)
+            self._data[key] = (value, updated, size)
+            self._bytes += size
+            loaded += 1
+        logger.info(f"Состояние '{self.name}' загружено: {loaded} записей")
+        return loaded
+
+    async def flush(self):
+        """Сохраняет изменения с прошлого сброса одним запросом к SQLite"""
+        if not self.db or not (self._dirty or self._deleted or self._touched):
+            return
+        dirty, self._dirty = self._dirty, set()
+        touched, self._touched = self._touched, set()
+        deleted, self._deleted = self._deleted, {}
+        upserts, touches = [], []
+        for key in dirty:
+            item = self._data.get(key)
+            if item is not None:
+                upserts.append((str(key), json.dumps(item[0], ensure_ascii=False, default=str), item[1]))
+        for key in touched:
+            item = self._data.get(key)
+            if item is not None:
+                touches.append((str(key), item[1]))
+        try:
+            await run_in_executor(self.db.write, self.name, upserts,
+                                  [(str(k), ts) for k, ts in deleted.items()], touches)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния '{self.name}': {e}")
+            self._dirty |= dirty
+            self._touched |= touched - self._dirty
+            for key, ts in deleted.items():
+                if key not in self._data:
+                    self._deleted.setdefault(key, ts)
+
+USER_MENU_MESSAGE = StateStore("menu", STATE_MENU_TTL_SEC, STATE_MAX_ENTRIES, STATE_MAX_BYTES, STATE_DB)
+PENDING_OFFER = StateStore("pending_offer", STATE_PENDING_TTL_SEC, STATE_MAX_ENTRIES, STATE_MAX_BYTES, STATE_DB)
+STATE_STORES = (USER_MENU_MESSAGE, PENDING_OFFER)
+
+async def state_flush_loop(interval: float = STATE_FLUSH_INTERVAL_SEC):
+    while True:
+        await asyncio.sleep(interval)
+        for store in STATE_STORES:
+            store.sweep()
+            await store.flush()
+
 async def store_menu_message_for_user(user_id: int, msg: types.Message):
     USER_MENU_MESSAGE[user_id] = {
         "chat_id": msg.chat.id,
@@ -117,12 +2023,48 @@ async def store_menu_message_for_user(user_id: int, msg: types.Message):
         "page": 1
     }
 
+def adopt_broadcast_menu(user_id: int, chat_id: int, message_id: int):
+    """
+    Сообщение рассылки становится меню пользователя (кнопки в нём редактируют его же).
+    Если пользователь сейчас вводит код по офферу — его меню не трогаем.
+    """
+    if user_id in PENDING_OFFER:
+        return
+    USER_MENU_MESSAGE[user_id] = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "category": None,
+        "page": 1
+    }
+
+def _menu_hash(text: str, keyboard: InlineKeyboardMarkup | None) -> str:
+    """Отпечаток отрисованного меню (текст + клавиатура) — чтобы не слать в Telegram то, что уже на экране"""
+    h = hashlib.blake2b(text.encode("utf-8"), digest_size=12)
+    if keyboard is not None:
+        h.update(b"\0")
+        h.update(keyboard.model_dump_json(exclude_none=True).encode("utf-8"))
+    return h.hexdigest()
+
+# сообщения больше нет или его нельзя редактировать — только тогда присылаем меню заново
+_MENU_GONE_ERRORS = (
+    "message to edit not found",
+    "message can't be edited",
+    "message_id_invalid",
+    "message identifier is not specified",
+)
+
 async def edit_user_menu(user_id: int, text: str, keyboard: InlineKeyboardMarkup | None = None):
     """
-    Попытка отредактировать существующее меню. Если не получилось — отправляем новое сообщение и сохраняем его.
+    Редактирует сохранённое меню пользователя.
+    Если на экране уже ровно это меню — ничего не отправляет. Новое сообщение присылаем,
+    только когда старое удалено или больше не редактируется (а не при любой ошибке).
     """
+    rendered = _menu_hash(text, keyboard)
     info = USER_MENU_MESSAGE.get(user_id)
     if info:
+        if info.get("hash") == rendered:
+            METRICS.inc("bot_menu_edits_skipped_total")
+            return
         try:
             await bot.edit_message_text(
                 text=text,
@@ -131,21 +2073,65 @@ async def edit_user_menu(user_id: int, text: str, keyboard: InlineKeyboardMarkup
                 reply_markup=keyboard,
                 parse_mode="HTML"
             )
+            info["hash"] = rendered
+            USER_MENU_MESSAGE[user_id] = info
+            return
+        except TelegramBadRequest as e:
+            err = str(e).lower()
+            if "message is not modified" in err:
+                # на экране уже это меню — считаем успехом
+                info["hash"] = rendered
+                USER_MENU_MESSAGE[user_id] = info
+                return
+            if not any(marker in err for marker in _MENU_GONE_ERRORS):
+                logger.error(f"Не удалось отредактировать меню (user {user_id}): {e}")
+                return
+            logger.info(f"Меню пользователя {user_id} недоступно ({e}), отправляем заново")
+        except TelegramForbiddenError as e:
+            # бот заблокирован — новое сообщение тоже не дойдёт
+            logger.warning(f"Не удалось отредактировать меню (user {user_id}): {e}")
             return
         except Exception as e:
+            # flood wait / сеть: повторная отправка только добавит нагрузки и дубль меню
             logger.warning(f"Не удалось отредактировать меню (user {user_id}): {e}")
+            return
 
-    # fallback: отправляем новое сообщение и сохраняем его как меню
+    # меню ещё нет или оно пропало: отправляем новое сообщение и сохраняем его как меню
     try:
         msg = await bot.send_message(chat_id=user_id, text=text, reply_markup=keyboard, parse_mode="HTML")
         await store_menu_message_for_user(user_id, msg)
+        info = USER_MENU_MESSAGE.get(user_id)
+        if info is not None:
+            info["hash"] = rendered
+            USER_MENU_MESSAGE[user_id] = info
     except Exception as e:
         logger.error(f"Ошибка при отправке fallback-меню пользователю {user_id}: {e}")
 
-async def init_google_sheets():
-    """Инициализация Google Sheets"""
-    global client, sheet_clients, sheet_logs, sheet_offers
-    try:
+class Storage:
+    """
+    Хранилище данных бота: три листа (клиенты, логи, офферы).
+    Каждый лист — объект с тем подмножеством API gspread.Worksheet, которым пользуется бот
+    (get_all_values, row_values, col_values, update, batch_update, append_row(s)).
+    """
+    name = "base"
+
+    def __init__(self):
+        self.clients = None
+        self.logs = None
+        self.offers = None
+
+    async def open(self) -> bool:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class GspreadStorage(Storage):
+    """Google Sheets через gspread"""
+    name = "gspread"
+
+    async def open(self) -> bool:
+        global client
         scope = [
             "https://spreadsheets.google.com/feeds",
             "https://www.googleapis.com/auth/spreadsheets",
@@ -160,12 +2146,369 @@ async def init_google_sheets():
         creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
         client = gspread.authorize(creds)
 
-        spreadsheet = await run_in_executor(client.open_by_url, SPREADSHEET_URL)
-        sheet_clients = spreadsheet.worksheet("Клиенты - Партнерки")
-        sheet_logs = spreadsheet.worksheet("Логи от бота")
-        sheet_offers = spreadsheet.worksheet("Офферы")
+        spreadsheet = await sheets_call(client.open_by_url, SPREADSHEET_URL)
+        self.clients = spreadsheet.worksheet(SHEET_CLIENTS_TITLE)
+        self.logs = spreadsheet.worksheet(SHEET_LOGS_TITLE)
+        self.offers = spreadsheet.worksheet(SHEET_OFFERS_TITLE)
+        return True
+
+class SheetsHTTPError(Exception):
+    """Ошибка Sheets API; code — HTTP-статус (по нему SheetsScheduler решает, повторять ли запрос)"""
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+
+class AsyncSheetsClient:
+    """
+    Асинхронный клиент Google Sheets API v4 на одной keep-alive aiohttp-сессии.
+    Токен сервисного аккаунта выдаёт oauth2client (get_access_token, в потоке), держим его в памяти до истечения.
+    Если Google отверг токен (401) раньше срока — берём новый и повторяем запрос один раз.
+    Покрывает только то, что нужно боту: values get/batchGet, update/batchUpdate, append.
+    """
+    API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+    SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+    def __init__(self, creds_dict: dict, spreadsheet_id: str):
+        self._creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, self.SCOPES)
+        self.spreadsheet_id = spreadsheet_id
+        self._session: aiohttp.ClientSession | None = None
+        self._token = None
+        self._token_expires = 0.0
+        self._revoked_token = None
+        self._token_lock = asyncio.Lock()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=SHEETS_HTTP_POOL_SIZE, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=SHEETS_HTTP_TIMEOUT_SEC),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    async def _access_token(self) -> str:
+        # обновляем заранее, за минуту до истечения
+        if self._token and time.monotonic() < self._token_expires - 60:
+            return self._token
+        async with self._token_lock:
+            if self._token and time.monotonic() < self._token_expires - 60:
+                return self._token
+            # обмен JWT на токен в oauth2client — блокирующий HTTP, поэтому в потоке
+            info = await run_in_executor(self._creds.get_access_token)
+            if info.access_token == self._revoked_token or (info.expires_in is not None and info.expires_in < 120):
+                # oauth2client отдаёт прежний токен, пока тот формально не истёк — обновляем принудительно
+                await run_in_executor(self._creds.refresh, oauth2_transport.get_http_object())
+                info = await run_in_executor(self._creds.get_access_token)
+            self._token = info.access_token
+            self._token_expires = time.monotonic() + (info.expires_in or 3600)
+            return self._token
+
+    async def _request(self, method: str, path: str, params=None, json_body=None):
+        url = f"{self.API_URL}/{self.spreadsheet_id}{path}"
+        for attempt in (1, 2):
+            token = await self._access_token()
+            async with self.session.request(
+                method, url, params=params, json=json_body, headers={"Authorization": f"Bearer {token}"}
+            ) as resp:
+                if resp.status == 401:
+                    # токен отозван/протух раньше срока; запрос с ним не выполнен — повторяем с новым
+                    if self._token == token:
+                        self._revoked_token, self._token = token, None
+                    if attempt == 1:
+                        continue
+                if resp.status >= 400:
+                    raise SheetsHTTPError(resp.status, await resp.text())
+                return await resp.json(content_type=None)
+
+    async def metadata(self, fields: str = "sheets.properties.title"):
+        return await self._request("GET", "", params={"fields": fields})
+
+    async def values_get(self, range_name: str, major_dimension: str = "ROWS"):
+        data = await self._request("GET", f"/values/{quote(range_name, safe='')}",
+                                   params={"majorDimension": major_dimension})
+        return data.get("values", [])
+
+    async def values_batch_get(self, ranges: list[str]):
+        params = [("ranges", r) for r in ranges]
+        data = await self._request("GET", "/values:batchGet", params=params)
+        return [vr.get("values", []) for vr in data.get("valueRanges", [])]
+
+    async def values_update(self, range_name: str, values, value_input_option: str = "RAW"):
+        return await self._request("PUT", f"/values/{quote(range_name, safe='')}",
+                                   params={"valueInputOption": value_input_option},
+                                   json_body={"range": range_name, "values": values})
+
+    async def values_batch_update(self, data: list[dict], value_input_option: str = "RAW"):
+        return await self._request("POST", "/values:batchUpdate",
+                                   json_body={"valueInputOption": value_input_option, "data": data})
+
+    async def values_append(self, range_name: str, values, value_input_option: str = "RAW"):
+        return await self._request("POST", f"/values/{quote(range_name, safe='')}:append",
+                                   params={"valueInputOption": value_input_option, "insertDataOption": "INSERT_ROWS"},
+                                   json_body={"values": values})
+
+class AsyncWorksheet:
+    """
+    Лист поверх AsyncSheetsClient с теми же именами методов, что у gspread.Worksheet (но async).
+    SheetsScheduler видит корутины и не отправляет их в пул потоков.
+    """
+    def __init__(self, api: AsyncSheetsClient, title: str):
+        self._api = api
+        self.title = title
+
+    def _range(self, a1: str) -> str:
+        return "'{}'!{}".format(self.title.replace("'", "''"), a1)
+
+    async def get_all_values(self):
+        rows = await self._api.values_get(self._range("A:ZZZ"))
+        if not rows:
+            return []
+        width = max(len(r) for r in rows)
+        return [_pad_row(r, width) for r in rows]
+
+    async def row_values(self, row: int):
+        rows = await self._api.values_get(self._range(f"{row}:{row}"))
+        return rows[0] if rows else []
+
+    async def col_values(self, col: int):
+        letter = rowcol_to_a1(1, col).rstrip("0123456789")
+        cols = await self._api.values_get(self._range(f"{letter}:{letter}"), major_dimension="COLUMNS")
+        return cols[0] if cols else []
+
+    async def batch_get(self, ranges, **kwargs):
+        return await self._api.values_batch_get([self._range(r) for r in ranges])
+
+    async def update(self, range_name, values=None, *args, value_input_option=None, **kwargs):
+        # поддерживаем оба порядка аргументов gspread и старый вызов с {'valueInputOption': ...}
+        if not isinstance(range_name, str):
+            range_name, values = values, range_name
+        for extra in args:
+            if isinstance(extra, dict):
+                value_input_option = value_input_option or extra.get("valueInputOption")
+        return await self._api.values_update(self._range(range_name), values, value_input_option or "RAW")
+
+    async def batch_update(self, data, value_input_option=None, **kwargs):
+        data = [{"range": self._range(item["range"]), "values": item["values"]} for item in data]
+        return await self._api.values_batch_update(data, value_input_option or "RAW")
+
+    async def append_rows(self, values, value_input_option=None, **kwargs):
+        return await self._api.values_append(self._range("A1"), values, value_input_option or "RAW")
+
+    async def append_row(self, values, value_input_option=None, **kwargs):
+        return await self.append_rows([values], value_input_option=value_input_option)
+
+class AsyncSheetsStorage(Storage):
+    """Google Sheets через AsyncSheetsClient — без gspread и без потоков"""
+    name = "aiohttp"
+
+    def __init__(self):
+        super().__init__()
+        self.api: AsyncSheetsClient | None = None
+
+    async def open(self) -> bool:
+        creds_json = os.getenv("GOOGLE_CREDENTIALS")
+        if not creds_json:
+            logger.error("GOOGLE_CREDENTIALS не найдены в переменных окружения!")
+            return False
+        m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", SPREADSHEET_URL)
+        if not m:
+            logger.error(f"Не удалось получить id таблицы из {SPREADSHEET_URL}")
+            return False
+        self.api = AsyncSheetsClient(json.loads(creds_json), m.group(1))
+
+        # проверяем доступ и наличие листов
+        meta = await sheets_call(self.api.metadata)
+        titles = {s["properties"]["title"] for s in meta.get("sheets", [])}
+        for title in (SHEET_CLIENTS_TITLE, SHEET_LOGS_TITLE, SHEET_OFFERS_TITLE):
+            if title not in titles:
+                logger.error(f"Лист '{title}' не найден в таблице")
+                return False
+        self.clients = AsyncWorksheet(self.api, SHEET_CLIENTS_TITLE)
+        self.logs = AsyncWorksheet(self.api, SHEET_LOGS_TITLE)
+        self.offers = AsyncWorksheet(self.api, SHEET_OFFERS_TITLE)
+        return True
+
+    async def close(self):
+        if self.api:
+            await self.api.close()
+
+def _trim_row(row):
+    """Убирает пустые ячейки в конце строки (как это делает Google в ответах)"""
+    row = list(row)
+    while row and row[-1] == "":
+        row.pop()
+    return row
+
+class SQLiteWorksheet:
+    """
+    Лист, хранящийся в локальной SQLite (одна запись на строку, значения — JSON-список).
+    Повторяет поведение gspread.Worksheet для используемых ботом методов:
+    пустые хвосты строк/колонок обрезаются, append дописывает после последней непустой строки.
+    """
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock, title: str):
+        self._conn = conn
+        self._lock = lock
+        self.title = title
+
+    def _load(self) -> dict[int, list[str]]:
+        cur = self._conn.execute("SELECT row, vals FROM sheet_rows WHERE sheet = ?", (self.title,))
+        return {r: json.loads(v) for r, v in cur.fetchall()}
+
+    def _last_row(self) -> int:
+        cur = self._conn.execute("SELECT MAX(row) FROM sheet_rows WHERE sheet = ?", (self.title,))
+        return cur.fetchone()[0] or 0
+
+    def _write_cells(self, top: int, left: int, values):
+        for r_off, row in enumerate(values):
+            row_index = top + r_off
+            cur = self._conn.execute(
+                "SELECT vals FROM sheet_rows WHERE sheet = ? AND row = ?", (self.title, row_index)
+            )
+            found = cur.fetchone()
+            vals = json.loads(found[0]) if found else []
+            for c_off, v in enumerate(row):
+                col = left + c_off
+                vals = _ensure_len(vals, col)
+                vals[col - 1] = "" if v is None else str(v)
+            vals = _trim_row(vals)
+            if vals:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sheet_rows (sheet, row, vals) VALUES (?, ?, ?)",
+                    (self.title, row_index, json.dumps(vals, ensure_ascii=False))
+                )
+            else:
+                self._conn.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row = ?", (self.title, row_index))
+
+    def get_all_values(self):
+        with self._lock:
+            rows = self._load()
+        if not rows:
+            return []
+        width = max(len(v) for v in rows.values())
+        return [_pad_row(rows.get(i, []), width) for i in range(1, max(rows) + 1)]
+
+    def row_values(self, row: int):
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT vals FROM sheet_rows WHERE sheet = ? AND row = ?", (self.title, row)
+            )
+            found = cur.fetchone()
+        return json.loads(found[0]) if found else []
+
+    def col_values(self, col: int):
+        with self._lock:
+            rows = self._load()
+        out = [""] * (max(rows) if rows else 0)
+        for r, vals in rows.items():
+            if len(vals) >= col:
+                out[r - 1] = vals[col - 1]
+        return _trim_row(out)
+
+    def batch_get(self, ranges, **kwargs):
+        with self._lock:
+            rows = self._load()
+        out = []
+        for rng in ranges:
+            first, _, last = rng.partition(":")
+            top, left = a1_to_rowcol(first)
+            bottom, right = a1_to_rowcol(last) if last else (top, left)
+            block = [_trim_row(_pad_row(rows.get(r, []), right)[left - 1:]) for r in range(top, bottom + 1)]
+            while block and not block[-1]:
+                block.pop()
+            out.append(block)
+        return out
+
+    def update(self, range_name, values=None, *args, **kwargs):
+        # поддерживаем оба порядка аргументов gspread: (range, values) и (values, range)
+        if not isinstance(range_name, str):
+            range_name, values = values, range_name
+        top, left = a1_to_rowcol(range_name.split(":", 1)[0])
+        with self._lock:
+            self._write_cells(top, left, values or [])
+            self._conn.commit()
+        return {"updatedRange": f"{self.title}!{range_name}"}
+
+    def batch_update(self, data, **kwargs):
+        with self._lock:
+            for item in data:
+                top, left = a1_to_rowcol(item["range"].split(":", 1)[0])
+                self._write_cells(top, left, item["values"])
+            self._conn.commit()
+        return {"totalUpdatedCells": sum(len(r) for item in data for r in item["values"])}
+
+    def append_rows(self, values, value_input_option=None, **kwargs):
+        with self._lock:
+            start = self._last_row() + 1
+            self._write_cells(start, 1, values)
+            self._conn.commit()
+        end = start + len(values) - 1
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:{rowcol_to_a1(end, max([len(r) for r in values] or [1]))}"}}
+
+    def append_row(self, values, value_input_option=None, **kwargs):
+        return self.append_rows([values], value_input_option=value_input_option)
+
+    def seed(self, rows):
+        """Полностью заменяет содержимое листа (для офлайн-прогонов)"""
+        with self._lock:
+            self._conn.execute("DELETE FROM sheet_rows WHERE sheet = ?", (self.title,))
+            self._write_cells(1, 1, rows)
+            self._conn.commit()
+
+class SQLiteStorage(Storage):
+    """Локальная SQLite с той же семантикой листов — бот работает полностью офлайн"""
+    name = "sqlite"
+
+    def __init__(self, path: str = SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self.conn = None
+
+    async def open(self) -> bool:
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sheet_rows ("
+            " sheet TEXT NOT NULL, row INTEGER NOT NULL, vals TEXT NOT NULL,"
+            " PRIMARY KEY (sheet, row))"
+        )
+        self.conn.commit()
+        lock = threading.Lock()
+        self.clients = SQLiteWorksheet(self.conn, lock, SHEET_CLIENTS_TITLE)
+        self.logs = SQLiteWorksheet(self.conn, lock, SHEET_LOGS_TITLE)
+        self.offers = SQLiteWorksheet(self.conn, lock, SHEET_OFFERS_TITLE)
+        return True
+
+STORAGE_BACKENDS = {
+    AsyncSheetsStorage.name: AsyncSheetsStorage,
+    GspreadStorage.name: GspreadStorage,
+    SQLiteStorage.name: SQLiteStorage,
+}
+storage: Storage | None = None
+# хранилище открыто (или открыть не удалось и бот работает без записи) — апдейты можно обрабатывать
+STORAGE_READY = asyncio.Event()
+
+async def init_google_sheets(backend: Storage | None = None):
+    """Инициализация хранилища (по умолчанию — Google Sheets, см. STORAGE_BACKEND)"""
+    global storage, sheet_clients, sheet_logs, sheet_offers
+    try:
+        if backend is None:
+            backend_cls = STORAGE_BACKENDS.get(STORAGE_BACKEND)
+            if not backend_cls:
+                logger.error(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+                return False
+            backend = backend_cls()
+        if not await backend.open():
+            return False
+        storage = backend
+        sheet_clients = backend.clients
+        sheet_logs = backend.logs
+        sheet_offers = backend.offers
+        STORAGE_READY.set()
 
-        logger.info("Google Sheets успешно инициализированы!")
+        logger.info(f"Хранилище '{backend.name}' успешно инициализировано!")
         return True
     except Exception as e:
         logger.error(f"Ошибка при инициализации Google Sheets: {e}")
@@ -183,12 +2526,24 @@ def _pad_row(row, length):
         row = row[:length]
     return row
 
+def _ensure_len(row, length):
+    """Дополняет список пустыми строками до length (не обрезает)"""
+    if len(row) < length:
+        row = row + [""] * (length - len(row))
+    return row
+
 async def find_user_row_by_id(user_id: str):
     """Ищет строку (номер) по user_id в колонке B. Возвращает None если не найдено"""
+    if CLIENT_ROW_INDEX.ready:
+        row_index = CLIENT_ROW_INDEX.get(user_id)
+        if row_index is not None or not CLIENT_ROW_INDEX.from_disk or not sheet_clients:
+            return row_index
+        # индекс из снимка на диске ещё не сверен с таблицей — клиент мог появиться позже, ищем по колонке
     if not sheet_clients:
         return None
+    # индекс ещё не построен — старый путь через загрузку колонки
     try:
-        col_vals = await run_in_executor(sheet_clients.col_values, IDX_USER_ID)
+        col_vals = await sheets_read(sheet_clients.col_values, IDX_USER_ID)
         # col_values returns list with header as first element usually
         for i, v in enumerate(col_vals, start=1):
             if v == user_id:
@@ -198,50 +2553,344 @@ async def find_user_row_by_id(user_id: str):
         logger.error(f"find_user_row_by_id error: {e}")
         return None
 
+class _Registration:
+    """Новая строка клиента в очереди на добавление"""
+    __slots__ = ("user_id", "row", "fut", "seqs", "in_flight", "sent")
+
+    def __init__(self, user_id: str, row: list, fut: asyncio.Future, seqs: list):
+        self.user_id = user_id
+        self.row = row
+        self.fut = fut
+        self.seqs = seqs          # записи журнала с этой строкой (последняя — актуальная)
+        self.in_flight = False    # строка сейчас отправляется в append_rows
+        self.sent: asyncio.Future | None = None   # завершится вместе с этой отправкой
+
+def _appended_first_row(resp) -> int | None:
+    """Номер первой добавленной строки из ответа append (updates.updatedRange, например "'Лист'!A5:H6")"""
+    updated = (resp or {}).get("updates", {}).get("updatedRange", "")
+    m = re.search(r"![A-Z]+(\d+)", updated)
+    return int(m.group(1)) if m else None
+
+class ClientRegistrar:
+    """
+    Регистрация новых клиентов без загрузки всего листа.
+    Новые строки копятся batch_sec секунд и уходят одним append_rows; номер строки берём из ответа Google.
+    Номер клиента выдаётся из счётчика в памяти перед отправкой, когда индекс клиентов сверен с таблицей:
+    счётчик не бывает меньше last_row, поэтому строки, добавленные операторами, номера не повторят.
+    Повторная регистрация того же user_id, пока первая ещё в очереди, ждёт ту же строку.
+    Строка сначала пишется в журнал (JOURNAL); если Google недоступен, пачка остаётся в очереди и повторяется
+    с нарастающей паузой (retry_sec .. retry_max_sec), а обработчик ждёт номер строки не дольше wait_sec.
+    Если запрос мог дойти до таблицы (сеть, 5xx), перед повтором индекс клиентов сверяется с таблицей,
+    чтобы не добавить строку второй раз. Пачку, отклонённую Google (4xx), отправляем по одной строке:
+    строку, которую таблица не принимает, убираем из очереди и журнала (в лог и метрику), остальные — добавляем.
+    """
+    def __init__(self, batch_sec: float, batch_size: int, wait_sec: float, retry_sec: float, retry_max_sec: float):
+        self.batch_sec = batch_sec
+        self.batch_size = batch_size
+        self.wait_sec = wait_sec
+        self.retry_sec = retry_sec
+        self.retry_max_sec = retry_max_sec
+        self.next_client_no: int | None = None
+        # в режиме нескольких процессов — общий счётчик multiprocessing.Value (см. run_sharded)
+        self.shared_counter = None
+        self._batch: list[_Registration] = []
+        self._pending: dict[str, _Registration] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._needs_sync = False
+        self._failures = 0        # сбоев подряд — от них пауза до повтора
+        self._isolate = 0         # сколько строк ещё отправлять по одной (после отказа 4xx на пачку)
+        self.rejected = 0
+
+    def allocate_client_no(self) -> int:
+        """Следующий № клиента; как и раньше — не меньше номера последней строки (первая строка — шапка)"""
+        if not CLIENT_ROW_INDEX.ready or CLIENT_ROW_INDEX.from_disk:
+            raise RuntimeError("индекс клиентов не сверен с таблицей — номер клиента не выдать")
+        if self.shared_counter is not None:
+            with self.shared_counter.get_lock():
+                client_no = max(self.shared_counter.value, CLIENT_ROW_INDEX.last_row, 1)
+                self.shared_counter.value = client_no + 1
+            return client_no
+        # last_row растёт и при пересинхронизации индекса (строки, добавленные операторами)
+        client_no = max(self.next_client_no or 1, CLIENT_ROW_INDEX.last_row)
+        self.next_client_no = client_no + 1
+        return client_no
+
+    def reserve_client_no(self, client_no: int):
+        """Номер уже выдан (строка из журнала прошлого запуска) — счётчик его больше не выдаст"""
+        if self.shared_counter is not None:
+            with self.shared_counter.get_lock():
+                self.shared_counter.value = max(self.shared_counter.value, client_no + 1)
+        else:
+            self.next_client_no = max(self.next_client_no or 1, client_no + 1)
+
+    async def _wait(self, item: _Registration) -> int | None:
+        try:
+            return await asyncio.wait_for(asyncio.shield(item.fut), self.wait_sec)
+        except asyncio.TimeoutError:
+            return None
+
+    async def register(self, user_id: str, new_row: list) -> tuple[int | None, bool]:
+        """
+        Возвращает (номер строки, создана ли строка именно этим вызовом).
+        Номер None — строка принята (в журнале и в очереди), но в таблицу ещё не попала.
+        """
+        item = self._pending.get(user_id)
+        if item is not None:
+            return await self._wait(item), False
+
+        # № клиента (IDX_CLIENT_NO) проставит flush — после сверки индекса с таблицей
+        seq = JOURNAL.append("register", u=user_id, row=new_row)
+        item = self._enqueue(user_id, new_row, [seq] if seq is not None else [])
+        start = time.perf_counter()
+        try:
+            return await self._wait(item), True
+        finally:
+            trace_span("sheets", "registration_batch", start, time.perf_counter() - start)
+
+    def _enqueue(self, user_id: str, row: list, seqs: list) -> _Registration:
+        item = _Registration(user_id, row, asyncio.get_running_loop().create_future(), seqs)
+        self._pending[user_id] = item
+        self._batch.append(item)
+        # общая запись пачки не принадлежит ни одному апдейту — запускаем её вне трассы вызывающего
+        if len(self._batch) >= self.batch_size:
+            asyncio.create_task(self.flush(), context=contextvars.Context())
+        else:
+            self._schedule(self.batch_sec)
+        return item
+
+    def _schedule(self, delay: float):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later(delay), context=contextvars.Context())
+
+    def restore(self, user_id: str, row: list, seq: int):
+        """Строка из журнала прошлого запуска: добавляем, только если клиента нет ни в таблице, ни в очереди"""
+        if CLIENT_ROW_INDEX.get(user_id) or user_id in self._pending:
+            # уже в таблице или клиент успел зарегистрироваться заново после рестарта (это свежее)
+            JOURNAL.ack([seq])
+            return
+        client_no = str(row[IDX_CLIENT_NO - 1]).strip()
+        if client_no.isdigit():
+            # номер выдан до рестарта, а строки в таблице ещё нет — last_row его не покрывает
+            self.reserve_client_no(int(client_no))
+        self._enqueue(user_id, row, [seq])
+
+    def is_pending(self, user_id: str) -> bool:
+        return user_id in self._pending
+
+    def update_pending(self, user_id: str, patch) -> bool:
+        """
+        Меняет строку клиента, которая ещё в очереди: patch(row) правит её на месте, новая версия — в журнал.
+        False — строки нет в очереди или она прямо сейчас отправляется.
+        """
+        item = self._pending.get(user_id)
+        if item is None or item.in_flight:
+            return False
+        patch(item.row)
+        seq = JOURNAL.append("register", u=user_id, row=item.row)
+        if seq is not None:
+            item.seqs.append(seq)
+        return True
+
+    def pending_row(self, user_id: str) -> list | None:
+        item = self._pending.get(user_id)
+        return item.row if item is not None else None
+
+    async def wait_row(self, user_id: str) -> int | None:
+        """Номер строки клиента после её текущей отправки (None — строка снова в очереди, её можно менять)"""
+        item = self._pending.get(user_id)
+        if item is None:
+            return CLIENT_ROW_INDEX.get(user_id)
+        if item.in_flight and item.sent is not None:
+            await asyncio.shield(item.sent)
+        return item.fut.result() if item.fut.done() else None
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._flush_task = None   # чтобы flush мог запланировать повтор
+        await self.flush()
+
+    def _resolve(self, item: _Registration, row_index: int | None):
+        JOURNAL.ack(item.seqs)
+        if self._pending.get(item.user_id) is item:
+            self._pending.pop(item.user_id)
+        if not item.fut.done():
+            item.fut.set_result(row_index)
+
+    def _retry_later(self, items: list):
+        """Сбой — пачка обратно в очередь, повтор через паузу, удваивающуюся с каждым сбоем подряд"""
+        self._batch = items + self._batch
+        delay = min(self.retry_max_sec, self.retry_sec * 2 ** self._failures)
+        self._failures += 1
+        self._schedule(delay)
+        return delay
+
+    async def flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        if self._needs_sync or not CLIENT_ROW_INDEX.ready or CLIENT_ROW_INDEX.from_disk:
+            # прошлая отправка могла дойти до таблицы — без свежего индекса повтор может задвоить строки;
+            # номера клиентов тоже считаются от last_row сверенного индекса
+            if not await CLIENT_ROW_INDEX.rebuild():
+                if sheet_clients:
+                    # таблица есть, но индекс не прочитать — это тоже сбой, паузы растут
+                    self._retry_later(batch)
+                else:
+                    # хранилище ещё подключается — ждём его без наращивания пауз
+                    self._batch = batch + self._batch
+                    self._schedule(self.retry_sec)
+                return
+            self._needs_sync = False
+        fresh = []
+        merged = False
+        for item in batch:
+            row_index = CLIENT_ROW_INDEX.get(item.user_id)
+            if row_index:
+                # строка уже в таблице (повтор после сбоя, запись из журнала или клиент,
+                # которого без таблицы не нашли) — поля, заполненные ботом, переносим в неё
+                self._merge_into(item, row_index)
+                self._resolve(item, row_index)
+                merged = True
+            else:
+                fresh.append(item)
+        if merged and JOURNAL.deferred():
+            asyncio.create_task(JOURNAL.replay(), context=contextvars.Context())
+        if not fresh:
+            return
+        if self._isolate:
+            # пачку отклонили целиком — ищем строку, которую таблица не принимает, отправляя по одной
+            fresh, rest = fresh[:1], fresh[1:]
+            self._batch = rest + self._batch
+        for item in fresh:
+            if not item.row[IDX_CLIENT_NO - 1]:
+                item.row[IDX_CLIENT_NO - 1] = str(self.allocate_client_no())
+        sent = asyncio.get_running_loop().create_future()
+        for item in fresh:
+            item.in_flight = True
+            item.sent = sent
+        try:
+            rows = [_trim_row(item.row) for item in fresh]
+            # 5xx сами не повторяем: строки могли добавиться — ниже повтор только после сверки индекса
+            resp = await sheets_call(sheet_clients.append_rows, rows, value_input_option="USER_ENTERED",
+                                     op="write", retry_5xx=False)
+            first_row = _appended_first_row(resp)
+            if not first_row:
+                raise RuntimeError(f"Не удалось определить строки из ответа append: {resp}")
+            for i, item in enumerate(fresh):
+                row_index = first_row + i
+                CLIENT_ROW_INDEX.set(item.user_id, row_index, phone=bool(item.row[IDX_PHONE - 1].strip()))
+                CLIENT_ROWS.put_row(row_index, item.row)
+                self._resolve(item, row_index)
+            logger.info(f"Зарегистрировано клиентов: {len(fresh)} (строки {first_row}..{first_row + len(fresh) - 1})")
+            self._failures = 0
+            self._advance_isolation()
+            if JOURNAL.deferred():
+                # отложенные пометки офферов этих клиентов можно применить сразу, не дожидаясь replay_loop
+                asyncio.create_task(JOURNAL.replay(), context=contextvars.Context())
+        except Exception as e:
+            for item in fresh:
+                item.in_flight = False
+            status = _sheets_error_status(e)
+            if _sheets_error_permanent(e):
+                # Google отклонил запрос (строка не добавлена) — повтор того же не поможет
+                if len(fresh) > 1:
+                    logger.error(f"Google отклонил пачку клиентов ({len(fresh)} строк, {status}): отправляем по одной")
+                    self._isolate = len(fresh)
+                    self._batch = fresh + self._batch
+                else:
+                    self._reject(fresh[0], e)
+                    self._advance_isolation()
+                if self._batch:
+                    self._schedule(self.batch_sec)
+            else:
+                if status is None or status >= 500:
+                    # запрос мог дойти до таблицы — перед повтором сверим индекс
+                    self._needs_sync = True
+                delay = self._retry_later(fresh)
+                logger.error(f"Ошибка добавления клиентов ({len(fresh)} строк), повтор через {delay:.0f} с: {e}")
+        finally:
+            sent.set_result(None)
+
+    def _merge_into(self, item: _Registration, row_index: int):
+        """Телефон и взятые офферы из строки в очереди — правками существующей строки (как update_client)"""
+        phone = item.row[IDX_PHONE - 1]
+        if phone:
+            CLIENT_ROWS.set_cell(row_index, IDX_PHONE, phone, user_id=item.user_id)
+        for offer_id in str(item.row[IDX_OFFER_NO - 1]).split(";"):
+            if offer_id.strip():
+                # H и чекбокс — через отложенную пометку: ей нужна текущая строка из таблицы
+                JOURNAL.defer_take(row_index, item.user_id, offer_id.strip())
+
+    def _advance_isolation(self):
+        if self._isolate:
+            self._isolate -= 1
+            if self._batch:
+                self._schedule(self.batch_sec)
+
+    def _reject(self, item: _Registration, e: Exception):
+        """Строку таблица не принимает — убираем её из очереди и журнала, чтобы не повторять вечно"""
+        self.rejected += 1
+        METRICS.inc("bot_client_registrations_rejected_total")
+        logger.error(f"Строка клиента {item.user_id} отклонена Google и отброшена: {e}; строка: {_trim_row(item.row)}")
+        self._resolve(item, None)
+
+CLIENT_REGISTRAR = ClientRegistrar(REGISTRATION_BATCH_SEC, REGISTRATION_BATCH_SIZE,
+                                   REGISTRATION_WAIT_SEC, REGISTRATION_RETRY_SEC, REGISTRATION_RETRY_MAX_SEC)
+
+def _merge_offer_no(current: str, offer="", offer_no="") -> str:
+    """Новое значение поля H (№ оффера): offer_no заменяет, offer дописывается через ';'"""
+    new_h = current
+    if offer_no:
+        new_h = offer_no
+    if offer:
+        # добавляем оффер в H (№ оффера) и/или можно ставить галочки I..O
+        # проще: если H пуст — пишем offer, иначе оставляем (или перезаписываем)
+        if not new_h:
+            new_h = offer
+        else:
+            # также можно дописать в H через ;
+            if offer not in new_h:
+                new_h = f"{new_h};{offer}"
+    return new_h
+
 async def update_client(user: types.User, phone="", location="", offer="", status="", mark="", offer_no=""):
     """
-    Добавляет или полностью обновляет строку клиента (A..Q).
-    Если запись есть — загружаем её, обновляем поля и перезаписываем весь диапазон A{row}:Q{row}.
-    Если нет — добавляем новую строку в A{next_row}:Q{next_row}.
+    Добавляет или обновляет строку клиента.
+    Если записи нет — строка добавляется через CLIENT_REGISTRAR (append, номер клиента из счётчика).
+    Если запись есть — меняем только переданные поля (ячейки уходят в таблицу в фоне через CLIENT_ROWS).
+    Если строка ещё в очереди на добавление (Google недоступен) — поля дописываются прямо в неё.
+    Все изменения сначала попадают в журнал (JOURNAL), поэтому при сбое Google не теряются —
+    в том числе пока хранилище не подключено: строку ищем по индексу из снимка, а не найденного клиента
+    ставим в очередь на добавление (если он в таблице уже есть, поля перенесутся в его строку, см. ClientRegistrar).
     """
-    if not sheet_clients:
-        logger.error("sheet_clients не инициализирован")
-        return False
     try:
         user_id = str(user.id)
         row_index = await find_user_row_by_id(user_id)
 
-        if row_index:
-            # обновление существующей строки
-            row_vals = await run_in_executor(sheet_clients.row_values, row_index)
-            row_vals = _pad_row(row_vals, NUM_COLUMNS)
-
-            # Обновляем поля (только если переданы)
-            if phone:
-                row_vals[IDX_PHONE - 1] = phone
-            if offer_no:
-                row_vals[IDX_OFFER_NO - 1] = offer_no
-            if offer:
-                # добавляем оффер в H (№ оффера) и/или можно ставить галочки I..O
-                # проще: если H пуст — пишем offer, иначе оставляем (или перезаписываем)
-                if not row_vals[IDX_OFFER_NO - 1]:
-                    row_vals[IDX_OFFER_NO - 1] = offer
-                else:
-                    # также можно дописать в H через ;
-                    if offer not in row_vals[IDX_OFFER_NO - 1]:
-                        row_vals[IDX_OFFER_NO - 1] = f"{row_vals[IDX_OFFER_NO - 1]};{offer}"
-
-            range_name = f"A{row_index}:GG{row_index}"
-            await run_in_executor(sheet_clients.update, range_name, [row_vals], {'valueInputOption': 'USER_ENTERED'})
-            logger.info(f"Обновлена строка {row_index} для user {user_id}")
-        else:
+        if not row_index and CLIENT_REGISTRAR.is_pending(user_id):
+            def patch(row):
+                if phone:
+                    row[IDX_PHONE - 1] = phone
+                row[IDX_OFFER_NO - 1] = _merge_offer_no(row[IDX_OFFER_NO - 1], offer, offer_no)
+
+            if CLIENT_REGISTRAR.update_pending(user_id, patch):
+                logger.info(f"Обновлена строка в очереди на добавление для user {user_id}")
+                return True
+            # строка как раз отправляется — дождёмся конца отправки
+            row_index = await CLIENT_REGISTRAR.wait_row(user_id)
+            if not row_index:
+                # отправка не удалась, строка снова в очереди
+                if CLIENT_REGISTRAR.update_pending(user_id, patch):
+                    return True
+                logger.error(f"update_client: строка user {user_id} ещё не добавлена, изменения не применены")
+                return False
+
+        if not row_index:
             # новая запись
-            all_values = await run_in_executor(sheet_clients.get_all_values)
-            next_row = len(all_values) + 1  # next available row index
-
-            client_no = next_row - 1  # первый data row will be 1 if header exists
             new_row = [""] * NUM_COLUMNS
-            new_row[IDX_CLIENT_NO - 1] = str(client_no)
             new_row[IDX_USER_ID - 1] = user_id
             new_row[IDX_USERNAME - 1] = user.username or ""
             new_row[IDX_FIRST_NAME - 1] = user.first_name or ""
@@ -249,42 +2898,344 @@ async def update_client(user: types.User, phone="", location="", offer="", statu
             new_row[IDX_DATE - 1] = datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S")
             new_row[IDX_MARK - 1] = mark or ""
             new_row[IDX_OFFER_NO - 1] = offer_no or offer or ""
-            # I..O checkboxes left empty            
-
-            range_name = f"A{next_row}:GG{next_row}"
-            await run_in_executor(sheet_clients.update, range_name, [new_row], {'valueInputOption': 'USER_ENTERED'})
-            logger.info(f"Добавлена новая строка {next_row} для user {user_id}")
+            # I..O checkboxes left empty
 
+            row_index, created = await CLIENT_REGISTRAR.register(user_id, new_row)
+            if created:
+                if row_index:
+                    logger.info(f"Добавлена новая строка {row_index} для user {user_id}")
+                else:
+                    logger.info(f"Строка user {user_id} в очереди на добавление (в журнале)")
+                return True
+            if not row_index:
+                # строку параллельно создаёт другой вызов и она ещё в очереди — дописываем поля в неё
+                return await update_client(user, phone=phone, offer=offer, offer_no=offer_no)
+            # строку параллельно создал другой вызов — дописываем наши поля как обновление
+
+        # обновление существующей строки: меняем только нужные ячейки, запись — в фоне
+        if phone:
+            CLIENT_ROWS.set_cell(row_index, IDX_PHONE, phone, user_id=user_id)
+        if offer and not offer_no and not sheet_clients:
+            # H без таблицы не прочитать — дописываем offer позже, как отложенную пометку оффера
+            JOURNAL.defer_take(row_index, user_id, offer)
+        elif offer or offer_no:
+            # текущее значение H нужно только чтобы дописать offer
+            current = (await CLIENT_ROWS.get_row(row_index))[IDX_OFFER_NO - 1] if offer else ""
+            new_h = _merge_offer_no(current, offer, offer_no)
+            if new_h != current:
+                CLIENT_ROWS.set_cell(row_index, IDX_OFFER_NO, new_h, user_id=user_id)
+                OFFER_STATUS.invalidate(row_index)
+
+        logger.info(f"Обновлена строка {row_index} для user {user_id}")
         return True
     except Exception as e:
         logger.error(f"Ошибка при update_client: {e}")
         logger.error(traceback.format_exc())
         return False
 
+class SheetLogWriter:
+    """
+    Буферизованная запись в лист 'Логи от бота'.
+    Строки копятся в ограниченной очереди и уходят одним append_rows
+    раз в flush_interval секунд или как только набралось batch_size строк.
+    Каждая строка сначала пишется в журнал (JOURNAL) и подтверждается после записи в Google.
+    Если очередь переполнена — строка остаётся только в журнале (spilled) и возвращается в очередь,
+    когда место освободится (respool); без журнала — отбрасывается. Обработчики никогда не ждут запись лога.
+    Пачку, отклонённую Google (4xx), отправляем частями (делим пополам), а строки, которые лист не принимает,
+    отбрасываем (в лог и метрику) — иначе одна такая строка навсегда остановила бы запись логов.
+    """
+    def __init__(self, flush_interval: float, batch_size: int, max_queue: int):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._retry: list[tuple] = []     # пачка (seq, строка), которую не удалось записать — отправим первой
+        self._recovered: list[tuple] = [] # строки из журнала прошлого запуска: перед отправкой — сверка с листом
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self.dropped = 0
+        self.rejected = 0
+        self.spilled: set[int] = set()    # seq строк, которые есть только в журнале
+
+    def put(self, row: list, seq: int | None = None) -> bool:
+        if seq is None:
+            seq = JOURNAL.append("log", row=row)
+        if self.spilled and seq is not None:
+            # раньше вытесненные строки должны уйти первыми — эта встанет за ними
+            self.spilled.add(seq)
+            return True
+        try:
+            self._queue.put_nowait((seq, row))
+        except asyncio.QueueFull:
+            self._wakeup.set()
+            if seq is not None:
+                self.spilled.add(seq)
+                return True
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Очередь логов переполнена, отброшено строк: {self.dropped}")
+            return False
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def put_recovered(self, items: list[tuple]):
+        """Строки (seq, строка) из журнала прошлого запуска — уйдут перед всеми накопленными"""
+        self._recovered.extend(items)
+        if items:
+            self._wakeup.set()
+
+    async def respool(self):
+        """Возвращает вытесненные в журнал строки в очередь, пока в ней есть место"""
+        room = self._queue.maxsize - self._queue.qsize()
+        if not self.spilled or room <= 0:
+            return
+        seqs = sorted(self.spilled)[:room]
+        for rec in await JOURNAL.load(seqs):
+            self._queue.put_nowait((rec["seq"], rec["row"]))
+        self.spilled.difference_update(seqs)
+        self._wakeup.set()
+
+    def backlog(self) -> int:
+        return self._queue.qsize() + len(self._retry) + len(self._recovered) + len(self.spilled)
+
+    async def flush(self) -> bool:
+        """Сбрасывает всё накопленное. Возвращает False, если запись в Google не удалась"""
+        async with self._flush_lock:
+            while self._recovered or self._retry or not self._queue.empty():
+                if not sheet_logs:
+                    # хранилище ещё подключается (_connect_storage повторяет попытки) — строки ждут в журнале
+                    return False
+                if self._recovered:
+                    # запись могла пройти до падения, а подтверждение в журнал — нет: такие строки не повторяем
+                    recovered, self._recovered = self._recovered, []
+                    skip = await _count_already_logged([row for _, row in recovered])
+                    JOURNAL.ack([seq for seq, _ in recovered[:skip]])
+                    self._retry = recovered[skip:] + self._retry
+                    if skip:
+                        logger.info(f"Журнал: строк логов уже в таблице: {skip}")
+                    continue
+                batch = self._retry
+                self._retry = []
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                done = []
+                try:
+                    await self._append(batch, done)
+                except Exception as e:
+                    logger.error(f"Ошибка записи логов: {e}")
+                    logger.error(traceback.format_exc())
+                    # части пачки, уже добавленные в лист, не повторяем
+                    rest = batch[len(done):]
+                    status = _sheets_error_status(e)
+                    if status is None or status >= 500:
+                        # запрос мог дойти до таблицы — перед повтором сверим конец листа, как после падения
+                        self._recovered = rest + self._recovered
+                    else:
+                        self._retry = rest
+                    return False
+            return True
+
+    async def _append(self, batch: list, done: list):
+        """append_rows пачки (seq, строка); отклонённую Google (4xx) — по половинам. Обработанные — в done"""
+        try:
+            await sheets_call(sheet_logs.append_rows, [row for _, row in batch],
+                              value_input_option="USER_ENTERED", op="write", priority=PRIO_LOG, retry_5xx=False)
+        except Exception as e:
+            if not _sheets_error_permanent(e):
+                raise
+            if len(batch) == 1:
+                self._reject(batch[0], e)
+                done.extend(batch)
+                return
+            logger.error(f"Google отклонил пачку логов ({len(batch)} строк, {_sheets_error_status(e)}): делим пачку")
+            mid = len(batch) // 2
+            await self._append(batch[:mid], done)
+            await self._append(batch[mid:], done)
+            return
+        logger.info(f"✅ Логи добавлены: {len(batch)} строк")
+        JOURNAL.ack([seq for seq, _ in batch if seq is not None])
+        done.extend(batch)
+
+    def _reject(self, item: tuple, e: Exception):
+        """Строку лист не принимает — убираем её из журнала, чтобы не повторять вечно"""
+        seq, row = item
+        self.rejected += 1
+        METRICS.inc("bot_log_rows_rejected_total")
+        logger.error(f"Строка лога отклонена Google и отброшена: {e}; строка: {row}")
+        if seq is not None:
+            JOURNAL.ack([seq])
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновый цикл и дописывает остаток"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+LOG_WRITER = SheetLogWriter(LOG_FLUSH_INTERVAL_SEC, LOG_BATCH_SIZE, LOG_QUEUE_MAX)
+
+def enqueue_log(user: types.User, event_type: str, content: str) -> bool:
+    """Кладёт строку лога в буфер LOG_WRITER, без обращения к Google"""
+    now = datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S")
+    row = [
+        now,
+        str(user.id),
+        user.username or "",
+        user.first_name or "",
+        user.last_name or "",
+        event_type,
+        (content or "")[:300]
+    ]
+    return LOG_WRITER.put(row)
+
 async def log_event(user: types.User, event_type: str, content: str):
-    """Запись в лист 'Логи от бота'"""
-    if not sheet_logs:
-        logger.error("❌ sheet_logs не инициализирован")
-        return False
+    """Запись в лист 'Логи от бота' (через буфер, запись в Google — пачками в фоне)"""
     try:
-        now = datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S")
-        row = [
-            now,
-            str(user.id),
-            user.username or "",
-            user.first_name or "",
-            user.last_name or "",
-            event_type,
-            content[:300]
-        ]
-        await run_in_executor(lambda: sheet_logs.append_row(row, value_input_option="USER_ENTERED"))
-        logger.info(f"✅ Лог добавлен: {event_type} для {user.id}")
-        return True
+        return enqueue_log(user, event_type, content)
     except Exception as e:
         logger.error(f"Ошибка log_event: {e}")
         logger.error(traceback.format_exc())
         return False
 
+async def _count_already_logged(rows: list) -> int:
+    """
+    Сколько первых строк из rows уже есть в конце листа логов: запись прошла, а подтверждение в журнал
+    не успело (падение между ними). Такие строки при восстановлении не дописываем второй раз.
+    """
+    if not rows or not sheet_logs:
+        return 0
+    try:
+        last_row = len(await sheets_read(sheet_logs.col_values, 1, priority=PRIO_BACKGROUND))
+        k = min(len(rows), last_row - 1)
+        if k <= 0:
+            return 0
+        last_col = rowcol_to_a1(1, max(len(r) for r in rows)).rstrip("0123456789")
+        result = await sheets_read(sheet_logs.batch_get, [f"A{last_row - k + 1}:{last_col}{last_row}"],
+                                   priority=PRIO_BACKGROUND)
+        tail = [_trim_row([str(v).strip() for v in r]) for r in (result[0] if result else [])]
+        wanted = [_trim_row([str(v).strip() for v in r]) for r in rows]
+        for n in range(min(len(tail), len(wanted)), 0, -1):
+            if tail[-n:] == wanted[:n]:
+                return n
+        return 0
+    except Exception as e:
+        # не смогли сверить — лучше повтор строки лога, чем потеря
+        logger.error(f"Журнал: не удалось сверить логи с таблицей: {e}")
+        return 0
+
+CANCEL_PENDING_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_pending")]
+])
+BACK_TO_CATEGORIES_ROW = [InlineKeyboardButton(text="◀️ Вернуться", callback_data="back_to_categories")]
+
+class CatalogRender:
+    """
+    Неизменяемый кэш отрисовки каталога: клавиатуры категорий, статичные тексты и кнопки офферов.
+    Строится целиком в load_offers_from_sheet и заменяется целиком при перезагрузке (version растёт),
+    поэтому на запрос остаётся только фильтрация уже взятых пользователем офферов.
+    """
+    def __init__(self, offers_by_category: dict, offers_by_id: dict, version: int):
+        self.version = version
+        categories = list(offers_by_category.keys())
+        category_rows = [
+            [InlineKeyboardButton(text=f"📂 {cat}", callback_data=f"category:{cat}")]
+            for cat in categories
+        ]
+        # клавиатура главного меню (с «Мои офферы») и без неё — для возврата после отмены
+        self.categories_kb = InlineKeyboardMarkup(
+            inline_keyboard=category_rows + [[InlineKeyboardButton(text="📋 Мои офферы", callback_data="my_offers")]]
+        )
+        self.categories_kb_plain = InlineKeyboardMarkup(inline_keyboard=category_rows)
+        # заготовка страницы категории: заголовок с подстановкой номера страницы
+        self.page_header = MappingProxyType({
+            cat: f"Категория: {cat}\nСтраница {{page}}/{{total_pages}}\nВыберите оффер:"
+            for cat in categories
+        })
+
+        offer_button, my_offer_button = {}, {}
+        select_prompt, code_incorrect, code_ok, code_ok_kb, info_text, info_kb = {}, {}, {}, {}, {}, {}
+        inline_article = {}
+        for offer_id, offer in offers_by_id.items():
+            offer_button[offer_id] = InlineKeyboardButton(
+                text=f"{offer_id}. {offer.name}", callback_data=f"offer_select:{offer_id}"
+            )
+            my_offer_button[offer_id] = InlineKeyboardButton(
+                text=f"{offer_id}. {offer.name}", callback_data=f"my_offer_info:{offer_id}"
+            )
+            select_prompt[offer_id] = (
+                f"Вы выбрали оффер {offer_id} — {offer.name}\n\n"
+                f"Введите код, полученный от оператора или нажми ❌ Отмена для возвращения.\n\n"
+                f"Вы получите {offer.price} за выполнение.\n\n"
+                f"Инструкция для выполнения:\n{offer.text}."
+            )
+            code_incorrect[offer_id] = (
+                f"Код неверный. Попробуйте ещё раз или нажмите ❌ Отмена.\n\nОффер: {offer_id} — {offer.name}"
+            )
+            code_ok[offer_id] = (
+                f"✅ Код верный! Вот ссылка на оффер:\n{offer.link}\n\n"
+                f"Вы получите {offer.price} за выполнение.\n\n"
+                f"Инструкция для выполнения:\n{offer.text}."
+            )
+            code_ok_kb[offer_id] = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="◀️ Вернуться к офферам", callback_data=f"offers_page:{offer.category}:1")],
+                [InlineKeyboardButton(text="⬅️ К категориям", callback_data="back_to_categories")]
+            ])
+            info_text[offer_id] = (
+                f"📌 <b>{offer.name}</b>\n\n"
+                f"Ссылка: {offer.link}\n\n"
+                f"Оплата: {offer.price}\n\n"
+                f"Инструкция:\n {offer.text}\n\n"
+            )
+            rows = []
+            if offer.link:
+                rows.append([InlineKeyboardButton(text="🔗 Перейти по ссылке", url=offer.link)])
+            rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="my_offers")])
+            info_kb[offer_id] = InlineKeyboardMarkup(inline_keyboard=rows)
+            inline_article[offer_id] = InlineQueryResultArticle(
+                id=f"offer:{offer_id}",
+                title=f"{offer_id}. {offer.name}",
+                description=f"{offer.category} · {offer.price}",
+                input_message_content=InputTextMessageContent(
+                    message_text=f"📌 <b>{html.escape(offer.name)}</b>\n"
+                                 f"{html.escape(offer.category)}\nОплата: {html.escape(offer.price)}",
+                    parse_mode="HTML",
+                ),
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                    InlineKeyboardButton(text="Взять оффер", callback_data=f"offer_select:{offer_id}")
+                ]]),
+            )
+
+        self.offer_button = MappingProxyType(offer_button)
+        self.my_offer_button = MappingProxyType(my_offer_button)
+        self.select_prompt = MappingProxyType(select_prompt)
+        self.code_incorrect = MappingProxyType(code_incorrect)
+        self.code_ok = MappingProxyType(code_ok)
+        self.code_ok_kb = MappingProxyType(code_ok_kb)
+        self.info_text = MappingProxyType(info_text)
+        self.info_kb = MappingProxyType(info_kb)
+        self.inline_article = MappingProxyType(inline_article)
+
+CATALOG_VERSION = 0
+CATALOG_RENDER = CatalogRender({}, {}, CATALOG_VERSION)
+
 def _find_col_index_by_keywords(headers, keywords):
     """Возвращает индекс колонки (1-based) в headers, содержащий одно из keywords. None если не найдено."""
     for i, h in enumerate(headers, start=1):
@@ -294,99 +3245,337 @@ def _find_col_index_by_keywords(headers, keywords):
                 return i
     return None
 
-async def load_offers_from_sheet():
-    global OFFERS, OFFERS_BY_CATEGORY, OFFERS_BY_ID, sheet_offers
-    if not sheet_offers:
-        logger.error("sheet_offers не инициализирован")
-        return False
+class Offer:
+    """
+    Оффер из листа 'Офферы'. Неизменяемая запись со __slots__:
+    idx — плотный номер в каталоге (0..N-1, по номеру оффера) и номер бита в масках статусов,
+    num — номер оффера числом (или None),
+    col — колонка чекбокса в листе клиентов (или None). Всё разобрано один раз при сборке снимка.
+    """
+    __slots__ = ("idx", "id", "num", "category", "name", "link", "price", "text", "code", "code_key", "row", "col")
 
-    try:
-        values = sheet_offers.get_all_values()
-        if not values or len(values) < 2:
-            logger.warning("Лист 'Офферы' пуст или нет данных")
-            OFFERS, OFFERS_BY_CATEGORY, OFFERS_BY_ID = {}, {}, {}
-            return False
+    def __init__(self, idx: int, offer_id: str, category: str, name: str, link: str, price: str, text: str,
+                 code: str, row: int, col: int | None):
+        for slot, value in (("idx", idx), ("id", offer_id), ("num", int(offer_id) if offer_id.isdigit() else None),
+                            ("category", category), ("name", name), ("link", link), ("price", price),
+                            ("text", text), ("code", code), ("code_key", code.strip().lower()),
+                            ("row", row), ("col", col)):
+            object.__setattr__(self, slot, value)
 
-        header = values[0]
-        rows = values[1:]
+    def __setattr__(self, name, value):
+        raise AttributeError("Offer неизменяем — каталог пересобирается целиком")
 
-        OFFERS = {}
-        OFFERS_BY_CATEGORY = {}
-        OFFERS_BY_ID = {}
+    def __repr__(self):
+        return f"Offer({self.id!r}, {self.name!r})"
 
-        for idx, row in enumerate(rows, start=2):
-            if not row or not row[0].strip():
-                continue
+def _parse_offers(values, col_map: dict):
+    """
+    Разбирает лист 'Офферы': (офферы по номеру, {категория: офферы по номеру}, {id: оффер}).
+    Глобальные переменные не трогает.
+    """
+    parsed: dict[str, tuple] = {}     # id -> поля; при повторе номера побеждает последняя строка
+    for row_no, row in enumerate(values[1:], start=2):
+        if not row or not row[0].strip():
+            continue
+        row = _pad_row(list(row), max(12, len(row)))
+        offer_id = row[0].strip()                       # № оффера (A)
+        category = row[1].strip() or "Без категории"    # Категория (B)
+        # Название (D), Ссылка (I), Заплатим (J), Требуемые действия (K), Код (L)
+        parsed.pop(offer_id, None)
+        parsed[offer_id] = (category, row[3].strip(), row[8].strip(), row[9].strip(),
+                            row[10].strip(), row[11].strip(), row_no)
+
+    # idx раздаётся по номеру оффера (нечисловые номера — после): тогда возрастание битов в масках
+    # статусов (UserOfferStatus) совпадает с порядком выдачи и страницу можно брать прямо из маски
+    offers = tuple(
+        Offer(idx, offer_id, category, name, link, price, text, code, row_no,
+              col_map.get(int(offer_id)) if offer_id.isdigit() else None)
+        for idx, (offer_id, (category, name, link, price, text, code, row_no))
+        in enumerate(sorted(parsed.items(), key=lambda item: _offer_sort_key(item[0])))
+    )
+    offers_by_id = {o.id: o for o in offers}
+    # категории — в порядке первого появления в листе, офферы внутри — по idx
+    offers_by_category: dict[str, list] = {category: [] for category, *_ in parsed.values()}
+    for o in offers:
+        offers_by_category[o.category].append(o)
+    offers_by_category = {cat: tuple(lst) for cat, lst in offers_by_category.items()}
+    return offers, offers_by_category, offers_by_id
+
+def _parse_client_offer_col_map(header):
+    """offer_id (int) -> column_index по шапке листа клиентов: колонки, где в шапке просто число (1,2,3...)"""
+    col_map = {}
+    for i, h in enumerate(header or [], start=1):
+        if not h:
+            continue
+        hs = h.strip()
+        # если значение точно число (например "1" или "10"), мапим
+        if hs.isdigit():
+            col_map[int(hs)] = i
+    return col_map
 
-            offer_id = row[0].strip()             # № оффера (A)
-            category = row[1].strip()             # Категория (B)
-            name = row[3].strip()                 # Название (D)
-            link = row[8].strip()                 # Ссылка (I)
-            price = row[9].strip()                # Заплатим (J)
-            text = row[10].strip()                # Требуемые действия (подробно) (K)
-            code = row[11].strip()                # Код (L)
-
-            if not category:
-                category = "Без категории"
-
-            # сохраняем в OFFERS
-            if category not in OFFERS:
-                OFFERS[category] = {}
-            OFFERS[category][offer_id] = {
-                "name": name,
-                "link": link,
-                "code": code
-            }
-
-            # создаём универсальный объект
-            offer_obj = {
-                "id": offer_id,
-                "category": category,
-                "name": name,
-                "link": link,
-                "price": price,
-                "text": text,
-                "code": code,
-                "row": idx
-            }
-
-            OFFERS_BY_ID[offer_id] = offer_obj
-            OFFERS_BY_CATEGORY.setdefault(category, []).append(offer_obj)
-
-        # сортируем офферы в каждой категории
-        for k, lst in OFFERS_BY_CATEGORY.items():
-            try:
-                lst.sort(key=lambda x: int(x["id"]))
-            except:
-                lst.sort(key=lambda x: x["id"])
+def _offer_sort_key(offer_id: str):
+    return (0, int(offer_id), "") if offer_id.isdigit() else (1, 0, offer_id)
 
-        logger.info(f"Офферы загружены: {len(OFFERS_BY_ID)} шт. в {len(OFFERS_BY_CATEGORY)} категориях")
-        return True
+_SEARCH_JUNK = re.compile(r"[^\w]+")
 
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке офферов: {e}")
-        logger.error(traceback.format_exc())
+def _search_normalize(text: str) -> str:
+    return _SEARCH_JUNK.sub(" ", (text or "").lower().replace("ё", "е")).strip()
+
+def _trigrams(text: str) -> set:
+    grams = set()
+    for word in text.split():
+        for i in range(len(word) - 2):
+            grams.add(word[i:i + 3])
+    return grams
+
+def _short_prefixes(text: str) -> set:
+    """Префиксы слов длиной 1-2 — для запросов короче триграммы"""
+    return {word[:n] for word in text.split() for n in (1, 2) if len(word) >= n}
+
+class _Postings:
+    """
+    Посписочные множества (ключ -> frozenset(offer_id)), общие с прошлыми версиями индекса:
+    версия хранит только ключи, изменённые в ней (own; пустое множество — ключ удалён), остальное берёт у base.
+    Цепочка сливается в один словарь, когда изменений в ней набралось не меньше, чем ключей в основании,
+    или слоёв стало больше MAX_DEPTH: перезагрузка стоит O(изменений), поиск проходит не больше MAX_DEPTH слоёв.
+    """
+    __slots__ = ("own", "base", "depth", "changes", "root_size")
+    MAX_DEPTH = 8
+    EMPTY = frozenset()
+
+    def __init__(self, own: dict, base: "_Postings | None" = None):
+        self.own = own
+        self.base = base
+        self.depth = 0 if base is None else base.depth + 1
+        self.changes = 0 if base is None else base.changes + len(own)
+        self.root_size = len(own) if base is None else base.root_size
+
+    def get(self, key) -> frozenset:
+        layer = self
+        while layer is not None:
+            found = layer.own.get(key)
+            if found is not None:
+                return found
+            layer = layer.base
+        return self.EMPTY
+
+    def derive(self, updates: dict) -> "_Postings":
+        """Новая версия: updates — ключ -> новое множество (пустое — удалить ключ)"""
+        if not updates:
+            return self
+        layer = _Postings(updates, self)
+        if layer.depth > self.MAX_DEPTH or layer.changes >= layer.root_size:
+            return _Postings(layer.flat())
+        return layer
+
+    def flat(self) -> dict:
+        layers = []
+        layer = self
+        while layer is not None:
+            layers.append(layer.own)
+            layer = layer.base
+        merged = {}
+        for own in reversed(layers):
+            merged.update(own)
+        return {key: value for key, value in merged.items() if value}
+
+class OfferSearchIndex:
+    """
+    Поиск офферов по номеру, названию и категории для inline-режима.
+    Индекс по триграммам слов (и префиксам из 1-2 символов для коротких запросов), неизменяемый:
+    при перезагрузке каталога пересчитываются только офферы, у которых поменялся текст, а посписочные
+    множества новой версии хранят лишь затронутые ими ключи — остальные общие со старой (_Postings).
+    """
+    __slots__ = ("docs", "trigrams", "prefixes", "order")
+
+    def __init__(self, docs: dict, trigrams: _Postings, prefixes: _Postings, order: dict):
+        self.docs = docs            # offer_id -> нормализованный текст
+        self.trigrams = trigrams    # триграмма -> frozenset(offer_id)
+        self.prefixes = prefixes    # префикс слова (1-2 символа) -> frozenset(offer_id)
+        self.order = order          # offer_id -> позиция в выдаче по умолчанию
+
+    @classmethod
+    def build(cls, offers_by_id: dict, prev: "OfferSearchIndex | None" = None) -> "OfferSearchIndex":
+        docs = {
+            oid: _search_normalize(f"{oid} {offer.name} {offer.category}")
+            for oid, offer in offers_by_id.items()
+        }
+        if prev is None:
+            prev = cls({}, _Postings({}), _Postings({}), {})
+        trigrams, prefixes = {}, {}    # только изменённые ключи
+        changed = [oid for oid, text in docs.items() if prev.docs.get(oid) != text]
+        removed = [oid for oid in prev.docs if oid not in docs]
+
+        def unlink(postings: _Postings, updates: dict, keys, oid):
+            for key in keys:
+                current = updates[key] if key in updates else postings.get(key)
+                updates[key] = current - {oid}
+
+        def link(postings: _Postings, updates: dict, keys, oid):
+            for key in keys:
+                current = updates[key] if key in updates else postings.get(key)
+                updates[key] = current | {oid}
+
+        for oid in changed + removed:
+            old = prev.docs.get(oid)
+            if old is not None:
+                unlink(prev.trigrams, trigrams, _trigrams(old), oid)
+                unlink(prev.prefixes, prefixes, _short_prefixes(old), oid)
+        for oid in changed:
+            link(prev.trigrams, trigrams, _trigrams(docs[oid]), oid)
+            link(prev.prefixes, prefixes, _short_prefixes(docs[oid]), oid)
+
+        # по умолчанию — в порядке листа "Офферы"
+        return cls(docs, prev.trigrams.derive(trigrams), prev.prefixes.derive(prefixes),
+                   {oid: offer.idx for oid, offer in offers_by_id.items()})
+
+    def search(self, query: str) -> list[str]:
+        """id офферов по запросу: точное совпадение номера, затем совпадение с начала слова, затем остальные"""
+        tokens = _search_normalize(query).split()
+        if not tokens:
+            return sorted(self.docs, key=self.order.__getitem__)
+        candidates = None
+        for tok in tokens:
+            if len(tok) < 3:
+                found = self.prefixes.get(tok)
+            else:
+                grams = _trigrams(tok)
+                found = None
+                for gram in grams:
+                    posting = self.trigrams.get(gram)
+                    found = posting if found is None else found & posting
+                    if not found:
+                        break
+                # триграммы дают кандидатов, подстрока — окончательная проверка
+                found = {oid for oid in found or () if tok in self.docs[oid]}
+            candidates = set(found) if candidates is None else candidates & found
+            if not candidates:
+                return []
+        first = " " + tokens[0]
+
+        def rank(oid):
+            if oid == tokens[0]:
+                return (0, self.order[oid])
+            return (1 if first in " " + self.docs[oid] else 2, self.order[oid])
+
+        return sorted(candidates, key=rank)
+
+class CatalogSnapshot:
+    """
+    Снимок каталога: офферы (Offer, по номеру — offers[o.idx] is o), они же по категориям и по id,
+    маски категорий (бит o.idx), карта колонок листа клиентов и кэш отрисовки одной версии.
+    Собирается целиком в стороне и подменяется одним присваиванием (_install_catalog),
+    так что обработчики никогда не видят полусобранный каталог. Все коллекции — только для чтения.
+    """
+    def __init__(self, offers: tuple, offers_by_category: dict, offers_by_id: dict, col_map: dict, version: int,
+                 content_hash: str, source_values=None, source_header=None, search: OfferSearchIndex | None = None):
+        self.offers = tuple(offers)
+        self.offers_by_category = MappingProxyType(dict(offers_by_category))
+        self.offers_by_id = MappingProxyType(dict(offers_by_id))
+        self.col_map = MappingProxyType(dict(col_map))
+        # категория -> маска её офферов: доступные = category_mask & ~taken
+        self.category_mask = MappingProxyType({
+            cat: sum(1 << o.idx for o in lst) for cat, lst in self.offers_by_category.items()
+        })
+        # (бит оффера, колонка) для разбора статусов из строки клиента — только офферы каталога
+        self.status_cols = tuple((1 << o.idx, o.col) for o in self.offers if o.col)
+        self.version = version
+        self.content_hash = content_hash
+        # исходные данные листа — по ним снимок можно собрать заново в другом процессе
+        self.source_values = source_values or []
+        self.source_header = source_header or []
+        self.render = CatalogRender(offers_by_category, offers_by_id, version)
+        self.search = search if search is not None else OfferSearchIndex.build(offers_by_id)
+
+CATALOG = CatalogSnapshot((), {}, {}, {}, CATALOG_VERSION, "")
+_catalog_reload_lock = asyncio.Lock()
+# вызываются после каждой подмены каталога (например, рассылка снимка воркерам)
+CATALOG_LISTENERS: list = []
+
+def build_catalog_snapshot(values, header, version: int, content_hash: str | None = None,
+                           prev_search: OfferSearchIndex | None = None) -> CatalogSnapshot:
+    """
+    Собирает снимок каталога из содержимого листа 'Офферы' и шапки листа клиентов.
+    prev_search — поисковый индекс прошлого снимка: из него переиспользуется всё, что не поменялось.
+    """
+    if content_hash is None:
+        content_hash = _catalog_hash(values, header)
+    col_map = _parse_client_offer_col_map(header)
+    if not values or len(values) < 2:
+        return CatalogSnapshot((), {}, {}, col_map, version, content_hash, values, header)
+    offers, offers_by_category, offers_by_id = _parse_offers(values, col_map)
+    search = OfferSearchIndex.build(offers_by_id, prev_search)
+    return CatalogSnapshot(offers, offers_by_category, offers_by_id, col_map, version, content_hash,
+                           values, header, search)
+
+def _catalog_hash(values, header) -> str:
+    return hashlib.sha1(json.dumps([values, header], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _install_catalog(snapshot: CatalogSnapshot):
+    """Атомарная подмена каталога (без await внутри — в asyncio это одна неделимая операция)"""
+    global CATALOG, CLIENT_OFFER_COL_MAP, CATALOG_RENDER, CATALOG_VERSION
+    CATALOG = snapshot
+    CLIENT_OFFER_COL_MAP = snapshot.col_map
+    CATALOG_RENDER = snapshot.render
+    CATALOG_VERSION = snapshot.version
+    # статусы в OFFER_STATUS — маски по idx старой версии: пересоберутся при обращении (по version)
+    for listener in CATALOG_LISTENERS:
+        try:
+            listener(snapshot)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика смены каталога: {e}")
+
+async def load_offers_from_sheet(force: bool = True):
+    """
+    Загружает лист 'Офферы' и шапку листа клиентов (вне event loop), собирает новый снимок
+    каталога и атомарно подменяет текущий. Если содержимое не изменилось и force=False — ничего не пересобирает.
+    """
+    if not sheet_offers:
+        logger.error("sheet_offers не инициализирован")
         return False
 
+    async with _catalog_reload_lock:
+        try:
+            values = await sheets_read(sheet_offers.get_all_values, priority=PRIO_BACKGROUND)
+            header = await sheets_read(sheet_clients.row_values, 1, priority=PRIO_BACKGROUND) if sheet_clients else []
+            content_hash = _catalog_hash(values, header)
+            if not force and content_hash == CATALOG.content_hash:
+                logger.info("Офферы не изменились, пересборка не нужна")
+                return True
+
+            # разбор и сборка клавиатур — тоже вне event loop
+            snapshot = await run_in_executor(
+                build_catalog_snapshot, values, header, CATALOG_VERSION + 1, content_hash, CATALOG.search
+            )
+            _install_catalog(snapshot)
+            if not snapshot.offers_by_id:
+                logger.warning("Лист 'Офферы' пуст или нет данных")
+                return False
+            logger.info(f"Офферы загружены: {len(snapshot.offers)} шт. в {len(snapshot.offers_by_category)} категориях (версия {CATALOG_VERSION})")
+            logger.info(f"Client offer col map built: {CLIENT_OFFER_COL_MAP}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке офферов: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
 async def build_client_offer_col_map():
     """Считает маппинг: offer_id (int) -> column_index (в листе 'Клиенты - Партнерки'),
-       если в шапке есть колонки с номерами офферов.
+       если в шапке есть колонки с номерами офферов. Каталог офферов при этом не перечитывается.
     """
-    global CLIENT_OFFER_COL_MAP, sheet_clients
-    CLIENT_OFFER_COL_MAP = {}
     if not sheet_clients:
         logger.error("sheet_clients не инициализирован")
         return {}
     try:
-        header = await run_in_executor(sheet_clients.row_values, 1)
-        # header is list of header values; ищем ячейки, которые являются числом (1,2,3...)
-        for i, h in enumerate(header, start=1):
-            if not h:
-                continue
-            hs = h.strip()
-            # если значение точно число (например "1" или "10"), мапим
-            if hs.isdigit():
-                CLIENT_OFFER_COL_MAP[int(hs)] = i
+        header = await sheets_read(sheet_clients.row_values, 1, priority=PRIO_BACKGROUND)
+        col_map = _parse_client_offer_col_map(header)
+        if col_map != CLIENT_OFFER_COL_MAP:
+            # колонки зашиты в записи Offer — пересобираем снимок из тех же данных листа 'Офферы'
+            cur = CATALOG
+            _install_catalog(await run_in_executor(
+                build_catalog_snapshot, cur.source_values, header, cur.version + 1, None, cur.search
+            ))
         logger.info(f"Client offer col map built: {CLIENT_OFFER_COL_MAP}")
         return CLIENT_OFFER_COL_MAP
     except Exception as e:
@@ -394,85 +3583,257 @@ async def build_client_offer_col_map():
         logger.error(traceback.format_exc())
         return {}
 
+async def catalog_refresh_loop(interval: int = CATALOG_REFRESH_SEC):
+    """Фоновая перезагрузка каталога: пересобирается только если содержимое листа изменилось"""
+    while True:
+        await asyncio.sleep(interval)
+        await load_offers_from_sheet(force=False)
+
+class WarmStartSnapshot:
+    """
+    Снимок для быстрого старта: исходные данные каталога (лист 'Офферы' и шапка листа клиентов —
+    из них заново собираются CATALOG и CLIENT_OFFER_COL_MAP) и индекс user_id -> строка (с признаком телефона).
+    Формат: заголовок (magic, версия формата, crc32) + zlib(marshal), строки индекса — массивом uint32;
+    поднимается за миллисекунды. Снимок другой версии формата, другого источника данных или битый — игнорируется.
+    Пишет один процесс (writable), атомарно: временный файл + os.replace.
+    """
+    MAGIC = b"BWS"
+    FORMAT = 2   # 2: признак телефона в индексе клиентов
+    HEADER = struct.Struct("<3sBI")
+
+    def __init__(self, path: str, source: str, save_delay: float):
+        self.path = path
+        self.source = source
+        self.save_delay = save_delay
+        self.writable = True
+        self._saved_catalog_hash: str | None = None
+        self._save_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def _encode(self, catalog_src, index) -> bytes:
+        user_ids, rows, last_row, phones = index
+        body = zlib.compress(marshal.dumps({
+            "source": self.source,
+            "saved_at": time.time(),
+            "catalog": catalog_src,          # [values, header, version, content_hash] или None
+            "user_ids": user_ids,
+            "rows": array.array("I", rows).tobytes(),
+            "last_row": last_row,
+            "phones": phones,
+        }))
+        return self.HEADER.pack(self.MAGIC, self.FORMAT, zlib.crc32(body)) + body
+
+    def _decode(self, data: bytes) -> dict | None:
+        if len(data) < self.HEADER.size:
+            return None
+        magic, fmt, crc = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC or fmt != self.FORMAT:
+            logger.warning(f"Снимок быстрого старта другого формата ({magic!r} v{fmt}) — пропускаем")
+            return None
+        body = data[self.HEADER.size:]
+        if zlib.crc32(body) != crc:
+            logger.warning("Снимок быстрого старта повреждён (crc) — пропускаем")
+            return None
+        payload = marshal.loads(zlib.decompress(body))
+        if payload.get("source") != self.source:
+            logger.warning("Снимок быстрого старта снят с другого источника данных — пропускаем")
+            return None
+        rows = array.array("I")
+        rows.frombytes(payload["rows"])
+        payload["rows"] = rows
+        return payload
+
+    def _write(self, catalog_src, index) -> int:
+        data = self._encode(catalog_src, index)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return len(data)
+
+    def restore(self, catalog: bool = True, index: bool = True) -> bool:
+        """
+        Поднимает каталог и/или индекс клиентов из снимка. True — если что-то поднято.
+        Без await: вызывается и до запуска event loop (run_sharded собирает каталог до fork).
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        start = time.perf_counter()
+        try:
+            with open(self.path, "rb") as f:
+                payload = self._decode(f.read())
+            if payload is None:
+                return False
+            restored = []
+            if catalog and payload["catalog"]:
+                values, header, version, content_hash = payload["catalog"]
+                # при старте event loop ещё ничем не занят (или его ещё нет) — собираем прямо здесь
+                snapshot = build_catalog_snapshot(values, header, version, content_hash)
+                self._saved_catalog_hash = content_hash
+                _install_catalog(snapshot)
+                restored.append(f"каталог v{version} ({len(snapshot.offers)} офферов)")
+            if index and payload["user_ids"]:
+                CLIENT_ROW_INDEX.load_snapshot(payload["user_ids"], payload["rows"], payload["last_row"],
+                                                payload["phones"])
+                restored.append(f"индекс клиентов ({len(CLIENT_ROW_INDEX)} записей)")
+            if not restored:
+                return False
+            age = time.time() - payload["saved_at"]
+            logger.info(f"Быстрый старт: {', '.join(restored)} из снимка {age:.0f} с назад "
+                        f"за {(time.perf_counter() - start) * 1000:.1f} мс")
+            return True
+        except Exception as e:
+            logger.error(f"Не удалось загрузить снимок быстрого старта: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    async def save(self) -> bool:
+        """Сохраняет текущие каталог и индекс клиентов (кодирование и запись — вне event loop)"""
+        if not self.path or not self.writable:
+            return False
+        async with self._lock:
+            catalog = CATALOG
+            catalog_src = None
+            if catalog.content_hash:
+                catalog_src = [catalog.source_values, catalog.source_header, catalog.version, catalog.content_hash]
+            index = CLIENT_ROW_INDEX.snapshot() if CLIENT_ROW_INDEX.ready else ([], [], 0, b"")
+            if catalog_src is None and not index[0]:
+                return False
+            try:
+                size = await run_in_executor(self._write, catalog_src, index)
+                self._saved_catalog_hash = catalog.content_hash
+                logger.info(f"Снимок быстрого старта сохранён: {size} байт, {len(index[0])} клиентов, "
+                            f"каталог v{catalog.version}")
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения снимка быстрого старта: {e}")
+                logger.error(traceback.format_exc())
+                return False
+
+    def request_save(self):
+        """Сохранение через save_delay секунд: несколько изменений подряд — одна запись файла"""
+        if not self.path or not self.writable:
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_later(), context=contextvars.Context())
+
+    async def _save_later(self):
+        await asyncio.sleep(self.save_delay)
+        await self.save()
+
+    def on_catalog(self, snapshot: CatalogSnapshot):
+        if snapshot.content_hash != self._saved_catalog_hash:
+            self.request_save()
+
+WARM_START = WarmStartSnapshot(
+    WARM_START_PATH,
+    f"{STORAGE_BACKEND}:{SQLITE_PATH if STORAGE_BACKEND == SQLiteStorage.name else SPREADSHEET_URL}",
+    WARM_START_SAVE_DELAY_SEC,
+)
+
 async def _get_client_row_index(user_id: str):
     """Возвращает номер строки в sheet_clients (1-based) где в колонке B (IDX_USER_ID) содержится user_id"""
-    if not sheet_clients:
-        return None
-    try:
-        col_vals = await run_in_executor(sheet_clients.col_values, IDX_USER_ID)
-        for i, v in enumerate(col_vals, start=1):
-            if v == user_id:
-                return i
-        return None
-    except Exception as e:
-        logger.error(f"_get_client_row_index error: {e}")
-        return None
+    return await find_user_row_by_id(user_id)
 
-async def get_user_taken_offers_by_row(row_index):
-    """Возвращает set() числовых id офферов, которые отмечены для пользователя в строке row_index.
-       Смотрим: 1) поле H (IDX_OFFER_NO) — если там список '1;3;10', 2) чекбоксы по CLIENT_OFFER_COL_MAP.
+async def get_user_taken_mask(row_index, catalog=None) -> int:
+    """Маска (бит Offer.idx каталога catalog) офферов, которые отмечены для пользователя в строке row_index.
+       Смотрим: 1) поле H (IDX_OFFER_NO) — если там список '1;3;10', 2) чекбоксы по колонкам офферов.
+       Берётся из OFFER_STATUS (без запроса в Google, пока статус свежий).
     """
-    taken = set()
     if not sheet_clients:
-        return taken
+        # хранилище ещё не открыто — только то, что уже есть в кэше
+        cached = OFFER_STATUS.cached(row_index, catalog)
+        return cached.taken if cached else 0
     try:
-        row_vals = await run_in_executor(sheet_clients.row_values, row_index)
-        row_vals = _pad_row(row_vals, NUM_COLUMNS)
-        # поле H (IDX_OFFER_NO) может содержать "1;3;10"
-        raw = row_vals[IDX_OFFER_NO - 1] or ""
-        for x in raw.replace(" ", "").split(";"):
-            if x.strip().isdigit():
-                taken.add(x.strip())
-        # чекбоксы
-        if CLIENT_OFFER_COL_MAP:
-            for offer_id, col_idx in CLIENT_OFFER_COL_MAP.items():
-                try:
-                    v = row_vals[col_idx-1]
-                except:
-                    v = ""
-                v = str(v).strip().upper()
-                if v in ("SELECTED", "DONE"):   # ⚡ только занятые
-                    taken.add(str(offer_id))
-        return taken
+        status = await OFFER_STATUS.get(row_index, catalog)
+        return status.taken
     except Exception as e:
-        logger.error(f"get_user_taken_offers_by_row error: {e}")
+        logger.error(f"get_user_taken_mask error: {e}")
         logger.error(traceback.format_exc())
-        return taken
+        return 0
+
+async def get_user_taken(user_id: str, catalog=None) -> int:
+    """Маска взятых офферов клиента: по его строке в таблице, а пока строка в очереди на добавление — по ней"""
+    row_index = await _get_client_row_index(user_id)
+    if row_index:
+        return await get_user_taken_mask(row_index, catalog)
+    row_vals = CLIENT_REGISTRAR.pending_row(user_id)
+    return _parse_offer_status(row_vals, catalog).taken if row_vals is not None else 0
 
-async def mark_offer_taken_for_user(row_index, offer_id):
+async def get_user_offer_status(user_id: str, catalog=None) -> UserOfferStatus | None:
+    """Статус офферов клиента (строка в очереди на добавление — тоже); None — клиента нет"""
+    row_index = await _get_client_row_index(user_id)
+    if row_index:
+        return await OFFER_STATUS.get(row_index, catalog)
+    row_vals = CLIENT_REGISTRAR.pending_row(user_id)
+    return _parse_offer_status(row_vals, catalog) if row_vals is not None else None
+
+def _offer_taken_cells(row_vals: list, offer_id) -> list[tuple[int, str]]:
+    """Ячейки (колонка, значение), которые отмечают оффер взятым: H дополняется offer_id, чекбокс — SELECTED"""
+    already = row_vals[IDX_OFFER_NO - 1] or ""
+    parts = [p for p in [s.strip() for s in already.split(";")] if p]
+    if str(offer_id) not in parts:
+        parts.append(str(offer_id))
+    cells = [(IDX_OFFER_NO, ";".join(parts))]
+    offer = CATALOG.offers_by_id.get(str(offer_id))
+    if offer is not None and offer.col:
+        cells.append((offer.col, "SELECTED"))
+    return cells
+
+async def mark_offer_taken_for_user(row_index, offer_id, user_id: str | None = None, defer: bool = True):
     """Помечает оффер за пользователем: 
        - дописывает offer_id в H (если не было)
        - ставит чекбокс TRUE в соответствующей колонке, если она присутствует
+       Пишутся только изменённые ячейки, сама запись в таблицу — в фоне (CLIENT_ROWS).
+       Если строка клиента ещё в очереди на добавление — пометка ставится прямо в неё.
+       Если строку не прочитать (хранилище не подключено, или строку уже отправляют) — пометка откладывается
+       в журнал (JOURNAL.defer_take) и применяется позже; defer=False — это и есть повтор из журнала.
     """
+    if not row_index and user_id:
+        def patch(row):
+            for col, value in _offer_taken_cells(row, offer_id):
+                if len(row) < col:
+                    row.extend([""] * (col - len(row)))
+                row[col - 1] = value
+        if CLIENT_REGISTRAR.update_pending(user_id, patch):
+            logger.info(f"Offer {offer_id} отмечен в строке user {user_id} (в очереди на добавление)")
+            return True
     if not sheet_clients:
+        if not defer or not (row_index or user_id):
+            return False
+        # хранилище ещё не подключено — пометка ждёт в журнале и применится после подключения
+        JOURNAL.defer_take(row_index, user_id, offer_id)
+        if row_index:
+            OFFER_STATUS.on_offer_taken(row_index, offer_id)
+        logger.warning(f"Offer {offer_id} для user {user_id} отложен: хранилище не подключено")
+        return True
+    if not row_index:
+        if defer and user_id:
+            JOURNAL.defer_take(None, user_id, offer_id)
+            logger.warning(f"Offer {offer_id} для user {user_id} отложен: строка клиента ещё не добавлена")
+            return True
         return False
     try:
         # получаем текущую строку
-        row_vals = await run_in_executor(sheet_clients.row_values, row_index)
-        row_vals = _pad_row(row_vals, NUM_COLUMNS)
-
-        # обновим поле H (IDX_OFFER_NO)
-        already = row_vals[IDX_OFFER_NO - 1] or ""
-        parts = [p for p in [s.strip() for s in already.split(";")] if p]
-        if str(offer_id) not in parts:
-            parts.append(str(offer_id))
-        new_h = ";".join(parts)
-        row_vals[IDX_OFFER_NO - 1] = new_h
-
-        # если есть колонка чекбокса для этого оффера — отметим
-        if CLIENT_OFFER_COL_MAP:
-            try:
-                offer_int = int(offer_id)
-                col_idx = CLIENT_OFFER_COL_MAP.get(offer_int)
-            except:
-                col_idx = None
-            if col_idx:
-                # пометим TRUE в колонке col_idx
-                row_vals[col_idx - 1] = "SELECTED"
-
-        # обновляем всю строку A..Q
-        range_name = f"A{row_index}:GG{row_index}"
-        await run_in_executor(sheet_clients.update, range_name, [row_vals], {'valueInputOption': 'USER_ENTERED'})
+        try:
+            row_vals = await CLIENT_ROWS.get_row(row_index)
+        except Exception as e:
+            if not defer:
+                return False
+            JOURNAL.defer_take(row_index, user_id, offer_id)
+            OFFER_STATUS.on_offer_taken(row_index, offer_id)
+            logger.warning(f"Offer {offer_id} для строки {row_index} отложен: строку не прочитать ({e})")
+            return True
+
+        # поле H (IDX_OFFER_NO) и чекбокс оффера (если для него есть колонка)
+        owner = user_id or row_vals[IDX_USER_ID - 1].strip() or None
+        for col, value in _offer_taken_cells(row_vals, offer_id):
+            CLIENT_ROWS.set_cell(row_index, col, value, user_id=owner)
+
+        OFFER_STATUS.on_offer_taken(row_index, offer_id)
+
         logger.info(f"Offer {offer_id} marked for row {row_index}")
         return True
     except Exception as e:
@@ -480,14 +3841,17 @@ async def mark_offer_taken_for_user(row_index, offer_id):
         logger.error(traceback.format_exc())
         return False
 
-def _build_offers_keyboard(offers_page, category, page, total_pages):
-    """Создаёт клавиатуру для списка офферов (offers_page — список offer_obj)."""
+def _build_offers_keyboard(offers_page, category, page, total_pages, render: CatalogRender | None = None):
+    """Создаёт клавиатуру для списка офферов (offers_page — последовательность Offer). Кнопки офферов берутся из CATALOG_RENDER."""
+    render = render or CATALOG_RENDER
     buttons: list[list[InlineKeyboardButton]] = []
 
     # кнопки офферов
     for off in offers_page:
-        text = f"{off['id']}. {off['name']}"
-        buttons.append([InlineKeyboardButton(text=text, callback_data=f"offer_select:{off['id']}")])
+        btn = render.offer_button.get(off.id)
+        if btn is None:
+            btn = InlineKeyboardButton(text=f"{off.id}. {off.name}", callback_data=f"offer_select:{off.id}")
+        buttons.append([btn])
 
     # навигация
     nav_row: list[InlineKeyboardButton] = []
@@ -499,37 +3863,38 @@ def _build_offers_keyboard(offers_page, category, page, total_pages):
         buttons.append(nav_row)
 
     # кнопка возврата
-    buttons.append([InlineKeyboardButton(text="◀️ Вернуться", callback_data="back_to_categories")])
+    buttons.append(BACK_TO_CATEGORIES_ROW)
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 async def show_offers_page_for_user(user_id: int, category: str, page: int = 1):
     """Редактирует пользовательское меню, показывая страницу офферов."""
-    lst = OFFERS_BY_CATEGORY.get(category, [])
-    if not lst:
+    catalog = CATALOG
+    category_mask = catalog.category_mask.get(category, 0)
+    if not category_mask:
         await edit_user_menu(user_id, "В этой категории пока нет офферов.", None)
         return
 
-    # получаем ряд пользователя (если есть) и какие офферы уже брал
-    row_index = await _get_client_row_index(str(user_id))
-    taken = set()
-    if row_index:
-        taken = await get_user_taken_offers_by_row(row_index)
+    # какие офферы пользователь уже брал (строка может быть ещё в очереди на добавление)
+    taken = await get_user_taken(str(user_id), catalog)
 
-    # фильтруем доступные офферы
-    available = [o for o in lst if o['id'] not in taken]
+    # доступные офферы — биты категории, которых нет среди взятых
+    available = category_mask & ~taken
     if not available:
         await edit_user_menu(user_id, "❗ Все офферы в этой категории вы уже брали.", None)
         return
 
-    total = len(available)
+    total = available.bit_count()
     total_pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
     page = max(1, min(page, total_pages))
-    start = (page - 1) * PAGE_SIZE
-    page_slice = available[start:start + PAGE_SIZE]
+    page_slice = _offers_page(catalog, available, page, PAGE_SIZE)
 
     # текст и клавиатура
-    text = f"Категория: {category}\nСтраница {page}/{total_pages}\nВыберите оффер:"
-    kb = _build_offers_keyboard(page_slice, category, page, total_pages)
+    header = catalog.render.page_header.get(category)
+    if header:
+        text = header.format(page=page, total_pages=total_pages)
+    else:
+        text = f"Категория: {category}\nСтраница {page}/{total_pages}\nВыберите оффер:"
+    kb = _build_offers_keyboard(page_slice, category, page, total_pages, catalog.render)
 
     # редактируем или отправляем меню
     await edit_user_menu(user_id, text, kb)
@@ -539,29 +3904,322 @@ async def show_offers_page_for_user(user_id: int, category: str, page: int = 1):
     if info:
         info["category"] = category
         info["page"] = page
+        USER_MENU_MESSAGE[user_id] = info   # чтобы изменение попало в сохранённое состояние
 
 async def is_registered(user_id: int) -> bool:
     """Проверяет, зарегистрирован ли пользователь (есть ли номер телефона)."""
     row_index = await _get_client_row_index(str(user_id))
     if not row_index:
-        return False
+        # строка ещё в очереди на добавление — телефон смотрим в ней
+        row_vals = CLIENT_REGISTRAR.pending_row(str(user_id))
+        return bool(row_vals and row_vals[IDX_PHONE - 1].strip())
+    if not sheet_clients:
+        # хранилище ещё подключается (быстрый старт): строку не прочитать — телефон смотрим по индексу из снимка
+        return CLIENT_ROW_INDEX.has_phone(str(user_id))
 
     try:
-        row_vals = await run_in_executor(sheet_clients.row_values, row_index)
-        row_vals = _pad_row(row_vals, NUM_COLUMNS)
+        row_vals = await CLIENT_ROWS.get_row(row_index)
         phone = row_vals[IDX_PHONE - 1].strip()
         return bool(phone)
     except Exception as e:
         logger.error(f"is_registered error: {e}")
         return False
 
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_IDS
+
+class Broadcaster:
+    """
+    Рассылка о новых офферах зарегистрированным клиентам.
+    - Новые офферы — разница id между снимками каталога (копится до запуска рассылки);
+      известные id сохраняются в STATE_DB, поэтому после рестарта разница считается от прошлого запуска.
+    - Получатели идут из CLIENT_ROW_INDEX по возрастанию строки, пачками по chunk_rows:
+      на пачку — один batch_get, пропускаем незарегистрированных и тех, кто уже брал все новые офферы.
+    - Отправка — workers задач с общим темпом rate сообщений/сек и приоритетом TG_PRIO_BULK в TELEGRAM_OUTBOX,
+      так что ответы пользователям всегда идут раньше рассылки.
+    - Прогресс (курсор по строке + кому уже отправлено в текущей пачке) сохраняется в STATE_DB:
+      после падения рассылка продолжается с места остановки.
+    """
+    STORE = "broadcast"
+
+    def __init__(self, rate: float, workers: int, chunk_rows: int, db: StateDB | None):
+        self.rate = rate
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.db = db
+        self.job: dict | None = None
+        self.new_offer_ids: list[str] = []
+        self._known_offer_ids: set | None = None
+        self._task: asyncio.Task | None = None
+        self._owner = f"{os.getpid()}:{random.getrandbits(32):08x}"
+        self._booted = time.time()
+        self._last_save = 0.0
+        self._run_started = 0.0
+        self._run_sent_start = 0
+
+    # --- состояние ---
+    async def load(self):
+        if not self.db:
+            return
+        try:
+            rows = await run_in_executor(self.db.load, self.STORE)
+            saved = {key: json.loads(value) for key, value, _ in rows}
+            self.job = saved.get("job")
+            known = saved.get("known_offers")
+            if known is not None and self._known_offer_ids is None:
+                self._known_offer_ids = set(known["ids"])
+                self.new_offer_ids = known.get("pending", [])
+        except Exception as e:
+            logger.error(f"Не удалось загрузить состояние рассылки: {e}")
+            logger.error(traceback.format_exc())
+
+    async def _save(self, key: str, value: dict):
+        if not self.db:
+            return
+        try:
+            await run_in_executor(self.db.write, self.STORE, [(key, json.dumps(value, ensure_ascii=False), time.time())])
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояние рассылки: {e}")
+
+    async def save_job(self):
+        self.job["owner"] = self._owner
+        self.job["updated_at"] = time.time()
+        self._last_save = time.monotonic()
+        await self._save("job", dict(self.job, chunk_done=list(self.job["chunk_done"])))
+
+    def on_catalog(self, snapshot):
+        """Слушатель смены каталога: копит id офферов, которых не было раньше"""
+        ids = set(snapshot.offers_by_id)
+        if not ids:
+            return
+        if self._known_offer_ids is None:
+            # первая загрузка после старта без сохранённого состояния — это не "новые" офферы
+            self._known_offer_ids = ids
+        else:
+            added = ids - self._known_offer_ids
+            if not added and ids == self._known_offer_ids:
+                return
+            pending = [i for i in self.new_offer_ids if i in ids]
+            self.new_offer_ids = sorted(set(pending) | added, key=_offer_sort_key)
+            self._known_offer_ids = ids
+            if added:
+                logger.info(f"Новые офферы в каталоге: {sorted(added, key=_offer_sort_key)}")
+        asyncio.create_task(self._save("known_offers", {"ids": sorted(ids), "pending": self.new_offer_ids}))
+
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _foreign_running(self) -> bool:
+        """
+        Задание выполняется другим живым процессом (в режиме нескольких воркеров).
+        Если его владелец не обновлял прогресс с момента нашего старта — процесс умер, задание можно продолжить.
+        """
+        job = self.job
+        return (not self.running() and job is not None and job["status"] == "running"
+                and job.get("owner") != self._owner and job.get("updated_at", 0) >= self._booted)
+
+    # --- управление ---
+    async def start(self, offer_ids: list[str], admin_id: int) -> str | None:
+        """Создаёт и запускает задание. Возвращает текст ошибки или None"""
+        await self.load()
+        if self.running() or self._foreign_running():
+            return "Рассылка уже идёт. /broadcast_status — прогресс, /broadcast_stop — остановить."
+        if self.job is not None and self.job["status"] == "paused":
+            return "Есть приостановленная рассылка: /broadcast_resume — продолжить, /broadcast_stop — отменить."
+        offer_ids = [i for i in offer_ids if i in CATALOG.offers_by_id]
+        if not offer_ids:
+            return "Нет новых офферов для рассылки."
+        if not CLIENT_ROW_INDEX.ready:
+            await CLIENT_ROW_INDEX.rebuild()
+        self.job = {
+            "id": datetime.now(MSK).strftime("%Y%m%d-%H%M%S"),
+            "offer_ids": offer_ids,
+            "status": "running",
+            "admin_id": admin_id,
+            "created_at": datetime.now(MSK).strftime("%d.%m.%Y %H:%M:%S"),
+            "cursor_row": 1,          # строки <= cursor_row обработаны (1 — шапка)
+            "chunk_done": [],         # user_id, уже обработанные в текущей пачке
+            "total": len(CLIENT_ROW_INDEX),
+            "sent": 0, "skipped": 0, "blocked": 0, "failed": 0,
+        }
+        self.new_offer_ids = [i for i in self.new_offer_ids if i not in offer_ids]
+        await self._save("known_offers", {"ids": sorted(self._known_offer_ids or []), "pending": self.new_offer_ids})
+        await self.save_job()
+        self._spawn()
+        return None
+
+    async def resume(self, force: bool = False) -> str | None:
+        await self.load()
+        if self.running() or self._foreign_running():
+            return "Рассылка уже идёт."
+        if self.job is None or self.job["status"] not in ("running", "paused"):
+            return "Нет незавершённой рассылки."
+        if self.job["status"] == "paused" and not force:
+            return None
+        self.job["status"] = "running"
+        await self.save_job()
+        self._spawn()
+        return None
+
+    async def stop(self, cancel: bool = False) -> str:
+        if not self.running():
+            await self.load()
+        if self.job is None or self.job["status"] not in ("running", "paused"):
+            return "Нет активной рассылки."
+        if self.running():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.job["status"] = "cancelled" if cancel else "paused"
+        await self.save_job()
+        return "Рассылка отменена." if cancel else "Рассылка приостановлена: /broadcast_resume — продолжить."
+
+    def status_text(self) -> str:
+        job = self.job
+        if job is None:
+            pending = ", ".join(self.new_offer_ids) or "нет"
+            return f"Рассылок ещё не было. Новые офферы: {pending}"
+        done = job["sent"] + job["skipped"] + job["blocked"] + job["failed"]
+        lines = [
+            f"Рассылка {job['id']} ({job['status']}), офферы: {', '.join(job['offer_ids'])}",
+            f"Обработано: {done} из ~{job['total']} (строка {job['cursor_row']})",
+            f"Отправлено: {job['sent']}, пропущено: {job['skipped']}, заблокировали бота: {job['blocked']}, ошибок: {job['failed']}",
+        ]
+        if self.running():
+            elapsed = time.monotonic() - self._run_started
+            rate = (job["sent"] - self._run_sent_start) / elapsed if elapsed > 0 else 0
+            lines.append(f"Скорость: {rate:.1f} сообщ./с")
+        if self.new_offer_ids:
+            lines.append(f"Ещё не разосланы новые офферы: {', '.join(self.new_offer_ids)}")
+        return "\n".join(lines)
+
+    # --- выполнение ---
+    def _spawn(self):
+        # своя копия контекста: приоритет рассылки не должен протечь в обработчик, который её запустил
+        self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    def _message_for(self, offer_ids: list[str]):
+        offers = [CATALOG.offers_by_id[i] for i in offer_ids if i in CATALOG.offers_by_id]
+        if not offers:
+            return None, None
+        lines = ["🆕 Появились новые офферы:", ""]
+        lines += [f"• {o.id}. {o.name} — {o.price}" for o in offers]
+        lines += ["", "Нажмите на оффер, чтобы взять его в работу."]
+        render = CATALOG.render
+        kb = [[render.offer_button[o.id]] for o in offers[:10]]
+        kb.append(BACK_TO_CATEGORIES_ROW)
+        return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=kb)
+
+    async def _targets(self, chunk: list[tuple[int, str]]) -> list[tuple[str, list[str]]]:
+        """Кому из пачки отправлять и какие из новых офферов (одно чтение на пачку)"""
+        last_col = rowcol_to_a1(1, max(NUM_COLUMNS, max(CLIENT_OFFER_COL_MAP.values(), default=0))).rstrip("0123456789")
+        ranges = [f"A{r}:{last_col}{r}" for r, _ in chunk]
+        result = await sheets_read(sheet_clients.batch_get, ranges, priority=PRIO_BACKGROUND)
+        done = set(self.job["chunk_done"])
+        catalog = CATALOG
+        # офферы рассылки, которые ещё есть в каталоге (снятые с витрины не рассылаем)
+        job_mask = 0
+        for offer_id in self.job["offer_ids"]:
+            offer = catalog.offers_by_id.get(offer_id)
+            if offer is not None:
+                job_mask |= 1 << offer.idx
+        targets = []
+        for (row_index, user_id), value_range in zip(chunk, result):
+            if user_id in done:
+                continue
+            row_vals = list(value_range[0]) if value_range else []
+            row_vals = CLIENT_ROWS.overlay(row_index, _pad_row(row_vals, max(NUM_COLUMNS, len(row_vals))))
+            if row_vals[IDX_USER_ID - 1].strip() != user_id or not row_vals[IDX_PHONE - 1].strip() \
+                    or not user_id.lstrip("-").isdigit():
+                self.job["skipped"] += 1
+                continue
+            taken = _parse_offer_status(row_vals, catalog).taken
+            # свои пометки бота, ещё не дошедшие до таблицы
+            cached = OFFER_STATUS.cached(row_index, catalog)
+            if cached:
+                taken |= cached.taken
+            remaining = job_mask & ~taken
+            if not remaining:
+                self.job["skipped"] += 1
+                continue
+            targets.append((user_id, [catalog.offers[idx].id for idx in _iter_bits(remaining)]))
+        return targets
+
+    async def _send(self, user_id: str, offer_ids: list[str]):
+        text, kb = self._message_for(offer_ids)
+        if text is None:
+            self.job["skipped"] += 1
+            return
+        try:
+            uid = int(user_id)
+            msg = await bot.send_message(chat_id=uid, text=text, reply_markup=kb, parse_mode="HTML")
+            # меню пользователя хранит процесс, который обслуживает его апдейты
+            if owns_user(uid):
+                adopt_broadcast_menu(uid, msg.chat.id, msg.message_id)
+            else:
+                WORKER_QUEUES[shard_of(uid, WORKER_COUNT)].put(("menu", uid, msg.chat.id, msg.message_id))
+            self.job["sent"] += 1
+            METRICS.inc("bot_broadcast_messages_total", result="sent")
+        except TelegramForbiddenError:
+            self.job["blocked"] += 1
+            METRICS.inc("bot_broadcast_messages_total", result="blocked")
+        except Exception as e:
+            self.job["failed"] += 1
+            METRICS.inc("bot_broadcast_messages_total", result="failed")
+            logger.warning(f"Рассылка: не удалось отправить {user_id}: {e}")
+
+    async def _run(self):
+        TG_PRIORITY.set(TG_PRIO_BULK)
+        job = self.job
+        bucket = TokenBucket(self.rate, max(1, self.rate))
+        self._run_started = time.monotonic()
+        self._run_sent_start = job["sent"]
+        logger.info(f"Рассылка {job['id']}: старт с строки {job['cursor_row']}, офферы {job['offer_ids']}")
+        try:
+            rows = CLIENT_ROW_INDEX.rows_after(job["cursor_row"])
+            for start in range(0, len(rows), self.chunk_rows):
+                chunk = rows[start:start + self.chunk_rows]
+                queue = list(reversed(await self._targets(chunk)))
+
+                async def sender():
+                    while queue:
+                        user_id, offer_ids = queue.pop()
+                        await bucket.acquire()
+                        await self._send(user_id, offer_ids)
+                        job["chunk_done"].append(user_id)
+                        if time.monotonic() - self._last_save > 2:
+                            await self.save_job()
+
+                await asyncio.gather(*(sender() for _ in range(self.workers)))
+                job["cursor_row"] = chunk[-1][0]
+                job["chunk_done"] = []
+                await self.save_job()
+            job["status"] = "done"
+            await self.save_job()
+            logger.info(f"Рассылка {job['id']} завершена: отправлено {job['sent']}, пропущено {job['skipped']}")
+            try:
+                await bot.send_message(job["admin_id"], "✅ Рассылка завершена.\n" + self.status_text())
+            except Exception as e:
+                logger.warning(f"Не удалось сообщить администратору о завершении рассылки: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # прогресс сохранён — продолжить можно по /broadcast_resume
+            logger.error(f"Ошибка рассылки {job['id']}: {e}")
+            logger.error(traceback.format_exc())
+            job["status"] = "paused"
+            await self.save_job()
+
+BROADCASTER = Broadcaster(BROADCAST_RATE_PER_SEC, BROADCAST_WORKERS, BROADCAST_CHUNK_ROWS, STATE_DB)
+
 # === Handlers ===
 
 @dp.message(Command(commands=["reload_offers"]))
 async def cmd_reload_offers(message: types.Message):
     # ручной лог события команды
-    ok = await load_offers_from_sheet()
-    await build_client_offer_col_map()
+    ok = await load_offers_from_sheet(force=True)
     if ok:
         await message.answer("Офферы перезагружены.")
     else:
@@ -572,6 +4230,9 @@ async def force_reset(message: types.Message):
     try:
         await bot.delete_webhook(drop_pending_updates=True)
         await bot.get_me()
+        if BOT_MODE == "webhook":
+            # в режиме webhook без него бот перестанет получать апдейты — ставим заново
+            await set_bot_webhook()
         await message.answer("✅ Webhook сброшен, все апдейты очищены!")
         logger.info(f"Принудительный сброс выполнен пользователем {message.from_user.id}")
     except Exception as e:
@@ -581,11 +4242,52 @@ async def force_reset(message: types.Message):
 @dp.message(Command(commands=["test_log"]))
 async def test_log(message: types.Message):
     ok = await log_event(message.from_user, "CMD", "/test_log")
+    # для проверки сразу сбрасываем буфер, чтобы убедиться что запись в Google работает
+    ok = ok and await LOG_WRITER.flush()
     if ok:
         await message.answer("✅ Лог записан")
     else:
         await message.answer("❌ Ошибка при записи лога")
 
+@dp.message(Command(commands=["broadcast_new"]))
+async def cmd_broadcast_new(message: types.Message):
+    """/broadcast_new — разослать офферы, появившиеся с прошлой рассылки; /broadcast_new 12,13 — указанные"""
+    if not is_admin(message.from_user.id):
+        return
+    args = (message.text or "").split(maxsplit=1)
+    if len(args) > 1:
+        offer_ids = [x.strip() for x in args[1].replace(" ", ",").split(",") if x.strip()]
+    else:
+        offer_ids = list(BROADCASTER.new_offer_ids)
+    error = await BROADCASTER.start(offer_ids, message.from_user.id)
+    if error:
+        await message.answer(error)
+    else:
+        await message.answer(f"🚀 Рассылка запущена.\n{BROADCASTER.status_text()}")
+
+@dp.message(Command(commands=["broadcast_status"]))
+async def cmd_broadcast_status(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    if not BROADCASTER.running():
+        await BROADCASTER.load()
+    await message.answer(BROADCASTER.status_text())
+
+@dp.message(Command(commands=["broadcast_stop"]))
+async def cmd_broadcast_stop(message: types.Message):
+    """/broadcast_stop — приостановить; /broadcast_stop cancel — отменить совсем"""
+    if not is_admin(message.from_user.id):
+        return
+    cancel = "cancel" in (message.text or "")
+    await message.answer(await BROADCASTER.stop(cancel=cancel))
+
+@dp.message(Command(commands=["broadcast_resume"]))
+async def cmd_broadcast_resume(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    error = await BROADCASTER.resume(force=True)
+    await message.answer(error or f"▶️ Рассылка продолжена.\n{BROADCASTER.status_text()}")
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     ref = "без_метки"
@@ -634,20 +4336,12 @@ async def open_menu(message: types.Message):
         await message.answer("❌ Вы не зарегистрированы. Введите /start для начала.")
         return
 
-    # формируем категории
-    categories = list(OFFERS_BY_CATEGORY.keys()) if OFFERS_BY_CATEGORY else list(OFFERS.keys())
-    if not categories:
+    # категории — готовая клавиатура из кэша каталога
+    if not CATALOG.offers_by_category:
         await message.answer("❗ Офферы пока не загружены.")
         return
 
-    category_buttons = [
-        [InlineKeyboardButton(text=f"📂 {cat}", callback_data=f"category:{cat}")]
-        for cat in categories
-    ]
-    category_buttons.append([InlineKeyboardButton(text="📋 Мои офферы", callback_data="my_offers")])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=category_buttons)
-    msg = await message.answer("Выберите категорию оффера: 👇", reply_markup=keyboard)
+    msg = await message.answer("Выберите категорию оффера: 👇", reply_markup=CATALOG_RENDER.categories_kb)
     await store_menu_message_for_user(message.from_user.id, msg)
 
 def _build_my_offers_keyboard(offers_page, source: str, page: int, total_pages: int):
@@ -657,8 +4351,10 @@ def _build_my_offers_keyboard(offers_page, source: str, page: int, total_pages:
     """
     rows = []
     for offer in offers_page:
-        text = f"{offer['id']}. {offer['name']}"
-        rows.append([InlineKeyboardButton(text=text, callback_data=f"my_offer_info:{offer['id']}")])
+        btn = CATALOG_RENDER.my_offer_button.get(offer.id)
+        if btn is None:
+            btn = InlineKeyboardButton(text=f"{offer.id}. {offer.name}", callback_data=f"my_offer_info:{offer.id}")
+        rows.append([btn])
 
     nav = []
     if page > 1:
@@ -678,27 +4374,14 @@ async def my_offer_info_handler(callback: types.CallbackQuery):
     Показываем карточку оффера из блока 'Мои офферы'
     """
     _, offer_id = callback.data.split(":", 1)
-    offer = OFFERS_BY_ID[offer_id]
+    render = CATALOG_RENDER
+    text = render.info_text.get(offer_id)
 
-    if not offer:
+    if not text:
         await callback.answer("❌ Оффер не найден")
         return
 
-    text = (
-        f"📌 <b>{offer.get('name')}</b>\n\n"
-        f"Ссылка: {offer.get('link')}\n\n"
-        f"Оплата: {offer.get('price')}\n\n"
-        f"Инструкция:\n {offer.get('text')}\n\n"
-    )
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔗 Перейти по ссылке", url=offer.get("link"))] if offer.get("link") else [],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="my_offers")]
-    ])
-    # убрать пустые строки если нет ссылки
-    kb.inline_keyboard = [r for r in kb.inline_keyboard if r]
-
-    await edit_user_menu(callback.from_user.id, text, kb)
+    await edit_user_menu(callback.from_user.id, text, render.info_kb[offer_id])
     await callback.answer()
 
 @dp.callback_query(F.data == "my_offers")
@@ -717,28 +4400,13 @@ async def show_my_offers_menu(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "my_offers_in_progress")
 async def show_my_offers_in_progress(callback: types.CallbackQuery):
-    user_id = str(callback.from_user.id)
-    row_index = await _get_client_row_index(user_id)
-    if not row_index:
+    catalog = CATALOG
+    status = await get_user_offer_status(str(callback.from_user.id), catalog)
+    if status is None:
         await callback.answer("❌ Ты не зарегистрирован")
         return
 
-    # забираем всю строку
-    row_vals = await run_in_executor(sheet_clients.row_values, row_index)
-    row_vals = _pad_row(row_vals, NUM_COLUMNS)
-
-    selected_offers = []
-    for offer in OFFERS_BY_ID.values():
-        try:
-            col_idx = CLIENT_OFFER_COL_MAP.get(int(offer["id"]))
-            if col_idx and col_idx <= len(row_vals):
-                val = str(row_vals[col_idx - 1]).strip().upper()
-                if val == "SELECTED":
-                    selected_offers.append(offer)
-        except:
-            continue
-
-    if not selected_offers:
+    if not status.selected:
         kb = InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(text="⬅️ Назад", callback_data="my_offers")]
@@ -749,9 +4417,9 @@ async def show_my_offers_in_progress(callback: types.CallbackQuery):
         return
 
     # пагинация по 5
-    total = len(selected_offers)
+    total = status.selected.bit_count()
     total_pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
-    page_slice = selected_offers[:PAGE_SIZE]
+    page_slice = _offers_page(catalog, status.selected, 1, PAGE_SIZE)
 
     kb = _build_my_offers_keyboard(page_slice, "my_offers_in_progress", 1, total_pages)
     await edit_user_menu(
@@ -763,27 +4431,13 @@ async def show_my_offers_in_progress(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "my_offers_done")
 async def show_my_offers_done(callback: types.CallbackQuery):
-    user_id = str(callback.from_user.id)
-    row_index = await _get_client_row_index(user_id)
-    if not row_index:
+    catalog = CATALOG
+    status = await get_user_offer_status(str(callback.from_user.id), catalog)
+    if status is None:
         await callback.answer("❌ Ты не зарегистрирован")
         return
 
-    row_vals = await run_in_executor(sheet_clients.row_values, row_index)
-    row_vals = _pad_row(row_vals, NUM_COLUMNS)
-
-    done_offers = []
-    for offer in OFFERS_BY_ID.values():
-        try:
-            col_idx = CLIENT_OFFER_COL_MAP.get(int(offer["id"]))
-            if col_idx and col_idx <= len(row_vals):
-                val = str(row_vals[col_idx - 1]).strip().upper()
-                if val == "DONE":
-                    done_offers.append(offer)
-        except:
-            continue
-
-    if not done_offers:
+    if not status.done:
         kb = InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(text="⬅️ Назад", callback_data="my_offers")]
@@ -793,9 +4447,9 @@ async def show_my_offers_done(callback: types.CallbackQuery):
         await callback.answer()
         return
 
-    total = len(done_offers)
+    total = status.done.bit_count()
     total_pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
-    page_slice = done_offers[:PAGE_SIZE]
+    page_slice = _offers_page(catalog, status.done, 1, PAGE_SIZE)
 
     kb = _build_my_offers_keyboard(page_slice, "my_offers_done", 1, total_pages)
     await edit_user_menu(
@@ -833,46 +4487,30 @@ async def offers_page_handler(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "back_to_categories")
 async def back_to_categories_handler(callback: types.CallbackQuery):
-    # формируем список категорий
-    categories = list(OFFERS_BY_CATEGORY.keys()) if OFFERS_BY_CATEGORY else list(OFFERS.keys())
-
-    category_buttons = [
-        [InlineKeyboardButton(text=f"📂 {cat}", callback_data=f"category:{cat}")]
-        for cat in categories
-    ]
-    category_buttons.append([InlineKeyboardButton(text="📋 Мои офферы", callback_data="my_offers")])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=category_buttons)
-
-    await edit_user_menu(callback.from_user.id, "Выберите категорию оффера:", keyboard)
+    await edit_user_menu(callback.from_user.id, "Выберите категорию оффера:", CATALOG_RENDER.categories_kb)
     await callback.answer()
 
 # обработчик выбора конкретного оффера
 @dp.callback_query(F.data.startswith("offer_select:"))
 async def offer_select_handler(callback: types.CallbackQuery):
     offer_id = callback.data.split(":", 1)[1]
-    offer = OFFERS_BY_ID.get(offer_id)
+    catalog = CATALOG
+    offer = catalog.offers_by_id.get(offer_id)
     if not offer:
         await callback.answer("Оффер не найден")
         return
 
     # проверим, не брал ли пользователь уже этот оффер
-    row_index = await _get_client_row_index(str(callback.from_user.id))
-    if row_index:
-        taken = await get_user_taken_offers_by_row(row_index)
-        if offer_id in taken:
-            await callback.answer("Вы уже брали этот оффер.")
-            return
+    taken = await get_user_taken(str(callback.from_user.id), catalog)
+    if taken >> offer.idx & 1:
+        await callback.answer("Вы уже брали этот оффер.")
+        return
 
     # Помечаем ожидание кода
     PENDING_OFFER[callback.from_user.id] = offer_id
 
     # редактируем меню и показываем запрос ввода кода + кнопку "Отмена"
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_pending")]
-    ])
-    prompt = f"Вы выбрали оффер {offer_id} — {offer['name']}\n\nВведите код, полученный от оператора или нажми ❌ Отмена для возвращения.\n\nВы получите {offer['price']} за выполнение.\n\nИнструкция для выполнения:\n{offer['text']}."
-    await edit_user_menu(callback.from_user.id, prompt, kb)
+    await edit_user_menu(callback.from_user.id, catalog.render.select_prompt[offer_id], CANCEL_PENDING_KB)
     await callback.answer()
 
 @dp.callback_query(F.data == "cancel_pending")
@@ -885,11 +4523,45 @@ async def cancel_pending_cb(callback: types.CallbackQuery):
         await show_offers_page_for_user(user_id, info["category"], info.get("page", 1))
     else:
         # возвращаем категории
-        categories = list(OFFERS_BY_CATEGORY.keys()) if OFFERS_BY_CATEGORY else list(OFFERS.keys())
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=f"📂 {cat}", callback_data=f"category:{cat}")] for cat in categories])
-        await edit_user_menu(user_id, "Выберите категорию оффера:", kb)
+        await edit_user_menu(user_id, "Выберите категорию оффера:", CATALOG_RENDER.categories_kb_plain)
     await callback.answer("Отменено")
 
+@dp.inline_query()
+async def inline_search_handler(inline_query: types.InlineQuery):
+    """Inline-поиск офферов: @bot <номер, название или категория>. Уже взятые пользователем офферы скрываются."""
+    catalog = CATALOG
+    offer_ids = catalog.search.search(inline_query.query)
+
+    # статусы — только если строка известна по индексу (без загрузки колонки) и успевают за отведённое время
+    row_index = CLIENT_ROW_INDEX.get(str(inline_query.from_user.id)) if CLIENT_ROW_INDEX.ready else None
+    if row_index and offer_ids and sheet_clients:
+        try:
+            # shield: при таймауте чтение доживёт и закэширует статус для следующей страницы
+            status = await asyncio.wait_for(asyncio.shield(OFFER_STATUS.get(row_index, catalog)),
+                                            INLINE_STATUS_TIMEOUT_SEC)
+            offer_ids = [i for i in offer_ids if not status.is_taken(catalog.offers_by_id[i])]
+        except asyncio.TimeoutError:
+            logger.warning(f"inline: статусы пользователя {inline_query.from_user.id} не успели загрузиться")
+        except Exception as e:
+            logger.error(f"inline: ошибка загрузки статусов: {e}")
+
+    try:
+        offset = max(0, int(inline_query.offset or 0))
+    except ValueError:
+        offset = 0
+    page = offer_ids[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(offer_ids) else ""
+    button = None
+    if not row_index:
+        button = InlineQueryResultsButton(text="Зарегистрироваться в боте", start_parameter="inline")
+    await inline_query.answer(
+        [catalog.render.inline_article[i] for i in page],
+        cache_time=INLINE_CACHE_SEC,
+        is_personal=True,
+        next_offset=next_offset,
+        button=button,
+    )
+
 @dp.message()
 async def handle_messages_for_code(message: types.Message):
     user_id = message.from_user.id
@@ -910,26 +4582,23 @@ async def handle_messages_for_code(message: types.Message):
             await show_offers_page_for_user(user_id, info["category"], info.get("page", 1))
         else:
             # показать категории
-            categories = list(OFFERS_BY_CATEGORY.keys()) if OFFERS_BY_CATEGORY else list(OFFERS.keys())
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=f"📂 {cat}", callback_data=f"category:{cat}")] for cat in categories])
-            await edit_user_menu(user_id, "Отменено. Выберите категорию оффера:", kb)
+            await edit_user_menu(user_id, "Отменено. Выберите категорию оффера:", CATALOG_RENDER.categories_kb_plain)
         return
 
     offer_id = PENDING_OFFER.get(user_id)
-    offer = OFFERS_BY_ID.get(offer_id)
+    catalog = CATALOG
+    offer = catalog.offers_by_id.get(offer_id)
+    render = catalog.render
     if not offer:
         await message.answer("Ошибка: оффер не найден. Попробуйте выбрать снова.")
         PENDING_OFFER.pop(user_id, None)
         return
 
     entered = text.strip().lower()
-    correct = (offer.get("code","").strip().lower() == entered)
+    correct = (offer.code_key == entered)
     if not correct:
         # редактируем то же меню с пометкой "Код неверный"
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_pending")]
-        ])
-        await edit_user_menu(user_id, f"Код неверный. Попробуйте ещё раз или нажмите ❌ Отмена.\n\nОффер: {offer_id} — {offer['name']}", kb)
+        await edit_user_menu(user_id, render.code_incorrect[offer_id], CANCEL_PENDING_KB)
         await log_event(message.from_user, "OFFER_CODE_INCORRECT", f"{offer_id} / {entered}")
         return
 
@@ -940,21 +4609,16 @@ async def handle_messages_for_code(message: types.Message):
         await update_client(message.from_user, status="взял оффер", offer=offer_id)
         row_index = await _get_client_row_index(str(user_id))
 
-    ok = await mark_offer_taken_for_user(row_index, offer_id)
+    ok = await mark_offer_taken_for_user(row_index, offer_id, user_id=str(user_id))
     if not ok:
         logger.warning("Не удалось пометить оффер, но всё равно отправлю ссылку.")
 
     await log_event(message.from_user, "OFFER_TAKEN", offer_id)
 
     # редактируем меню: показываем ссылку + кнопку "Вернуться к офферам"
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Вернуться к офферам", callback_data=f"offers_page:{offer['category']}:1")],
-        [InlineKeyboardButton(text="⬅️ К категориям", callback_data="back_to_categories")]
-    ])
-    text_ok = f"✅ Код верный! Вот ссылка на оффер:\n{offer['link']}\n\nВы получите {offer['price']} за выполнение.\n\nИнструкция для выполнения:\n{offer['text']}."
     # очистим pending
     PENDING_OFFER.pop(user_id, None)
-    await edit_user_menu(user_id, text_ok, kb)
+    await edit_user_menu(user_id, render.code_ok[offer_id], render.code_ok_kb[offer_id])
 
 @dp.message()
 async def fallback_message_handler(message: types.Message):
@@ -968,40 +4632,513 @@ async def fallback_message_handler(message: types.Message):
 async def handle(request):
     return web.Response(text="I'm alive!")
 
+async def handle_metrics(request):
+    """Метрики в текстовом формате Prometheus (при нескольких процессах — с меткой worker)"""
+    if SHARD_ROUTER is not None:
+        others = await SHARD_ROUTER.collect_metrics(METRICS_WORKER_TIMEOUT_SEC)
+        text = METRICS.render(labels=(("worker", "front"),), others=others)
+    else:
+        text = METRICS.render()
+    return web.Response(text=text, content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+def register_state_gauges():
+    """Gauge'и читаются только при запросе /metrics — на горячий путь не влияют"""
+    METRICS.gauge("bot_pending_offers", "Пользователи, от которых ждём код (PENDING_OFFER)", lambda: len(PENDING_OFFER))
+    METRICS.gauge("bot_menu_messages", "Сохранённые меню пользователей (USER_MENU_MESSAGE)", lambda: len(USER_MENU_MESSAGE))
+    METRICS.gauge("bot_state_bytes", "Оценка памяти состояния диалогов",
+                  lambda: {(("store", st.name),): st.memory_bytes() for st in STATE_STORES})
+    METRICS.gauge("bot_offers", "Офферов в каталоге", lambda: len(CATALOG.offers))
+    METRICS.gauge("bot_catalog_version", "Версия каталога", lambda: CATALOG_VERSION)
+    METRICS.gauge("bot_log_backlog", "Строки логов, ждущие записи в Google", lambda: LOG_WRITER.backlog())
+    METRICS.gauge("bot_log_dropped", "Строки логов, отброшенные при переполнении очереди", lambda: LOG_WRITER.dropped)
+    METRICS.gauge("bot_client_dirty_cells", "Изменённые ячейки клиентов, ждущие записи", lambda: CLIENT_ROWS.pending())
+    METRICS.gauge("bot_client_rows_cached", "Строки клиентов в кэше CLIENT_ROWS", lambda: len(CLIENT_ROWS))
+    METRICS.gauge("bot_client_registrations_pending", "Новые строки клиентов в очереди на добавление",
+                  lambda: CLIENT_REGISTRAR.pending())
+    METRICS.gauge("bot_journal_unacked", "Записи журнала, ещё не подтверждённые Google", lambda: JOURNAL.pending())
+    METRICS.gauge("bot_journal_deferred", "Отложенные пометки офферов в журнале", lambda: JOURNAL.deferred())
+    METRICS.gauge("bot_client_index_size", "Записей в индексе user_id -> строка", lambda: len(CLIENT_ROW_INDEX))
+    METRICS.gauge("bot_offer_status_cached", "Закэшированные статусы офферов пользователей", lambda: len(OFFER_STATUS))
+    METRICS.gauge("bot_sheets_queue_depth", "Очередь запросов к Google Sheets",
+                  lambda: {(("queue", k),): v for k, v in SHEETS.queue_depth().items()})
+    METRICS.gauge("bot_telegram_queue_depth", "Запросы к Telegram, ждущие очереди", lambda: TELEGRAM_OUTBOX.depth())
+    METRICS.gauge("bot_updates_in_progress", "Апдейты в обработке (webhook / воркер)", lambda: UPDATE_PROCESSOR.backlog())
+
+register_state_gauges()
+
+def _update_user_id(update: types.Update):
+    event = update.event
+    user = getattr(event, "from_user", None) if event is not None else None
+    return user.id if user else None
+
+class UpdateProcessor:
+    """
+    Обработка входящих апдейтов в фоне: приём подтверждается сразу,
+    одновременно обрабатывается не больше max_concurrency апдейтов,
+    апдейты одного пользователя обрабатываются строго по очереди.
+    """
+    def __init__(self, max_concurrency: int):
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._user_locks: dict[int, list] = {}   # user_id -> [Lock, сколько апдейтов его ждут]
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, bot_: Bot, update: types.Update):
+        task = asyncio.create_task(self._process(bot_, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, bot_: Bot, update: types.Update):
+        user_id = _update_user_id(update)
+        entry = None
+        if user_id is not None:
+            entry = self._user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+        try:
+            if entry:
+                await entry[0].acquire()
+            try:
+                async with self._sem:
+                    await dp.feed_update(bot_, update)
+            finally:
+                if entry:
+                    entry[0].release()
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            if entry:
+                entry[1] -= 1
+                # замок больше никому не нужен — не копим их для всех пользователей
+                if entry[1] == 0:
+                    self._user_locks.pop(user_id, None)
+
+    def backlog(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+UPDATE_PROCESSOR = UpdateProcessor(WEBHOOK_MAX_CONCURRENCY)
+
+async def handle_webhook(request):
+    """Приём апдейтов от Telegram: проверяем секрет, отвечаем 200 сразу, обработка — в фоне"""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=401)
+    try:
+        data = await request.json()
+        if SHARD_ROUTER:
+            # многопроцессный режим: сам апдейт разбирает воркер
+            SHARD_ROUTER.route(data)
+            return web.Response()
+        update = types.Update.model_validate(data, context={"bot": bot})
+    except Exception as e:
+        logger.warning(f"Некорректный апдейт в webhook: {e}")
+        return web.Response(status=400)
+    UPDATE_PROCESSOR.submit(bot, update)
+    return web.Response()
+
+async def set_bot_webhook():
+    url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+    await bot.set_webhook(
+        url,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=True,
+    )
+    logger.info(f"Webhook установлен: {url}")
+
+def webhook_config_error() -> str | None:
+    """Чего не хватает для режима webhook (None — можно запускать)"""
+    if not WEBHOOK_BASE_URL:
+        return "BOT_MODE=webhook, но WEBHOOK_BASE_URL не задан"
+    if not WEBHOOK_SECRET:
+        # без секрета кто угодно, узнав URL, может слать боту поддельные апдейты (в том числе команды админа)
+        return "BOT_MODE=webhook, но WEBHOOK_SECRET не задан"
+    return None
+
 async def start_web_server():
     port = int(os.environ.get("PORT", 10000))
     app = web.Application()
     app.router.add_get("/", handle)
+    app.router.add_get("/metrics", handle_metrics)
+    if BOT_MODE == "webhook":
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
     logging.info(f"Веб-сервер запущен на порту {port}")
-
-# Регистрируем middleware (важно: до старта polling)
+    return runner
+
+# Регистрируем middleware (важно: до старта polling / webhook)
+setup_bot_session(bot)
+# дребезг — первым внешним middleware: повторное нажатие гасится до фильтров, ожидания хранилища и логов
+dp.callback_query.outer_middleware(CallbackDebounceMiddleware(MENU_DEBOUNCE_SEC))
+# ожидание хранилища — внутренний middleware: ему нужен выбранный обработчик (data["handler"])
+STORAGE_READY_MIDDLEWARE = StorageReadyMiddleware(STORAGE_READY_TIMEOUT_SEC)
+dp.message.middleware(STORAGE_READY_MIDDLEWARE)
+dp.callback_query.middleware(STORAGE_READY_MIDDLEWARE)
+dp.inline_query.middleware(STORAGE_READY_MIDDLEWARE)
 dp.message.middleware(LoggingMiddleware())
 dp.callback_query.middleware(LoggingMiddleware())
+dp.inline_query.middleware(LoggingMiddleware())
+
+async def start_data_services(catalog_refresh: bool = True):
+    """Инициализация хранилища, каталога, индекса клиентов и фоновых задач"""
+    # до первой загрузки каталога: новые офферы считаются от сохранённого списка известных
+    await BROADCASTER.load()
+    if BROADCASTER.on_catalog not in CATALOG_LISTENERS:
+        CATALOG_LISTENERS.append(BROADCASTER.on_catalog)
+        if CATALOG.content_hash:
+            # каталог собран ещё до fork (run_sharded) — учитываем его, как загруженный после старта
+            BROADCASTER.on_catalog(CATALOG)
+    # снимок быстрого старта пишет один процесс (при нескольких воркерах — воркер 0)
+    WARM_START.writable = WORKER_NO in (None, 0)
+    if WARM_START.on_catalog not in CATALOG_LISTENERS:
+        CATALOG_LISTENERS.append(WARM_START.on_catalog)
+
+    # журнал записей — до первого обработчика (у каждого воркера свой файл)
+    if JOURNAL_PATH:
+        JOURNAL.open(JOURNAL_PATH if WORKER_NO is None else f"{JOURNAL_PATH}.{WORKER_NO}")
+    asyncio.create_task(JOURNAL.replay_loop())
+
+    # состояние диалогов после рестарта
+    for store in STATE_STORES:
+        await store.load()
+    asyncio.create_task(state_flush_loop())
+
+    # каталог (кроме воркеров — его присылает фронт) и индекс клиентов из снимка на диске:
+    # тогда апдейты обслуживаются сразу, а подключение к таблице и сверка идут фоном
+    warm = WARM_START.restore(catalog=catalog_refresh)
+    # записи, не дошедшие до таблицы в прошлый раз, — до первого обработчика: иначе он прочитает строку
+    # клиента без них (например, H без уже взятых офферов) и запишет её поверх
+    JOURNAL.restore()
+    if warm:
+        ok = True
+        asyncio.create_task(_connect_storage(catalog_refresh, warm=True))
+    else:
+        ok = await _connect_storage(catalog_refresh, warm=False)
 
-# Main
-async def main():
-    logger.info("Запуск бота...")
+    LOG_WRITER.start()
+    CLIENT_ROWS.start()
+    return ok
+
+async def _connect_storage(catalog_refresh: bool, warm: bool):
+    """Подключение к таблице, загрузка (или сверка после быстрого старта) каталога и индекса, фоновые задачи"""
     ok = await init_google_sheets()
+    # обработчики больше не ждут хранилище: без него изменения копятся в журнале и очередях
+    STORAGE_READY.set()
     if not ok:
-        logger.error("Не удалось инициализировать Google Sheets. Бот будет работать, но без записи.")
+        logger.error("Не удалось инициализировать Google Sheets. Бот работает без таблицы, "
+                     "изменения копятся в журнале; подключение повторяется фоном.")
+        asyncio.create_task(_retry_connect_storage(catalog_refresh, warm))
+        return False
+    await _storage_connected(catalog_refresh, warm)
+    return True
+
+async def _retry_connect_storage(catalog_refresh: bool, warm: bool):
+    """Повторные попытки открыть хранилище с нарастающей паузой (STORAGE_RETRY_SEC .. STORAGE_RETRY_MAX_SEC)"""
+    delay = STORAGE_RETRY_SEC
+    attempt = 1
+    while True:
+        await asyncio.sleep(delay)
+        attempt += 1
+        if await init_google_sheets():
+            logger.info(f"Хранилище подключено с попытки {attempt}")
+            await _storage_connected(catalog_refresh, warm)
+            return
+        delay = min(STORAGE_RETRY_MAX_SEC, delay * 2)
+        logger.error(f"Хранилище недоступно (попытка {attempt}), следующая через {delay:.0f} с")
+
+async def _storage_connected(catalog_refresh: bool, warm: bool):
+    """Хранилище открыто: каталог, индекс клиентов и фоновые задачи, которым нужна таблица"""
+    if catalog_refresh:
+        # Автозагрузка офферов и карты колонок (после быстрого старта — только если лист изменился), дальше — фоном
+        await load_offers_from_sheet(force=not warm)
+        asyncio.create_task(catalog_refresh_loop())
+    # индекс клиентов: строим (или сверяем индекс из снимка) один раз и дальше пересинхронизируем фоном
+    if CLIENT_ROW_INDEX.from_disk:
+        await CLIENT_ROW_INDEX.ensure_synced()
     else:
-        # Автозагрузка офферов и карты колонок
-        await load_offers_from_sheet()
-        await build_client_offer_col_map()
+        await CLIENT_ROW_INDEX.rebuild()
+    asyncio.create_task(CLIENT_ROW_INDEX.resync_loop())
+    asyncio.create_task(OFFER_STATUS.refresh_loop())
+
+    # рассылка, прерванная рестартом, продолжается; при нескольких воркерах — у того, кто обслуживает
+    # её администратора: туда же приходят его /broadcast_status и /broadcast_stop
+    if BROADCASTER.job is not None and owns_user(BROADCASTER.job.get("admin_id")):
+        await BROADCASTER.resume()
+
+async def stop_data_services():
+    """Дописываем накопленные изменения и логи перед выходом"""
+    await UPDATE_PROCESSOR.drain()
+    if BROADCASTER.running():
+        # остановка процесса — не отмена: после старта рассылка продолжится
+        BROADCASTER._task.cancel()
+        await asyncio.gather(BROADCASTER._task, return_exceptions=True)
+        await BROADCASTER.save_job()
+    await CLIENT_REGISTRAR.flush()
+    await WARM_START.save()
+    await CLIENT_ROWS.close()
+    await LOG_WRITER.close()
+    # что не дошло до таблицы, остаётся в журнале до следующего запуска
+    JOURNAL.close()
+    for store in STATE_STORES:
+        await store.flush()
+    if storage:
+        await storage.close()
+
+# === Несколько процессов ===
+
+def _raw_update_user_id(data: dict):
+    """user_id из сырого апдейта Telegram (без разбора в aiogram-модели)"""
+    for key in ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result"):
+        event = data.get(key)
+        if event and event.get("from"):
+            return event["from"].get("id")
+    return None
 
-    # старт веб-сервера для Render healthcheck
-    asyncio.create_task(start_web_server())
+class ShardRouter:
+    """
+    Фронт-процесс: раздаёт апдейты воркерам по хэшу user_id
+    (все апдейты одного пользователя попадают в один процесс и обрабатываются по порядку)
+    и рассылает им новые снимки каталога. Для /metrics собирает снимки метрик воркеров через replies.
+    """
+    def __init__(self, queues: list, replies):
+        self.queues = queues
+        self.replies = replies
+        self._metrics_req = 0
+        self._metrics_lock = asyncio.Lock()
+
+    def route(self, data: dict):
+        user_id = _raw_update_user_id(data)
+        idx = shard_of(user_id, len(self.queues)) if user_id is not None else 0
+        self.queues[idx].put(("update", data))
+
+    def broadcast_catalog(self, snapshot: CatalogSnapshot):
+        msg = ("catalog", snapshot.source_values, snapshot.source_header, snapshot.version, snapshot.content_hash)
+        for q in self.queues:
+            q.put(msg)
+
+    async def collect_metrics(self, timeout: float) -> list:
+        """[(labels, snapshot)] воркеров, ответивших за timeout секунд"""
+        async with self._metrics_lock:
+            self._metrics_req += 1
+            req = self._metrics_req
+            for q in self.queues:
+                q.put(("metrics", req))
+            deadline = time.monotonic() + timeout
+            snapshots = {}
+            while len(snapshots) < len(self.queues):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    reply_req, worker_no, snap = await run_in_executor(self.replies.get, True, left)
+                except Empty:
+                    break
+                if reply_req == req:   # опоздавшие ответы на прошлые запросы пропускаем
+                    snapshots[worker_no] = snap
+            if len(snapshots) < len(self.queues):
+                logger.warning(f"metrics: ответили {len(snapshots)} из {len(self.queues)} воркеров")
+            return [((("worker", str(n)),), snapshots[n]) for n in sorted(snapshots)]
+
+    def stop(self):
+        for q in self.queues:
+            q.put(("stop",))
+
+SHARD_ROUTER: ShardRouter | None = None
+WORKER_NO: int | None = None   # номер процесса-воркера (None — один процесс)
+WORKER_COUNT = 1               # сколько всего воркеров
+WORKER_QUEUES: list = []       # входные очереди всех воркеров (для передачи данных владельцу пользователя)
+
+def shard_of(user_id, n_workers: int) -> int:
+    """Номер воркера, который обслуживает пользователя (тот же хэш, что у ShardRouter)"""
+    return zlib.crc32(str(user_id).encode()) % n_workers
+
+def owns_user(user_id) -> bool:
+    """Пользователь обслуживается этим процессом (в однопроцессном режиме — всегда)"""
+    return WORKER_NO is None or shard_of(user_id, WORKER_COUNT) == WORKER_NO
+
+def _start_queue_reader(queue, loop: asyncio.AbstractEventLoop, name: str) -> asyncio.Queue:
+    """
+    Поток-читатель межпроцессной очереди: ждёт сообщение (блокирующий get), забирает всё, что уже пришло,
+    и одним call_soon_threadsafe передаёт пачку в asyncio.Queue. Без задачи executor'а на каждый апдейт.
+    """
+    inbox: asyncio.Queue = asyncio.Queue()
 
-    logger.info("Начинаем polling...")
-    await dp.start_polling(
-        bot,
-        drop_pending_updates=True,
-        allowed_updates=["message", "callback_query"]
-    )
+    def pump():
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < 256:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                pass
+            loop.call_soon_threadsafe(inbox.put_nowait, batch)
+            if any(msg[0] == "stop" for msg in batch):
+                return
+
+    threading.Thread(target=pump, name=name, daemon=True).start()
+    return inbox
+
+async def worker_main(worker_no: int, queues: list, n_workers: int, replies):
+    """Процесс-воркер: обрабатывает апдейты своей доли пользователей"""
+    global bot, WORKER_NO, WORKER_COUNT, WORKER_QUEUES
+    WORKER_NO = worker_no
+    WORKER_COUNT = n_workers
+    WORKER_QUEUES = queues
+    queue = queues[worker_no]
+    # свой экземпляр Bot (HTTP-сессии между процессами не делятся)
+    bot = setup_bot_session(Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode="HTML")))
+    # квота Google общая на всех — делим поровну
+    SHEETS.scale_quota(1 / n_workers)
+    TELEGRAM_OUTBOX.scale(1 / n_workers)
+    logger.info(f"Воркер {worker_no} запущен (pid {os.getpid()})")
+    # каталог собран до fork (из снимка) или его присылает фронт — сами его не загружаем
+    await start_data_services(catalog_refresh=False)
+    inbox = _start_queue_reader(queue, asyncio.get_running_loop(), f"bot-worker-{worker_no}-queue")
+    try:
+        while await _worker_dispatch(await inbox.get(), worker_no, replies):
+            pass
+    finally:
+        await stop_data_services()
+        await bot.session.close()
+
+async def _worker_dispatch(batch: list, worker_no: int, replies) -> bool:
+    """Пачка сообщений фронта по порядку. False — пришла команда остановки"""
+    for msg in batch:
+        kind = msg[0]
+        if kind == "update":
+            UPDATE_PROCESSOR.submit(bot, types.Update.model_validate(msg[1], context={"bot": bot}))
+        elif kind == "catalog":
+            _, values, header, version, content_hash = msg
+            if content_hash != CATALOG.content_hash or version != CATALOG.version:
+                _install_catalog(await run_in_executor(
+                    build_catalog_snapshot, values, header, version, content_hash, CATALOG.search
+                ))
+        elif kind == "menu":
+            # рассылку отправил другой воркер, а меню этого пользователя храним мы
+            adopt_broadcast_menu(*msg[1:])
+        elif kind == "metrics":
+            replies.put((msg[1], worker_no, METRICS.snapshot()))
+        elif kind == "stop":
+            return False
+    return True
+
+def _worker_entry(worker_no: int, queues: list, n_workers: int, counter, replies):
+    CLIENT_REGISTRAR.shared_counter = counter
+    try:
+        asyncio.run(worker_main(worker_no, queues, n_workers, replies))
+    except KeyboardInterrupt:
+        pass
+
+async def front_main(router: ShardRouter):
+    """Фронт-процесс: принимает апдейты (polling или webhook), держит каталог и раздаёт работу воркерам"""
+    global SHARD_ROUTER
+    SHARD_ROUTER = router
+    CATALOG_LISTENERS.append(router.broadcast_catalog)
+
+    async def connect(warm: bool):
+        if await init_google_sheets():
+            await load_offers_from_sheet(force=not warm)
+            asyncio.create_task(catalog_refresh_loop())
+
+    # каталог из снимка собран до fork (run_sharded) — он уже и у воркеров; снимок фронт только читает
+    WARM_START.writable = False
+    if CATALOG.content_hash:
+        asyncio.create_task(connect(warm=True))
+    else:
+        await connect(warm=False)
+    try:
+        if BOT_MODE == "webhook":
+            await start_web_server()
+            await set_bot_webhook()
+            logger.info(f"Работаем через webhook, воркеров: {len(router.queues)}")
+            await asyncio.Event().wait()
+        else:
+            asyncio.create_task(start_web_server())
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info(f"Начинаем polling, воркеров: {len(router.queues)}")
+            offset = None
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES)
+                except Exception as e:
+                    logger.error(f"Ошибка get_updates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    router.route(update.model_dump(mode="json", exclude_none=True))
+    finally:
+        if storage:
+            await storage.close()
+        await bot.session.close()
+
+def run_sharded(n_workers: int):
+    """Фронт + n_workers процессов-воркеров (fork)"""
+    # записи журнала — к тем воркерам, которые теперь обслуживают их клиентов (WORKERS мог измениться)
+    consolidate_journals(JOURNAL_PATH, n_workers)
+    # каталог из снимка собираем один раз, до fork: воркеры получают его готовым (общие страницы памяти),
+    # а не разбирают каждый заново. Индекс клиентов каждый воркер поднимает сам (он сверяет его с таблицей)
+    WARM_START.restore(index=False)
+    ctx = multiprocessing.get_context("fork")
+    queues = [ctx.Queue() for _ in range(n_workers)]
+    replies = ctx.Queue()
+    counter = ctx.Value("q", 0)
+    procs = [
+        ctx.Process(target=_worker_entry, args=(i, queues, n_workers, counter, replies), name=f"bot-worker-{i}")
+        for i in range(n_workers)
+    ]
+    for p in procs:
+        p.start()
+    router = ShardRouter(queues, replies)
+    try:
+        asyncio.run(front_main(router))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.stop()
+        for p in procs:
+            p.join(timeout=30)
+
+# Main
+async def main():
+    logger.info("Запуск бота...")
+    # журналы воркеров прошлого запуска (если раньше работали с WORKERS > 1) — в общий файл
+    consolidate_journals(JOURNAL_PATH, 1)
+    await start_data_services()
+
+    try:
+        if BOT_MODE == "webhook":
+            # в режиме webhook веб-сервер — основной вход, его запуск ждём
+            await start_web_server()
+            await set_bot_webhook()
+            logger.info("Работаем через webhook...")
+            await asyncio.Event().wait()
+        else:
+            # старт веб-сервера для Render healthcheck
+            asyncio.create_task(start_web_server())
+
+            logger.info("Начинаем polling...")
+            await dp.start_polling(
+                bot,
+                drop_pending_updates=True,
+                allowed_updates=ALLOWED_UPDATES
+            )
+    finally:
+        await stop_data_services()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook" and webhook_config_error():
+        # не стартуем вовсе: ни воркеров, ни журнала, ни приёма апдейтов
+        logger.error(webhook_config_error())
+        raise SystemExit(1)
+    if WORKERS > 1:
+        run_sharded(WORKERS)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,267 @@
+"""
+Бенчмарк пользовательских сценариев бота без сети.
+
+Гоняет настоящие aiogram-обработчики из Bot.py через dp.feed_update с фейковым Bot
+(сессия записывает вызовы Telegram API) и фейковыми листами (локальная SQLite в памяти,
+каждый вызов считается и может задерживаться на заданную латентность).
+
+Для каждого сценария и уровня параллельности печатает:
+чтения/записи Sheets, вызовы Telegram API, p50/p99 времени обработки апдейта.
+
+    python bench.py                       # 1, 100, 1000 пользователей
+    python bench.py --users 1 100 --sheets-latency-ms 80 --json baseline.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+os.environ.setdefault("API_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("LOG_FLUSH_INTERVAL_SEC", "3600")
+os.environ.setdefault("CLIENT_FLUSH_INTERVAL_SEC", "3600")
+os.environ.setdefault("STATE_DB_PATH", "")
+os.environ.setdefault("WARM_START_PATH", "")
+# квоты Sheets в бенчмарке по умолчанию не ограничиваем — меряем число вызовов и латентность
+os.environ.setdefault("SHEETS_READS_PER_MIN", "1000000")
+os.environ.setdefault("SHEETS_WRITES_PER_MIN", "1000000")
+# и лимиты Telegram тоже: иначе бенчмарк меряет ожидание в очереди отправки
+os.environ.setdefault("TG_GLOBAL_PER_SEC", "1000000")
+os.environ.setdefault("TG_CHAT_PER_SEC", "1000000")
+os.environ.setdefault("TG_CHAT_BURST", "1000000")
+
+import Bot as app  # noqa: E402
+from aiogram import Bot, types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+
+SHEETS_READS = {"get_all_values", "row_values", "col_values", "batch_get", "get"}
+SHEETS_WRITES = {"update", "batch_update", "append_row", "append_rows"}
+
+CATEGORIES = ["Дебетовые карты", "Кредитные карты", "Вклады"]
+OFFERS_PER_CATEGORY = 10
+
+
+class RecordingWorksheet:
+    """Обёртка над листом: считает вызовы и добавляет латентность (sleep в потоке executor'а)"""
+
+    def __init__(self, inner, stats: Counter, lock: threading.Lock, latency: float):
+        self._inner = inner
+        self._stats = stats
+        self._lock = lock
+        self.latency = latency
+        self.title = inner.title
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if name not in SHEETS_READS and name not in SHEETS_WRITES:
+            return attr
+
+        def call(*args, **kwargs):
+            with self._lock:
+                self._stats[("read" if name in SHEETS_READS else "write", f"{self.title}.{name}")] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            return attr(*args, **kwargs)
+        call.__name__ = name
+        # как у настоящего листа: повторное обращение даёт тот же (равный) метод — важно для объединения чтений
+        setattr(self, name, call)
+        return call
+
+
+class RecordingStorage(app.Storage):
+    name = "bench"
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.inner = app.SQLiteStorage(":memory:")
+
+    async def open(self) -> bool:
+        await self.inner.open()
+        seed_sheets(self.inner)
+        self.clients = RecordingWorksheet(self.inner.clients, self.stats, self.lock, self.latency)
+        self.logs = RecordingWorksheet(self.inner.logs, self.stats, self.lock, self.latency)
+        self.offers = RecordingWorksheet(self.inner.offers, self.stats, self.lock, self.latency)
+        return True
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot API без сети: считает методы и возвращает правдоподобные ответы"""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.stats = Counter()
+        self._message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.stats[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = type(method).__name__
+        if name == "SendMessage":
+            self._message_id += 1
+            return types.Message(
+                message_id=self._message_id,
+                date=datetime.now(timezone.utc),
+                chat=types.Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+def seed_sheets(storage):
+    """Каталог офферов и пустой лист клиентов с колонками-чекбоксами офферов"""
+    offers = [["№", "Категория", "", "Название", "", "", "", "", "Ссылка", "Заплатим", "Действия", "Код"]]
+    offer_no = 0
+    for cat in CATEGORIES:
+        for _ in range(OFFERS_PER_CATEGORY):
+            offer_no += 1
+            offers.append([str(offer_no), cat, "", f"Оффер {offer_no}", "", "", "", "",
+                           f"https://example.com/{offer_no}", f"{offer_no * 100} ₽",
+                           "Оформить и активировать", f"code{offer_no}"])
+    storage.offers.seed(offers)
+    header = ["№", "user_id", "username", "Имя", "Телефон", "Дата", "Метка", "№ оффера", "", ""]
+    header += [str(i) for i in range(1, offer_no + 1)]
+    storage.clients.seed([header])
+    storage.logs.seed([["Дата", "user_id", "username", "Имя", "Фамилия", "Событие", "Текст"]])
+
+
+def make_user(uid: int) -> types.User:
+    return types.User(id=uid, is_bot=False, first_name=f"User{uid}", username=f"user{uid}")
+
+
+def make_message(uid: int, text: str | None = None, contact: types.Contact | None = None) -> types.Message:
+    return types.Message(
+        message_id=1,
+        date=datetime.now(timezone.utc),
+        chat=types.Chat(id=uid, type="private"),
+        from_user=make_user(uid),
+        text=text,
+        contact=contact,
+    )
+
+
+def message_update(uid: int, **kwargs) -> types.Update:
+    return types.Update(update_id=uid, message=make_message(uid, **kwargs))
+
+
+def callback_update(uid: int, data: str) -> types.Update:
+    return types.Update(update_id=uid, callback_query=types.CallbackQuery(
+        id=str(uid),
+        from_user=make_user(uid),
+        chat_instance=str(uid),
+        data=data,
+        message=make_message(uid, text="menu"),
+    ))
+
+
+# сценарии в порядке пользовательского пути: каждый следующий опирается на состояние предыдущего
+FLOWS = [
+    ("cmd_start", lambda uid: message_update(uid, text="/start bench")),
+    ("get_phone", lambda uid: message_update(uid, contact=types.Contact(phone_number=f"+7900{uid:07d}",
+                                                                          first_name="U", user_id=uid))),
+    ("open_menu", lambda uid: message_update(uid, text="📋 Меню")),
+    ("category_handler", lambda uid: callback_update(uid, f"category:{CATEGORIES[0]}")),
+    ("offers_page_handler", lambda uid: callback_update(uid, f"offers_page:{CATEGORIES[0]}:2")),
+    ("offer_select_handler", lambda uid: callback_update(uid, "offer_select:1")),
+    ("handle_messages_for_code", lambda uid: message_update(uid, text="code1")),
+]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[idx]
+
+
+async def run_flow(bot, build_update, user_ids):
+    latencies = []
+
+    async def one(uid):
+        start = time.perf_counter()
+        await app.dp.feed_update(bot, build_update(uid))
+        latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(uid) for uid in user_ids))
+    return latencies
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--sheets-latency-ms", type=float, default=50.0)
+    parser.add_argument("--tg-latency-ms", type=float, default=20.0)
+    parser.add_argument("--json", help="сохранить результаты в файл (для сравнения с базовой линией)")
+    args = parser.parse_args(argv)
+
+    logging_level = app.logging.WARNING
+    app.logging.getLogger().setLevel(logging_level)
+    app.logger.setLevel(logging_level)
+
+    session = FakeSession(args.tg_latency_ms / 1000)
+    bot = app.setup_bot_session(Bot(token=os.environ["API_TOKEN"], session=session))
+    app.bot = bot
+
+    storage = RecordingStorage(args.sheets_latency_ms / 1000)
+    await app.init_google_sheets(storage)
+    await app.load_offers_from_sheet()
+    await app.CLIENT_ROW_INDEX.rebuild()
+
+    results = []
+    next_uid = 100_000
+    for n_users in args.users:
+        user_ids = list(range(next_uid, next_uid + n_users))
+        next_uid += n_users
+        for flow_name, build_update in FLOWS:
+            storage.stats.clear()
+            session.stats.clear()
+            latencies = await run_flow(bot, build_update, user_ids)
+            # отложенные записи тоже считаются в стоимость сценария
+            await app.CLIENT_ROWS.flush()
+            await app.LOG_WRITER.flush()
+            reads = sum(v for (kind, _), v in storage.stats.items() if kind == "read")
+            writes = sum(v for (kind, _), v in storage.stats.items() if kind == "write")
+            results.append({
+                "flow": flow_name,
+                "users": n_users,
+                "sheets_reads": reads,
+                "sheets_writes": writes,
+                "telegram_calls": sum(session.stats.values()),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                "sheets_detail": {name: v for (_, name), v in sorted(storage.stats.items())},
+                "telegram_detail": dict(session.stats),
+            })
+
+    header = f"{'flow':<26}{'users':>7}{'reads':>9}{'writes':>9}{'tg':>8}{'p50 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['flow']:<26}{r['users']:>7}{r['sheets_reads']:>9}{r['sheets_writes']:>9}"
+              f"{r['telegram_calls']:>8}{r['p50_ms']:>10}{r['p99_ms']:>10}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+    await app.LOG_WRITER.close()
+    await app.CLIENT_ROWS.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
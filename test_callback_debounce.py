@@ -0,0 +1,55 @@
+"""
+Гашение повторных нажатий (CallbackDebounceMiddleware): повтор снимает «часики» и дальше внешнего middleware
+не идёт — ни фильтров, ни ожидания хранилища, ни логов.
+
+    python -m unittest test_callback_debounce
+"""
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+from aiogram import Bot  # noqa: E402
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+
+
+class CallbackDebounceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = bench.FakeSession(0)
+        self.bot = app.setup_bot_session(Bot(token=os.environ["API_TOKEN"], session=self.session))
+        self._saved_bot = app.bot
+        app.bot = self.bot
+        await app.init_google_sheets(bench.RecordingStorage(0))
+        await app.load_offers_from_sheet()
+
+    async def asyncTearDown(self):
+        app.bot = self._saved_bot
+
+    async def test_repeated_tap_stops_before_inner_middlewares(self):
+        inner_calls = []
+        storage_ready = app.StorageReadyMiddleware.__call__
+
+        async def counting(middleware, handler, event, data):
+            inner_calls.append(event.data)
+            return await storage_ready(middleware, handler, event, data)
+
+        update = bench.callback_update(700_001, f"category:{bench.CATEGORIES[0]}")
+        with mock.patch.object(app.StorageReadyMiddleware, "__call__", counting):
+            await app.dp.feed_update(self.bot, update)
+            answered = self.session.stats["AnswerCallbackQuery"]
+            await app.dp.feed_update(self.bot, update)
+
+        self.assertEqual(inner_calls, [f"category:{bench.CATEGORIES[0]}"])
+        self.assertEqual(self.session.stats["AnswerCallbackQuery"], answered + 1)
+
+    def test_debounce_is_the_first_callback_middleware(self):
+        outer = list(app.dp.callback_query.outer_middleware)
+        self.assertIsInstance(outer[0], app.CallbackDebounceMiddleware)
+        self.assertFalse(any(isinstance(m, app.CallbackDebounceMiddleware) for m in app.dp.callback_query.middleware))
+
+
+if __name__ == "__main__":
+    unittest.main()
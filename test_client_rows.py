@@ -0,0 +1,144 @@
+"""
+Write-behind кэш строк клиентов (ClientRowCache) против листа, отвечающего с задержкой.
+
+Лист — фейковый, с асинхронными методами (как AsyncWorksheet): тест сам решает,
+когда Google «ответит» на чтение или запись, и так воспроизводит их пересечения.
+
+    python -m unittest test_client_rows
+"""
+import os
+import asyncio
+import unittest
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+ROW = 2
+COL_H = app.IDX_OFFER_NO
+
+
+class SheetsError(Exception):
+    """Ошибка Google с HTTP-статусом (как APIError у gspread)"""
+
+    def __init__(self, code: int):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class GatedSheet:
+    """Лист клиентов: чтения и записи ждут своего gate (если он задан), значения — на момент вызова"""
+
+    def __init__(self, rows: dict):
+        self.rows = {r: list(v) for r, v in rows.items()}
+        self.read_gate: asyncio.Event | None = None
+        self.write_gate: asyncio.Event | None = None
+        self.write_started = asyncio.Event()
+        self.writes = []
+        self.max_col = 100
+        self.fail_next: Exception | None = None
+
+    async def row_values(self, row_index):
+        snapshot = list(self.rows.get(row_index, []))
+        if self.read_gate is not None:
+            await self.read_gate.wait()
+        return snapshot
+
+    async def batch_update(self, data, value_input_option=None):
+        self.write_started.set()
+        if self.write_gate is not None:
+            await self.write_gate.wait()
+        if self.fail_next is not None:
+            e, self.fail_next = self.fail_next, None
+            raise e
+        if any(app.a1_to_rowcol(item["range"])[1] > self.max_col for item in data):
+            # как «exceeds grid limits» у Google: весь запрос отклонён, ничего не записано
+            raise SheetsError(400)
+        for item in data:
+            row_index, col = app.a1_to_rowcol(item["range"])
+            row = self.rows.setdefault(row_index, [])
+            row.extend([""] * (col - len(row)))
+            row[col - 1] = item["values"][0][0]
+        self.writes.append(data)
+
+
+class ClientRowCacheFlushRaceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        row = [""] * COL_H
+        row[COL_H - 1] = "1"
+        self.sheet = GatedSheet({ROW: row})
+        self._saved_sheet = app.sheet_clients
+        app.sheet_clients = self.sheet
+        app.READ_FLIGHTS.invalidate()
+        self.cache = app.ClientRowCache(3600, 0)
+
+    async def asyncTearDown(self):
+        app.sheet_clients = self._saved_sheet
+
+    async def test_row_read_during_flush_keeps_cells_being_written(self):
+        await self.cache.get_row(ROW)
+        self.cache.set_cell(ROW, COL_H, "1;3")
+        self.sheet.write_gate = asyncio.Event()
+        flush = asyncio.create_task(self.cache.flush())
+        await self.sheet.write_started.wait()
+
+        # ttl=0: строка перечитывается из таблицы, где H ещё старое
+        row = await self.cache.get_row(ROW)
+        self.assertEqual(row[COL_H - 1], "1;3")
+
+        self.sheet.write_gate.set()
+        self.assertTrue(await flush)
+        self.cache.set_cell(ROW, COL_H, (await self.cache.get_row(ROW))[COL_H - 1] + ";5")
+        self.assertTrue(await self.cache.flush())
+        self.assertEqual(self.sheet.rows[ROW][COL_H - 1], "1;3;5")
+
+    async def test_read_started_before_flush_sees_written_cells(self):
+        await self.cache.get_row(ROW)
+        self.cache.set_cell(ROW, COL_H, "1;3")
+        self.sheet.read_gate = asyncio.Event()
+        read = asyncio.create_task(self.cache.get_row(ROW))
+        await asyncio.sleep(0)
+
+        # запись успевает подтвердиться, пока чтение (со старым H) ещё не вернулось
+        self.assertTrue(await self.cache.flush())
+        self.sheet.read_gate.set()
+        row = await read
+        self.assertEqual(row[COL_H - 1], "1;3")
+        self.assertEqual(self.cache._written, {})
+
+
+class ClientRowCacheRejectTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sheet = GatedSheet({ROW: [""] * COL_H, ROW + 1: [""] * COL_H})
+        self.sheet.max_col = 40
+        self._saved_sheet = app.sheet_clients
+        app.sheet_clients = self.sheet
+        self.cache = app.ClientRowCache(3600, 3600)
+
+    async def asyncTearDown(self):
+        app.sheet_clients = self._saved_sheet
+
+    async def test_rejected_cell_is_dropped_and_the_rest_written(self):
+        self.cache.set_cell(ROW, COL_H, "3")
+        self.cache.set_cell(ROW, 50, "SELECTED")
+        self.cache.set_cell(ROW + 1, COL_H, "5")
+        self.assertTrue(await self.cache.flush())
+        self.assertEqual(self.cache.pending(), 0)
+        self.assertEqual(self.cache.rejected, 1)
+        self.assertEqual(self.sheet.rows[ROW][COL_H - 1], "3")
+        self.assertEqual(self.sheet.rows[ROW + 1][COL_H - 1], "5")
+        self.assertEqual(len(self.sheet.rows[ROW]), COL_H)
+
+    async def test_transient_error_keeps_the_batch(self):
+        self.cache.set_cell(ROW, COL_H, "3")
+        self.sheet.fail_next = ConnectionError("сеть")
+        self.assertFalse(await self.cache.flush())
+        self.assertEqual(self.cache.pending(), 1)
+        self.assertEqual(self.cache.rejected, 0)
+        self.assertTrue(await self.cache.flush())
+        self.assertEqual(self.sheet.rows[ROW][COL_H - 1], "3")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+"""
+Восстановление журнала записей (JOURNAL) после падения процесса.
+
+Каждая фаза — отдельный процесс с настоящим Bot.py на локальной SQLite (STORAGE_BACKEND=sqlite):
+1) клиент берёт офферы 1 и 3, процесс падает до записи в таблицу (в таблице H пусто, всё — в журнале);
+2) быстрый старт из снимка, тот же клиент сразу берёт оффер 5 через обработчики бота.
+В таблице должны оказаться все три оффера.
+
+Отдельно — хранилище, недоступное при старте (outage): изменения клиента, сделанные до подключения,
+доезжают в его существующую строку, когда подключение удаётся с повторной попытки.
+
+    python -m unittest test_journal
+"""
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+import subprocess
+
+USER_ID = 555
+CLIENT_ROW = 2
+
+
+def _env(tmp: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "API_TOKEN": "123456:TEST",
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_PATH": os.path.join(tmp, "storage.sqlite3"),
+        "JOURNAL_PATH": os.path.join(tmp, "journal.jsonl"),
+        "WARM_START_PATH": os.path.join(tmp, "warm_start.bin"),
+        "STATE_DB_PATH": "",
+        # в таблицу ничего не уходит само — только по явному flush
+        "CLIENT_FLUSH_INTERVAL_SEC": "3600",
+        "LOG_FLUSH_INTERVAL_SEC": "3600",
+        "STORAGE_RETRY_SEC": "0.05",
+        "REGISTRATION_RETRY_SEC": "0.05",
+        "JOURNAL_REPLAY_SEC": "0.05",
+    })
+    return env
+
+
+async def _phase_crash():
+    import bench
+    app = bench.app
+    storage = app.SQLiteStorage(app.SQLITE_PATH)
+    await storage.open()
+    bench.seed_sheets(storage)
+    storage.clients.append_rows([["1", str(USER_ID), "user555", "User", "+79000000555", "", "", ""]])
+    storage.conn.close()
+
+    await app.start_data_services()
+    for offer_id in ("1", "3"):
+        assert await app.mark_offer_taken_for_user(CLIENT_ROW, offer_id, user_id=str(USER_ID))
+    assert await app.WARM_START.save()
+    # падение: ячейки не записаны в таблицу, в журнале — без подтверждения
+    os._exit(0)
+
+
+async def _phase_restart():
+    import bench
+    app = bench.app
+    app.bot = app.setup_bot_session(bench.Bot(token=os.environ["API_TOKEN"], session=bench.FakeSession(0)))
+    await app.start_data_services()
+    # быстрый старт: обработчики идут сразу, подключение к таблице — фоном
+    await app.dp.feed_update(app.bot, bench.callback_update(USER_ID, "offer_select:5"))
+    await app.dp.feed_update(app.bot, bench.message_update(USER_ID, text="code5"))
+    assert await app.CLIENT_ROWS.flush()
+    assert await app.LOG_WRITER.flush()
+    row = app.sheet_clients.row_values(CLIENT_ROW)
+    cols = {offer_id: row[app.CLIENT_OFFER_COL_MAP[int(offer_id)] - 1] for offer_id in ("1", "3", "5")}
+    print(json.dumps({"h": row[app.IDX_OFFER_NO - 1], "cols": cols, "journal": app.JOURNAL.pending()}))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+async def _phase_outage():
+    import bench
+    app = bench.app
+    storage = app.SQLiteStorage(app.SQLITE_PATH)
+    await storage.open()
+    bench.seed_sheets(storage)
+    storage.clients.append_rows([["1", str(USER_ID), "user555", "User", "", "", "", "1"]])
+    storage.conn.close()
+
+    class FlakyStorage(app.SQLiteStorage):
+        failures = 2
+
+        async def open(self):
+            if FlakyStorage.failures:
+                FlakyStorage.failures -= 1
+                return False
+            return await super().open()
+
+    app.STORAGE_BACKENDS["sqlite"] = FlakyStorage
+    assert not await app.start_data_services()
+    # таблицы нет и снимка нет: клиента не найти — изменения в журнале и очереди на добавление
+    user = bench.make_user(USER_ID)
+    assert await app.update_client(user, phone="+79000000555")
+    assert await app.mark_offer_taken_for_user(None, "3", user_id=str(USER_ID))
+    assert await app.mark_offer_taken_for_user(None, "5", user_id=str(USER_ID))
+
+    for _ in range(200):
+        if app.storage and not app.CLIENT_REGISTRAR.pending() and not app.JOURNAL.deferred():
+            break
+        await asyncio.sleep(0.05)
+    assert await app.CLIENT_ROWS.flush()
+    row = app.sheet_clients.row_values(CLIENT_ROW)
+    cols = {offer_id: row[app.CLIENT_OFFER_COL_MAP[int(offer_id)] - 1] for offer_id in ("3", "5")}
+    print(json.dumps({"h": row[app.IDX_OFFER_NO - 1], "phone": row[app.IDX_PHONE - 1], "cols": cols,
+                      "rows": len(app.sheet_clients.col_values(app.IDX_USER_ID)), "journal": app.JOURNAL.pending()}))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+class JournalRestartTest(unittest.TestCase):
+    def _run_phase(self, env: dict, phase: str) -> str:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--phase", phase],
+                              env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=120)
+        self.assertEqual(proc.returncode, 0, proc.stderr[-2000:])
+        return proc.stdout
+
+    def test_take_after_restart_keeps_journaled_offers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = _env(tmp)
+            self._run_phase(env, "crash")
+            result = json.loads(self._run_phase(env, "restart").strip().splitlines()[-1])
+        self.assertEqual(result["h"], "1;3;5")
+        self.assertEqual(result["cols"], {"1": "SELECTED", "3": "SELECTED", "5": "SELECTED"})
+        self.assertEqual(result["journal"], 0)
+
+    def test_changes_made_before_storage_connects_reach_existing_row(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = json.loads(self._run_phase(_env(tmp), "outage").strip().splitlines()[-1])
+        self.assertEqual(result["h"], "1;3;5")
+        self.assertEqual(result["phone"], "+79000000555")
+        self.assertEqual(result["cols"], {"3": "SELECTED", "5": "SELECTED"})
+        # клиент уже был в таблице — второй строки для него не появилось
+        self.assertEqual(result["rows"], 2)
+        self.assertEqual(result["journal"], 0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--phase":
+        asyncio.run({"crash": _phase_crash, "restart": _phase_restart, "outage": _phase_outage}[sys.argv[2]]())
+    else:
+        unittest.main()
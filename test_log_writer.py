@@ -0,0 +1,111 @@
+"""
+Буферизованная запись логов (SheetLogWriter) при ошибках Google.
+
+    python -m unittest test_log_writer
+"""
+import os
+import unittest
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+from test_client_rows import SheetsError  # noqa: E402
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+
+
+class LogSheet:
+    """
+    Лист логов (без шапки в rows): строку с текстом "bad" Google не принимает — отклоняет весь append целиком.
+    fail_on_call — ошибка на N-й вызов append_rows; landed_on_call — N-й вызов добавит строки и всё равно упадёт
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.calls = 0
+        self.fail_on_call: dict[int, Exception] = {}
+        self.landed_on_call: dict[int, Exception] = {}
+
+    async def append_rows(self, values, value_input_option=None):
+        self.calls += 1
+        if self.calls in self.fail_on_call:
+            raise self.fail_on_call[self.calls]
+        if any("bad" in row for row in values):
+            raise SheetsError(400)
+        self.rows.extend(values)
+        if self.calls in self.landed_on_call:
+            raise self.landed_on_call[self.calls]
+        return {"updates": {"updatedRange": f"Logs!A{len(self.rows) - len(values) + 2}"}}
+
+    async def col_values(self, col):
+        return ["Дата"] + [row[col - 1] for row in self.rows]
+
+    async def batch_get(self, ranges):
+        first, last = ranges[0].split(":")
+        top, bottom = app.a1_to_rowcol(first)[0], app.a1_to_rowcol(last)[0]
+        return [[list(row) for row in self.rows[top - 2:bottom - 1]]]
+
+
+class SheetLogWriterTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sheet = LogSheet()
+        self._saved_sheet = app.sheet_logs
+        app.sheet_logs = self.sheet
+        self.writer = app.SheetLogWriter(3600, 100, 100)
+
+    async def asyncTearDown(self):
+        app.sheet_logs = self._saved_sheet
+
+    async def test_rejected_row_is_dropped_and_the_rest_appended_in_order(self):
+        for text in ("a", "b", "bad", "c", "d"):
+            self.writer.put([text])
+        self.assertTrue(await self.writer.flush())
+        self.assertEqual(self.sheet.rows, [["a"], ["b"], ["c"], ["d"]])
+        self.assertEqual(self.writer.rejected, 1)
+        self.assertEqual(self.writer.backlog(), 0)
+
+    async def test_transient_error_after_split_retries_only_unwritten_rows(self):
+        for text in ("a", "b", "bad", "c"):
+            self.writer.put([text])
+        # 1: вся пачка (400), 2: ["a", "b"] — добавлена, 3: ["bad", "c"] — сеть упала
+        self.sheet.fail_on_call[3] = ConnectionError("сеть")
+        self.assertFalse(await self.writer.flush())
+        self.assertEqual(self.writer.backlog(), 2)
+        self.assertTrue(await self.writer.flush())
+        self.assertEqual(self.sheet.rows, [["a"], ["b"], ["c"]])
+
+    async def test_ambiguous_error_does_not_duplicate_appended_rows(self):
+        for text in ("a", "b"):
+            self.writer.put([text])
+        # Google добавил строки, но ответил 503: планировщик не повторяет append сам
+        self.sheet.landed_on_call[1] = SheetsError(503)
+        self.assertFalse(await self.writer.flush())
+        self.assertEqual(self.sheet.calls, 1)
+        self.writer.put(["c"])
+        self.assertTrue(await self.writer.flush())
+        self.assertEqual(self.sheet.rows, [["a"], ["b"], ["c"]])
+
+
+class SheetsRetryTest(unittest.IsolatedAsyncioTestCase):
+    async def test_5xx_is_retried_only_for_idempotent_calls(self):
+        calls = []
+
+        async def flaky(name):
+            calls.append(name)
+            if calls.count(name) == 1:
+                raise SheetsError(503)
+            return name
+
+        saved = app.SHEETS.backoff_base
+        app.SHEETS.backoff_base = 0
+        try:
+            self.assertEqual(await app.sheets_call(flaky, "batch_update", op="write"), "batch_update")
+            with self.assertRaises(SheetsError):
+                await app.sheets_call(flaky, "append_rows", op="write", retry_5xx=False)
+        finally:
+            app.SHEETS.backoff_base = saved
+        self.assertEqual(calls, ["batch_update", "batch_update", "append_rows"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Поисковый индекс офферов для inline-режима (OfferSearchIndex): выдача и пересборка при перезагрузке каталога.
+Страницы офферов по битовой маске (_offers_page) — как их листает меню категории.
+
+    python -m unittest test_offer_search
+"""
+import os
+import unittest
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+
+HEADER = ["№", "user_id", "username", "Имя", "Телефон", "Дата", "Метка", "№ оффера", "", ""]
+QUERIES = ["", "7", "карта", "кредитн", "вкл", "ка", "тинькофф", "альфа карта", "оффер 1", "нет такого"]
+
+
+def offer_row(offer_id: int, name: str, category: str) -> list:
+    return [str(offer_id), category, "", name, "", "", "", "", f"https://example.com/{offer_id}", "100 ₽",
+            "Оформить", f"code{offer_id}"]
+
+
+def sheet(names: dict) -> list:
+    """Лист 'Офферы': {offer_id: (название, категория)}"""
+    rows = [["№", "Категория", "", "Название", "", "", "", "", "Ссылка", "Заплатим", "Действия", "Код"]]
+    rows += [offer_row(oid, name, cat) for oid, (name, cat) in sorted(names.items())]
+    return rows
+
+
+BASE = {
+    1: ("Тинькофф Black", "Дебетовые карты"),
+    2: ("Альфа-Карта", "Дебетовые карты"),
+    3: ("Альфа 100 дней", "Кредитные карты"),
+    4: ("Тинькофф Платинум", "Кредитные карты"),
+    5: ("Сбер Вклад", "Вклады"),
+    6: ("ВТБ Вклад", "Вклады"),
+    7: ("Оффер 7", "Вклады"),
+}
+
+
+def build(names: dict, prev=None) -> app.OfferSearchIndex:
+    return app.build_catalog_snapshot(sheet(names), HEADER, 1, prev_search=prev).search
+
+
+class OfferSearchIndexTest(unittest.TestCase):
+    def test_search_ranks_id_then_word_start_then_substring(self):
+        index = build(BASE)
+        self.assertEqual(index.search("7"), ["7"])
+        # номер оффера раньше совпадения в названии ("Альфа 100 дней")
+        self.assertEqual(index.search("1"), ["1", "3"])
+        # совпадение с начала слова ("Оффер 7") раньше подстроки ("Тинькофф")
+        self.assertEqual(index.search("офф"), ["7", "1", "4"])
+        self.assertEqual(index.search("альфа"), ["2", "3"])
+        self.assertEqual(index.search("альфа карта"), ["2"])
+        self.assertEqual(index.search("вкл"), ["5", "6", "7"])
+        # короткий запрос — по префиксам слов
+        self.assertEqual(index.search("ка"), ["1", "2", "3", "4"])
+        self.assertEqual(index.search("нет такого"), [])
+        self.assertEqual(index.search(""), [str(i) for i in range(1, 8)])
+
+    def test_incremental_build_matches_full_build(self):
+        prev = build(BASE)
+        names = dict(BASE)
+        names[2] = ("Альфа Премиум", "Дебетовые карты")   # изменён
+        del names[5]                                      # удалён
+        names[8] = ("Газпром Вклад", "Вклады")            # добавлен
+        incremental, full = build(names, prev), build(names)
+        for query in QUERIES + ["премиум", "газпром", "сбер"]:
+            self.assertEqual(incremental.search(query), full.search(query), query)
+
+    def test_reload_shares_unchanged_postings(self):
+        prev = build(BASE)
+        names = dict(BASE)
+        names[6] = ("Копилка Плюс", "Вклады")
+        index = build(names, prev)
+        # новая версия хранит только ключи, которых коснулось изменение оффера 6
+        self.assertIs(index.trigrams.base, prev.trigrams)
+        self.assertLess(len(index.trigrams.own), len(prev.trigrams.own) // 2)
+        self.assertIs(index.trigrams.get("тин"), prev.trigrams.get("тин"))
+        self.assertEqual(index.search("копилка"), ["6"])
+        self.assertEqual(index.search("втб"), [])
+
+    def test_layers_are_merged_after_many_reloads(self):
+        index = build(BASE)
+        names = dict(BASE)
+        for n in range(3 * app._Postings.MAX_DEPTH):
+            names[7] = (f"Оффер {n}", "Вклады")
+            index = build(names, index)
+            self.assertLessEqual(index.trigrams.depth, app._Postings.MAX_DEPTH)
+        self.assertEqual(index.search(f"оффер {n}"), ["7"])
+        for query in QUERIES:
+            self.assertEqual(index.search(query), build(names).search(query), query)
+
+
+class OffersPageTest(unittest.TestCase):
+    def setUp(self):
+        names = {oid: (f"Оффер {oid}", "Вклады") for oid in range(1, 24)}
+        self.catalog = app.build_catalog_snapshot(sheet(names), HEADER, 1)
+
+    def ids(self, mask: int, page: int, page_size: int = 5) -> list:
+        return [offer.id for offer in app._offers_page(self.catalog, mask, page, page_size)]
+
+    def mask(self, offer_ids) -> int:
+        return sum(1 << self.catalog.offers_by_id[str(oid)].idx for oid in offer_ids)
+
+    def test_pages_follow_catalog_order(self):
+        mask = self.catalog.category_mask["Вклады"]
+        pages = [self.ids(mask, page) for page in range(1, 6)]
+        self.assertEqual(pages[0], ["1", "2", "3", "4", "5"])
+        self.assertEqual(pages[4], ["21", "22", "23"])
+        self.assertEqual(sum(pages, []), [str(oid) for oid in range(1, 24)])
+        self.assertEqual(self.ids(mask, 6), [])
+
+    def test_taken_offers_are_skipped(self):
+        available = self.catalog.category_mask["Вклады"] & ~self.mask([2, 3, 7, 20])
+        self.assertEqual(self.ids(available, 1), ["1", "4", "5", "6", "8"])
+        self.assertEqual(self.ids(available, 4), ["19", "21", "22", "23"])
+
+    def test_matches_slicing_the_full_list(self):
+        offers = self.catalog.offers
+        for taken in ([], [1], [5, 6, 7, 8, 9, 10], list(range(1, 23))):
+            available = self.catalog.category_mask["Вклады"] & ~self.mask(taken)
+            full = [o.id for o in offers if available >> o.idx & 1]
+            for page in range(1, 7):
+                self.assertEqual(self.ids(available, page, 4), full[(page - 1) * 4:page * 4], (taken, page))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Объединение одинаковых одновременных чтений Sheets (ReadCoalescer): одно обращение к Google на всех,
+своя копия результата каждому, сброс после записи.
+
+    python -m unittest test_read_coalescer
+"""
+import os
+import asyncio
+import unittest
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+from test_client_rows import SheetsError  # noqa: E402
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+
+
+class SlowSheet:
+    """Чтение ждёт gate (если задан); calls — сколько раз чтение дошло до «Google»"""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate: asyncio.Event | None = None
+        self.value = ["1", "555"]
+        self.error: Exception | None = None
+        self.started = asyncio.Event()
+
+    async def row_values(self, row_index):
+        self.calls += 1
+        self.started.set()
+        value = list(self.value)
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        return value
+
+    async def batch_update(self, data, value_input_option=None):
+        pass
+
+
+class ReadCoalescerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sheet = SlowSheet()
+        self.reads = app.ReadCoalescer(0)
+
+    async def test_concurrent_reads_share_one_request_and_get_own_copies(self):
+        self.sheet.gate = asyncio.Event()
+        tasks = [asyncio.create_task(self.reads.read(self.sheet.row_values, 2)) for _ in range(5)]
+        await self.sheet.started.wait()
+        self.sheet.gate.set()
+        results = await asyncio.gather(*tasks)
+        self.assertEqual(self.sheet.calls, 1)
+        self.assertEqual(results, [["1", "555"]] * 5)
+        results[0].append("изменено")
+        self.assertEqual(results[1], ["1", "555"])
+
+    async def test_different_arguments_are_not_merged(self):
+        await asyncio.gather(self.reads.read(self.sheet.row_values, 2), self.reads.read(self.sheet.row_values, 3))
+        self.assertEqual(self.sheet.calls, 2)
+
+    async def test_error_reaches_every_waiter_and_next_read_goes_to_google(self):
+        self.sheet.gate = asyncio.Event()
+        self.sheet.error = SheetsError(400)
+        tasks = [asyncio.create_task(self.reads.read(self.sheet.row_values, 2)) for _ in range(3)]
+        await self.sheet.started.wait()
+        self.sheet.gate.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(isinstance(r, SheetsError) for r in results))
+        self.sheet.error = None
+        self.assertEqual(await self.reads.read(self.sheet.row_values, 2), ["1", "555"])
+        self.assertEqual(self.sheet.calls, 2)
+
+    async def test_read_after_invalidate_does_not_join_older_flight(self):
+        self.sheet.gate = asyncio.Event()
+        old = asyncio.create_task(self.reads.read(self.sheet.row_values, 2))
+        await self.sheet.started.wait()
+        # запись прошла, пока первое чтение ещё в полёте: новое чтение должно увидеть её
+        self.sheet.value = ["1", "777"]
+        self.reads.invalidate()
+        self.sheet.started.clear()
+        new = asyncio.create_task(self.reads.read(self.sheet.row_values, 2))
+        await self.sheet.started.wait()
+        self.sheet.gate.set()
+        self.assertEqual(await old, ["1", "555"])
+        self.assertEqual(await new, ["1", "777"])
+        self.assertEqual(self.sheet.calls, 2)
+
+    async def test_fresh_result_is_reused_until_a_write(self):
+        saved = app.READ_FLIGHTS
+        app.READ_FLIGHTS = self.reads
+        try:
+            self.assertEqual(await app.sheets_read(self.sheet.row_values, 2, fresh_sec=60), ["1", "555"])
+            self.assertEqual(await app.sheets_read(self.sheet.row_values, 2, fresh_sec=60), ["1", "555"])
+            self.assertEqual(self.sheet.calls, 1)
+            self.sheet.value = ["1", "777"]
+            await app.sheets_call(self.sheet.batch_update, [], op="write")
+            self.assertEqual(await app.sheets_read(self.sheet.row_values, 2, fresh_sec=60), ["1", "777"])
+            self.assertEqual(self.sheet.calls, 2)
+        finally:
+            app.READ_FLIGHTS = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
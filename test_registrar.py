@@ -0,0 +1,106 @@
+"""
+Регистрация новых клиентов (ClientRegistrar), когда append_rows падает: повтор после сверки индекса
+не задваивает строку, если она всё-таки добавилась, и добавляет её, если нет.
+
+    python -m unittest test_registrar
+"""
+import os
+import asyncio
+import unittest
+from unittest import mock
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+from test_client_rows import SheetsError  # noqa: E402
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+USER_ID = "601"
+
+
+class FlakyAppendSheet:
+    """Лист клиентов из SQLite; append_rows по очереди берёт сценарий из failures: ("landed"|"lost", ошибка)"""
+
+    def __init__(self, inner):
+        self._inner = inner
+        self.failures: list[tuple[str, Exception]] = []
+        self.appends = 0
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def append_rows(self, values, value_input_option=None):
+        self.appends += 1
+        if self.failures:
+            kind, e = self.failures.pop(0)
+            if kind == "landed":
+                self._inner.append_rows(values, value_input_option=value_input_option)
+            raise e
+        return self._inner.append_rows(values, value_input_option=value_input_option)
+
+
+def new_row(user_id: str, phone: str) -> list:
+    row = [""] * app.NUM_COLUMNS
+    row[app.IDX_USER_ID - 1] = user_id
+    row[app.IDX_PHONE - 1] = phone
+    return row
+
+
+class ClientRegistrarRetryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        for name in ("sheet_clients", "sheet_logs", "sheet_offers", "storage", "CLIENT_ROW_INDEX", "CLIENT_ROWS"):
+            patcher = mock.patch.object(app, name, getattr(app, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        storage = bench.RecordingStorage(0)
+        await app.init_google_sheets(storage)
+        self.sheet = FlakyAppendSheet(storage.inner.clients)
+        app.sheet_clients = self.sheet
+        app.CLIENT_ROW_INDEX = app.ClientRowIndex()
+        app.CLIENT_ROWS = app.ClientRowCache(3600, 3600)
+        self.registrar = app.ClientRegistrar(0, 100, 5, 0.01, 0.05)
+
+    def user_rows(self) -> list[int]:
+        col = self.sheet.col_values(app.IDX_USER_ID)
+        return [i for i, v in enumerate(col, start=1) if v == USER_ID]
+
+    async def test_ambiguous_append_is_not_repeated_when_the_row_landed(self):
+        self.sheet.failures.append(("landed", SheetsError(503)))
+        row_index, created = await self.registrar.register(USER_ID, new_row(USER_ID, "+79001234567"))
+        self.assertTrue(created)
+        self.assertEqual(self.user_rows(), [row_index])
+        self.assertEqual(self.sheet.appends, 1)
+        self.assertEqual(app.CLIENT_ROW_INDEX.get(USER_ID), row_index)
+        self.assertTrue(app.CLIENT_ROW_INDEX.has_phone(USER_ID))
+        self.assertEqual(self.registrar.pending(), 0)
+
+    async def test_failed_append_is_repeated_when_the_row_did_not_land(self):
+        self.sheet.failures.append(("lost", ConnectionError("сеть")))
+        row_index, created = await self.registrar.register(USER_ID, new_row(USER_ID, "+79001234567"))
+        self.assertTrue(created)
+        self.assertEqual(self.user_rows(), [row_index])
+        self.assertEqual(self.sheet.appends, 2)
+
+    async def test_rejected_batch_is_sent_row_by_row(self):
+        bad, good = "602", "603"
+        original = self.sheet._inner.append_rows
+
+        def append_rows(values, value_input_option=None):
+            self.sheet.appends += 1
+            if any(row[app.IDX_USER_ID - 1] == bad for row in values):
+                raise SheetsError(400)
+            return original(values, value_input_option=value_input_option)
+
+        self.sheet.append_rows = append_rows
+        self.registrar.batch_sec = 0.05
+        (bad_row, _), (good_row, _) = await asyncio.gather(
+            *(self.registrar.register(uid, new_row(uid, "")) for uid in (bad, good)))
+        self.assertIsNone(bad_row)
+        self.assertEqual(app.CLIENT_ROW_INDEX.get(good), good_row)
+        self.assertEqual(self.registrar.rejected, 1)
+        # пачка целиком, затем по одной
+        self.assertEqual(self.sheet.appends, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
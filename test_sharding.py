@@ -0,0 +1,82 @@
+"""
+Режим нескольких процессов (WORKERS > 1): каталог из снимка собирается до fork и достаётся воркерам готовым,
+воркер читает свою межпроцессную очередь отдельным потоком, пачками.
+
+    python -m unittest test_sharding
+"""
+import os
+import asyncio
+import tempfile
+import unittest
+import multiprocessing
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+
+
+def _catalog_in_child(conn):
+    conn.send((app.CATALOG.content_hash, len(app.CATALOG.offers)))
+    conn.close()
+
+
+class PreforkCatalogTest(unittest.TestCase):
+    def setUp(self):
+        self._saved = app.CATALOG
+        self.addCleanup(app._install_catalog, self._saved)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        async def snapshot():
+            await app.init_google_sheets(bench.RecordingStorage(0))
+            await app.load_offers_from_sheet()
+            warm = app.WarmStartSnapshot(os.path.join(self.tmp.name, "warm.bin"), "test", 0)
+            self.assertTrue(await warm.save())
+            return warm
+
+        self.warm = asyncio.run(snapshot())
+        self.content_hash = app.CATALOG.content_hash
+        app._install_catalog(app.CatalogSnapshot((), {}, {}, {}, 0, ""))
+
+    def test_catalog_restored_without_event_loop_is_inherited_by_fork(self):
+        self.assertTrue(self.warm.restore(index=False))
+        self.assertEqual(app.CATALOG.content_hash, self.content_hash)
+
+        ctx = multiprocessing.get_context("fork")
+        parent, child = ctx.Pipe()
+        proc = ctx.Process(target=_catalog_in_child, args=(child,))
+        proc.start()
+        content_hash, n_offers = parent.recv()
+        proc.join(timeout=30)
+        self.assertEqual(content_hash, self.content_hash)
+        self.assertEqual(n_offers, bench.OFFERS_PER_CATEGORY * len(bench.CATEGORIES))
+
+
+class QueueReaderTest(unittest.IsolatedAsyncioTestCase):
+    async def test_messages_arrive_in_order_and_reader_stops(self):
+        queue = multiprocessing.get_context("fork").Queue()
+        for i in range(5):
+            queue.put(("menu", i))
+        queue.put(("stop",))
+        inbox = app._start_queue_reader(queue, asyncio.get_running_loop(), "test-queue")
+        received = []
+        while not received or received[-1] != ("stop",):
+            received.extend(await asyncio.wait_for(inbox.get(), 5))
+        self.assertEqual(received, [("menu", i) for i in range(5)] + [("stop",)])
+
+    async def test_dispatch_stops_on_stop_and_handles_messages_before_it(self):
+        adopted = []
+        saved = app.adopt_broadcast_menu
+        app.adopt_broadcast_menu = lambda *args: adopted.append(args)
+        try:
+            self.assertTrue(await app._worker_dispatch([("menu", 1, 2)], 0, None))
+            self.assertFalse(await app._worker_dispatch([("menu", 3, 4), ("stop",), ("menu", 5, 6)], 0, None))
+        finally:
+            app.adopt_broadcast_menu = saved
+        self.assertEqual(adopted, [(1, 2), (3, 4)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+"""
+Бэкенд хранилища на aiohttp (AsyncSheetsClient / AsyncWorksheet / AsyncSheetsStorage) против локального
+HTTP-сервера, который отвечает как Sheets API v4 и запоминает запросы.
+Токен сервисного аккаунта выдаёт фейковый oauth2client: без сети и без ключа.
+
+    python -m unittest test_sheets_http
+"""
+import os
+import json
+import unittest
+from unittest import mock
+from collections import namedtuple
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+app.logging.getLogger("aiohttp.access").setLevel(app.logging.WARNING)
+
+SPREADSHEET_ID = "sheet-id"
+TokenInfo = namedtuple("TokenInfo", "access_token expires_in")
+
+
+class FakeCredentials:
+    """Как ServiceAccountCredentials: get_access_token отдаёт прежний токен, пока не вызван refresh"""
+
+    def __init__(self):
+        self.refreshes = 0
+
+    def get_access_token(self):
+        return TokenInfo(f"token{self.refreshes + 1}", 3600)
+
+    def refresh(self, http):
+        self.refreshes += 1
+
+
+class FakeSheetsAPI:
+    """Sheets API v4 на aiohttp.web: ответы по (метод, путь) и список принятых запросов"""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = {}    # (method, path) -> [(status, body), ...] по очереди; последний — навсегда
+        self.web_app = web.Application()
+        self.web_app.router.add_route("*", "/v4/spreadsheets/{tail:.*}", self.handle)
+
+    def reply(self, method: str, path: str, *responses):
+        self.responses[(method, f"/v4/spreadsheets/{SPREADSHEET_ID}{path}")] = list(responses)
+
+    async def handle(self, request: web.Request):
+        body = await request.read()
+        self.requests.append({
+            "method": request.method,
+            "path": request.path,
+            "query": list(request.query.items()),
+            "auth": request.headers.get("Authorization"),
+            "json": json.loads(body) if body else None,
+        })
+        queue = self.responses.get((request.method, request.path))
+        if not queue:
+            return web.json_response({"error": "not found"}, status=404)
+        status, payload = queue.pop(0) if len(queue) > 1 else queue[0]
+        return web.json_response(payload, status=status)
+
+
+class SheetsHTTPTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.api = FakeSheetsAPI()
+        self.server = TestServer(self.api.web_app)
+        await self.server.start_server()
+        patcher = mock.patch.object(app.ServiceAccountCredentials, "from_json_keyfile_dict",
+                                    return_value=FakeCredentials())
+        self.creds = patcher.start()
+        self.addCleanup(patcher.stop)
+        url_patcher = mock.patch.object(app.AsyncSheetsClient, "API_URL", str(self.server.make_url("/v4/spreadsheets")))
+        url_patcher.start()
+        self.addCleanup(url_patcher.stop)
+        self.client = app.AsyncSheetsClient({}, SPREADSHEET_ID)
+        self.sheet = app.AsyncWorksheet(self.client, app.SHEET_CLIENTS_TITLE)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+
+class AsyncWorksheetTest(SheetsHTTPTestCase):
+    async def test_row_values_builds_quoted_range_with_token(self):
+        self.api.reply("GET", f"/values/'{app.SHEET_CLIENTS_TITLE}'!2:2", (200, {"values": [["1", "555"]]}))
+        self.assertEqual(await self.sheet.row_values(2), ["1", "555"])
+        req = self.api.requests[0]
+        self.assertEqual(req["query"], [("majorDimension", "ROWS")])
+        self.assertEqual(req["auth"], "Bearer token1")
+
+    async def test_col_values_asks_for_columns(self):
+        self.api.reply("GET", f"/values/'{app.SHEET_CLIENTS_TITLE}'!B:B", (200, {"values": [["user_id", "555"]]}))
+        self.assertEqual(await self.sheet.col_values(2), ["user_id", "555"])
+        self.assertEqual(self.api.requests[0]["query"], [("majorDimension", "COLUMNS")])
+
+    async def test_batch_get_keeps_order_and_empty_ranges(self):
+        self.api.reply("GET", "/values:batchGet", (200, {"valueRanges": [
+            {"range": "a", "values": [["1", "2"]]},
+            {"range": "b"},   # пустой диапазон Google отдаёт без values
+        ]}))
+        self.assertEqual(await self.sheet.batch_get(["A2:C2", "A3:C3"]), [[["1", "2"]], []])
+        title = app.SHEET_CLIENTS_TITLE
+        self.assertEqual(self.api.requests[0]["query"], [("ranges", f"'{title}'!A2:C2"), ("ranges", f"'{title}'!A3:C3")])
+
+    async def test_batch_update_prefixes_ranges_with_sheet_title(self):
+        self.api.reply("POST", "/values:batchUpdate", (200, {"totalUpdatedCells": 2}))
+        await self.sheet.batch_update([{"range": "H2", "values": [["1;3"]]}, {"range": "K2", "values": [["SELECTED"]]}],
+                                      value_input_option="USER_ENTERED")
+        self.assertEqual(self.api.requests[0]["json"], {
+            "valueInputOption": "USER_ENTERED",
+            "data": [
+                {"range": f"'{app.SHEET_CLIENTS_TITLE}'!H2", "values": [["1;3"]]},
+                {"range": f"'{app.SHEET_CLIENTS_TITLE}'!K2", "values": [["SELECTED"]]},
+            ],
+        })
+
+    async def test_append_rows_inserts_and_reports_first_row(self):
+        self.api.reply("POST", f"/values/'{app.SHEET_CLIENTS_TITLE}'!A1:append", (200, {
+            "updates": {"updatedRange": f"'{app.SHEET_CLIENTS_TITLE}'!A5:H6", "updatedRows": 2},
+        }))
+        resp = await self.sheet.append_rows([["5", "111"], ["6", "222"]], value_input_option="USER_ENTERED")
+        self.assertEqual(app._appended_first_row(resp), 5)
+        req = self.api.requests[0]
+        self.assertEqual(sorted(req["query"]), [("insertDataOption", "INSERT_ROWS"), ("valueInputOption", "USER_ENTERED")])
+        self.assertEqual(req["json"], {"values": [["5", "111"], ["6", "222"]]})
+
+    async def test_error_status_reaches_scheduler(self):
+        self.api.reply("GET", f"/values/'{app.SHEET_CLIENTS_TITLE}'!2:2", (400, {"error": "bad range"}))
+        with self.assertRaises(app.SheetsHTTPError) as ctx:
+            await self.sheet.row_values(2)
+        self.assertEqual(app._sheets_error_status(ctx.exception), 400)
+        self.assertTrue(app._sheets_error_permanent(ctx.exception))
+
+
+class AsyncSheetsClientAuthTest(SheetsHTTPTestCase):
+    async def test_401_refreshes_token_and_retries_once(self):
+        self.api.reply("GET", f"/values/'{app.SHEET_CLIENTS_TITLE}'!2:2",
+                       (401, {"error": "expired"}), (200, {"values": [["1"]]}))
+        self.assertEqual(await self.sheet.row_values(2), ["1"])
+        self.assertEqual([r["auth"] for r in self.api.requests], ["Bearer token1", "Bearer token2"])
+        self.assertEqual(self.creds.return_value.refreshes, 1)
+        # новый токен дальше используется без обновлений
+        await self.sheet.row_values(2)
+        self.assertEqual(self.api.requests[-1]["auth"], "Bearer token2")
+
+    async def test_second_401_is_raised(self):
+        self.api.reply("GET", f"/values/'{app.SHEET_CLIENTS_TITLE}'!2:2", (401, {"error": "denied"}))
+        with self.assertRaises(app.SheetsHTTPError) as ctx:
+            await self.sheet.row_values(2)
+        self.assertEqual(ctx.exception.code, 401)
+        self.assertEqual(len(self.api.requests), 2)
+
+
+class AsyncSheetsStorageTest(SheetsHTTPTestCase):
+    async def _open(self, titles) -> bool:
+        self.api.reply("GET", "", (200, {"sheets": [{"properties": {"title": t}} for t in titles]}))
+        storage = app.AsyncSheetsStorage()
+        url = f"https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/edit"
+        with mock.patch.dict(os.environ, {"GOOGLE_CREDENTIALS": "{}"}), mock.patch.object(app, "SPREADSHEET_URL", url):
+            try:
+                return await storage.open()
+            finally:
+                await storage.close()
+
+    async def test_open_checks_sheet_titles(self):
+        titles = [app.SHEET_CLIENTS_TITLE, app.SHEET_LOGS_TITLE, app.SHEET_OFFERS_TITLE]
+        self.assertTrue(await self._open(titles))
+        self.assertEqual(self.api.requests[0]["query"], [("fields", "sheets.properties.title")])
+        self.assertFalse(await self._open(titles[:2]))
+
+    def test_aiohttp_is_the_default_backend(self):
+        self.assertIs(app.STORAGE_BACKENDS[app.STORAGE_BACKEND], app.AsyncSheetsStorage)
+
+
+if __name__ == "__main__":
+    unittest.main()
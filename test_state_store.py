@@ -0,0 +1,104 @@
+"""
+Состояние пользователей (StateStore): вытеснение по TTL и LRU, сохранение в SQLite (StateDB) и загрузка после рестарта.
+
+    python -m unittest test_state_store
+"""
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+TTL = 60
+
+
+class Clock:
+    """time.time, который двигает тест"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+class StateStoreTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(app.time, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "state.sqlite3")
+
+    def store(self, max_entries: int = 100, max_bytes: int = 1 << 20, db=True) -> app.StateStore:
+        return app.StateStore("menu", TTL, max_entries, max_bytes, app.StateDB(self.path) if db else None)
+
+    def test_entries_expire_after_ttl_since_last_access(self):
+        store = self.store(db=False)
+        store[1] = {"page": 1}
+        self.clock.now += TTL - 1
+        self.assertEqual(store.get(1), {"page": 1})   # обращение продлевает TTL
+        self.clock.now += TTL - 1
+        self.assertIn(1, store)
+        self.clock.now += TTL + 1
+        self.assertIsNone(store.get(1))
+        self.assertEqual(len(store), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        store = self.store(max_entries=2, db=False)
+        store[1], store[2] = "a", "b"
+        store.get(1)
+        store[3] = "c"
+        self.assertNotIn(2, store)
+        self.assertEqual((store.get(1), store.get(3)), ("a", "c"))
+        self.assertEqual(store.evicted, 1)
+
+    def test_memory_limit_evicts_oldest(self):
+        store = self.store(max_bytes=3 * 200, db=False)
+        for key in range(1, 6):
+            store[key] = "x" * 50
+        self.assertLessEqual(store.memory_bytes(), 3 * 200)
+        self.assertNotIn(1, store)
+        self.assertIn(5, store)
+
+    async def test_state_survives_restart(self):
+        store = self.store()
+        store[1] = {"chat_id": 1, "message_id": 10, "category": "Вклады", "page": 2}
+        store["key"] = [1, 2]
+        store[3] = "удалим"
+        await store.flush()
+        store.pop(3)
+        await store.flush()
+
+        restored = self.store()
+        self.assertEqual(await restored.load(), 2)
+        self.assertEqual(restored[1]["page"], 2)
+        self.assertEqual(restored["key"], [1, 2])
+        self.assertNotIn(3, restored)
+
+    async def test_reads_extend_ttl_in_db_and_expired_entries_are_deleted(self):
+        store = self.store()
+        store[1], store[2] = "читают", "забыли"
+        await store.flush()
+        self.clock.now += TTL - 1
+        store.get(1)
+        await store.flush()
+        self.clock.now += 2
+
+        restored = self.store()
+        self.assertEqual(await restored.load(), 1)
+        self.assertEqual(restored.get(1), "читают")
+        # просроченная запись удаляется из базы при следующем сбросе
+        await restored.flush()
+        self.assertEqual([key for key, _, _ in app.StateDB(self.path).load("menu")], ["1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
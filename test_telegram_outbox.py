@@ -0,0 +1,107 @@
+"""
+Очередь исходящих запросов к Bot API: порядок выдачи токенов (TokenBucket) и приоритеты,
+схлопывание правок в TelegramOutbox.
+
+    python -m unittest test_telegram_outbox
+"""
+import os
+import asyncio
+import unittest
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, GetMe, SendMessage  # noqa: E402
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+CHAT = 42
+
+
+class TokenBucketTest(unittest.IsolatedAsyncioTestCase):
+    async def _order(self, bucket: app.TokenBucket, waiters) -> list:
+        """waiters: [(метка, priority)] — ставятся в очередь по порядку; возвращает порядок получения токенов"""
+        got = []
+
+        async def take(label, priority):
+            await bucket.acquire(priority)
+            got.append(label)
+
+        await asyncio.gather(*(take(label, priority) for label, priority in waiters))
+        return got
+
+    async def test_waiters_get_tokens_by_priority_then_arrival(self):
+        bucket = app.TokenBucket(200, 1)
+        bucket.tokens = 0
+        got = await self._order(bucket, [("bulk", 3), ("send1", 2), ("answer", 0), ("send2", 2), ("edit", 1)])
+        self.assertEqual(got, ["answer", "edit", "send1", "send2", "bulk"])
+
+    async def test_promote_moves_waiter_ahead(self):
+        bucket = app.TokenBucket(200, 1)
+        bucket.tokens = 0
+        got = []
+
+        class Holder:
+            waiting = None
+
+        async def take(label, priority, holder=None):
+            await bucket.acquire(priority, holder)
+            got.append(label)
+
+        holder = Holder()
+        tasks = [asyncio.create_task(take("background", 5, holder)), asyncio.create_task(take("user", 1))]
+        await asyncio.sleep(0)
+        bucket.promote(holder.waiting[1], 0)
+        await asyncio.gather(*tasks)
+        self.assertEqual(got, ["background", "user"])
+
+    async def test_rate_limits_tokens(self):
+        bucket = app.TokenBucket(100, 1)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*(bucket.acquire() for _ in range(6)))
+        # первый — из запаса, остальные пять — по одному за 10 мс
+        self.assertGreaterEqual(loop.time() - start, 0.045)
+
+
+class TelegramOutboxTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.outbox = app.TelegramOutbox(100, 1000, 1000, 20, 0, 0)
+        self.outbox.global_bucket.tokens = 0
+        self.sent = []
+
+    async def make_request(self, bot_, method):
+        self.sent.append(method)
+        return f"{type(method).__name__}:{getattr(method, 'text', '')}"
+
+    async def test_callback_answer_goes_before_queued_messages(self):
+        send = asyncio.create_task(self.outbox(self.make_request, None, SendMessage(chat_id=CHAT, text="hi")))
+        await asyncio.sleep(0)
+        answer = asyncio.create_task(self.outbox(self.make_request, None, AnswerCallbackQuery(callback_query_id="1")))
+        await asyncio.gather(send, answer)
+        self.assertEqual([type(m).__name__ for m in self.sent], ["AnswerCallbackQuery", "SendMessage"])
+
+    async def test_bulk_priority_waits_for_user_messages(self):
+        async def bulk():
+            app.TG_PRIORITY.set(app.TG_PRIO_BULK)
+            return await self.outbox(self.make_request, None, SendMessage(chat_id=CHAT + 1, text="рассылка"))
+
+        first = asyncio.create_task(bulk())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(self.outbox(self.make_request, None, SendMessage(chat_id=CHAT, text="ответ")))
+        await asyncio.gather(first, second)
+        self.assertEqual([m.text for m in self.sent], ["ответ", "рассылка"])
+
+    async def test_queued_edits_of_one_message_collapse_into_the_last(self):
+        edits = [EditMessageText(chat_id=CHAT, message_id=7, text=f"страница {i}") for i in range(1, 4)]
+        results = await asyncio.gather(*(self.outbox(self.make_request, None, m) for m in edits))
+        self.assertEqual([m.text for m in self.sent], ["страница 3"])
+        self.assertEqual(results, ["EditMessageText:страница 3"] * 3)
+        self.assertEqual(self.outbox.collapsed, 2)
+
+    async def test_service_methods_bypass_the_queue(self):
+        self.assertEqual(await self.outbox(self.make_request, None, GetMe()), "GetMe:")
+        self.assertIsNone(self.outbox.global_bucket._pump_task)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Индекс клиентов из снимка быстрого старта (WarmStartSnapshot): пока хранилище подключается,
+регистрацию проверяем по признаку телефона из снимка.
+
+    python -m unittest test_warm_start
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+WITH_PHONE, WITHOUT_PHONE, PHONE_LATER = "501", "502", "503"
+
+
+def client_row(user_id: str, phone: str) -> list:
+    row = [""] * app.NUM_COLUMNS
+    row[app.IDX_USER_ID - 1] = user_id
+    row[app.IDX_PHONE - 1] = phone
+    return row
+
+
+class WarmStartPhoneTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        for name in ("sheet_clients", "sheet_logs", "sheet_offers", "storage", "CLIENT_ROW_INDEX", "CLIENT_ROWS"):
+            patcher = mock.patch.object(app, name, getattr(app, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        app.CLIENT_ROW_INDEX = app.ClientRowIndex()
+        app.CLIENT_ROWS = app.ClientRowCache(3600, 3600)
+        storage = bench.RecordingStorage(0)
+        await app.init_google_sheets(storage)
+        storage.inner.clients.append_rows([client_row(WITH_PHONE, "+79001234567"), client_row(WITHOUT_PHONE, ""),
+                                           client_row(PHONE_LATER, "")])
+        self.assertTrue(await app.CLIENT_ROW_INDEX.rebuild())
+        # телефон, ещё не дошедший до таблицы, тоже попадает в снимок
+        app.CLIENT_ROWS.set_cell(app.CLIENT_ROW_INDEX.get(PHONE_LATER), app.IDX_PHONE, "+79007654321",
+                                 user_id=PHONE_LATER)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.warm = app.WarmStartSnapshot(os.path.join(tmp.name, "warm.bin"), "test", 0)
+        self.assertTrue(await self.warm.save())
+
+    async def test_registration_checked_by_phone_bit_until_storage_connects(self):
+        app.CLIENT_ROW_INDEX = app.ClientRowIndex()
+        app.sheet_clients = None
+        self.assertTrue(self.warm.restore(catalog=False))
+        self.assertTrue(app.CLIENT_ROW_INDEX.from_disk)
+        self.assertTrue(await app.is_registered(int(WITH_PHONE)))
+        self.assertFalse(await app.is_registered(int(WITHOUT_PHONE)))
+        self.assertTrue(await app.is_registered(int(PHONE_LATER)))
+
+    async def test_rebuild_keeps_phone_still_being_written(self):
+        self.assertTrue(await app.CLIENT_ROW_INDEX.rebuild())
+        self.assertTrue(app.CLIENT_ROW_INDEX.has_phone(PHONE_LATER))
+        self.assertFalse(app.CLIENT_ROW_INDEX.has_phone(WITHOUT_PHONE))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Приём апдейтов в режиме webhook (handle_webhook): без верного секрета апдейт не обрабатывается.
+
+    python -m unittest test_webhook
+"""
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("JOURNAL_PATH", "")
+import bench  # noqa: E402  (окружение бенчмарка: без сети, без квот)
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+app = bench.app
+app.logger.setLevel(app.logging.WARNING)
+SECRET = "s3cr3t-token"
+HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookSecretTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.submitted = []
+        for patcher in (
+            mock.patch.object(app, "WEBHOOK_SECRET", SECRET),
+            mock.patch.object(app, "SHARD_ROUTER", None),
+            mock.patch.object(app.UPDATE_PROCESSOR, "submit", lambda bot_, update: self.submitted.append(update)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        web_app = web.Application()
+        web_app.router.add_post(app.WEBHOOK_PATH, app.handle_webhook)
+        self.client = TestClient(TestServer(web_app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def post(self, headers: dict, body=None):
+        update = bench.callback_update(800_001, "category:Вклады")
+        payload = body if body is not None else update.model_dump(mode="json", exclude_none=True)
+        return await self.client.post(app.WEBHOOK_PATH, json=payload, headers=headers)
+
+    async def test_update_with_secret_is_accepted(self):
+        resp = await self.post({HEADER: SECRET})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual([u.update_id for u in self.submitted], [800_001])
+
+    async def test_missing_or_wrong_secret_is_rejected(self):
+        for headers in ({}, {HEADER: "wrong"}, {HEADER: SECRET + "x"}):
+            resp = await self.post(headers)
+            self.assertEqual(resp.status, 401, headers)
+        self.assertEqual(self.submitted, [])
+
+    async def test_no_secret_configured_rejects_everything(self):
+        with mock.patch.object(app, "WEBHOOK_SECRET", ""), \
+                mock.patch.object(app, "WEBHOOK_BASE_URL", "https://bot.example.com"):
+            self.assertEqual((await self.post({HEADER: ""})).status, 401)
+            # и сам режим webhook без секрета не запускается
+            self.assertIn("WEBHOOK_SECRET", app.webhook_config_error())
+        self.assertEqual(self.submitted, [])
+
+    async def test_malformed_update_is_rejected(self):
+        resp = await self.post({HEADER: SECRET}, body={"update_id": "не число"})
+        self.assertEqual(resp.status, 400)
+        self.assertEqual(self.submitted, [])
+
+
+if __name__ == "__main__":
+    unittest.main()